@@ -0,0 +1,219 @@
+"""Admission control for the CPU-heavy prediction routes.
+
+Each limited route gets an AdmissionController with a concurrency limit,
+a bounded wait queue and a per-user limit. When the queue is full, or a
+request waits longer than ``queue_timeout``, the route answers ``503``
+straight away. A user over their own limit gets ``429``. Both carry a
+``Retry-After`` estimate, so a burst cannot pile CPU work onto every
+worker and starve cheap requests such as the ``/`` health check.
+
+The limits hold for all worker processes on the host together: every
+slot (running, queued, or one of a user's) is an ``flock`` on a file in
+``ADMISSION_LOCK_DIR``, and a worker that dies frees its slots with its
+files. Waiting requests poll for a free slot every ``POLL_INTERVAL``
+seconds. Retry-After assumes the host is as busy as the limits allow.
+Without ``fcntl`` (Windows) the limits are per process.
+
+Limits come from ``app.config['ADMISSION_LIMITS'][endpoint]`` and fall
+back to the ADMISSION_* environment variables.
+"""
+import math
+import os
+import threading
+import time
+from collections import Counter
+from functools import wraps
+
+from flask import current_app, g, jsonify, request, Response
+from flask_login import current_user
+
+import metrics
+from cpus import available_cores
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+DEFAULT_LIMITS = {
+    'max_concurrent': int(os.environ.get('ADMISSION_MAX_CONCURRENT', available_cores())),
+    'max_queue': int(os.environ.get('ADMISSION_MAX_QUEUE', 2 * available_cores())),
+    'max_per_user': int(os.environ.get('ADMISSION_MAX_PER_USER', 2)),
+    'queue_timeout': float(os.environ.get('ADMISSION_QUEUE_TIMEOUT', 10)),
+}
+ADMISSION_LOCK_DIR = os.environ.get('ADMISSION_LOCK_DIR', os.path.join('instance', 'admission'))
+POLL_INTERVAL = 0.02
+
+
+class SlotFiles:
+    """Named groups of slots shared by the processes on this host, one locked file per slot."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+
+    def try_acquire(self, name, size):
+        """A handle holding one of ``name``'s ``size`` slots, or None if all are taken."""
+        for i in range(size):
+            handle = open(os.path.join(self.directory, f"{name}.{i}"), 'a')
+            try:
+                fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                handle.close()
+                continue
+            return handle
+        return None
+
+    def release(self, handle):
+        # Closing the file drops the lock
+        handle.close()
+
+
+class LocalSlots:
+    """``SlotFiles`` for a single process."""
+
+    def __init__(self, directory):
+        self.taken = Counter()
+        self._lock = threading.Lock()
+
+    def try_acquire(self, name, size):
+        with self._lock:
+            if self.taken[name] >= size:
+                return None
+            self.taken[name] += 1
+            return name
+
+    def release(self, handle):
+        with self._lock:
+            self.taken[handle] -= 1
+            if self.taken[handle] <= 0:
+                del self.taken[handle]
+
+
+Slots = SlotFiles if fcntl is not None else LocalSlots
+
+
+class AdmissionRejected(Exception):
+    def __init__(self, status, reason, retry_after):
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    def __init__(self, name, max_concurrent, max_queue, max_per_user, queue_timeout, lock_dir=ADMISSION_LOCK_DIR):
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.max_per_user = max_per_user
+        self.queue_timeout = queue_timeout
+        self._slots = Slots(lock_dir)
+        # This process' share, for the gauges
+        self.active = 0
+        self.waiting = 0
+        # Smoothed service time, used for Retry-After estimates
+        self.avg_service_time = 1.0
+        self._lock = threading.Lock()
+
+    def retry_after(self, backlog):
+        return max(1, math.ceil(self.avg_service_time * backlog / self.max_concurrent))
+
+    def _reject(self, status, reason, backlog):
+        metrics.inc("food_admission_rejected_total", route=self.name, reason=reason)
+        raise AdmissionRejected(status, reason, self.retry_after(backlog))
+
+    def _publish(self):
+        metrics.set_gauge("food_admission_active", self.active, route=self.name)
+        metrics.set_gauge("food_admission_queue_depth", self.waiting, route=self.name)
+
+    def _count(self, field, delta):
+        with self._lock:
+            setattr(self, field, getattr(self, field) + delta)
+            self._publish()
+
+    def acquire(self, user_id):
+        """Wait for a slot; returns the token to pass to ``release``."""
+        user_slot = self._slots.try_acquire(f"{self.name}.user-{user_id}", self.max_per_user)
+        if user_slot is None:
+            self._reject(429, 'user_limit', self.max_per_user)
+        try:
+            slot = self._slots.try_acquire(f"{self.name}.run", self.max_concurrent)
+            if slot is None:
+                queued = self._slots.try_acquire(f"{self.name}.queue", self.max_queue)
+                if queued is None:
+                    self._reject(503, 'queue_full', self.max_concurrent + self.max_queue)
+                self._count('waiting', 1)
+                deadline = time.monotonic() + self.queue_timeout
+                try:
+                    while slot is None:
+                        if time.monotonic() >= deadline:
+                            self._reject(503, 'queue_timeout', self.max_concurrent + self.max_queue)
+                        time.sleep(POLL_INTERVAL)
+                        slot = self._slots.try_acquire(f"{self.name}.run", self.max_concurrent)
+                finally:
+                    self._slots.release(queued)
+                    self._count('waiting', -1)
+        except AdmissionRejected:
+            self._slots.release(user_slot)
+            raise
+        self._count('active', 1)
+        return time.monotonic(), slot, user_slot
+
+    def release(self, token):
+        admitted_at, slot, user_slot = token
+        elapsed = time.monotonic() - admitted_at
+        self._slots.release(slot)
+        self._slots.release(user_slot)
+        with self._lock:
+            self.active -= 1
+            self.avg_service_time = 0.8 * self.avg_service_time + 0.2 * elapsed
+            self._publish()
+
+
+_controllers = {}
+_controllers_lock = threading.Lock()
+
+
+def get_controller(name):
+    with _controllers_lock:
+        controller = _controllers.get(name)
+        if controller is None:
+            limits = dict(DEFAULT_LIMITS)
+            limits.update(current_app.config.get('ADMISSION_LIMITS', {}).get(name, {}))
+            controller = _controllers[name] = AdmissionController(name, **limits)
+        return controller
+
+
+def _rejection_response(rejection):
+    message = 'Server is busy, please retry shortly.' if rejection.status == 503 else \
+        'Too many analyses in progress for this account, please wait for them to finish.'
+    if request.path.startswith('/api/') or request.accept_mimetypes.best == 'application/json':
+        response = jsonify({'error': message, 'reason': rejection.reason})
+        response.status_code = rejection.status
+    else:
+        response = Response(message, status=rejection.status, mimetype='text/plain')
+    response.headers['Retry-After'] = str(rejection.retry_after)
+    return response
+
+
+def admission_limited(view):
+    """Admit the view through the controller named after its endpoint.
+
+    Apply it inside ``login_required``/``token_required`` so the user is known.
+    """
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        controller = get_controller(request.endpoint)
+        api_user = g.get('api_user')
+        user_id = api_user.id if api_user is not None else current_user.get_id()
+        try:
+            with metrics.stage("admission.wait"):
+                token = controller.acquire(user_id)
+        except AdmissionRejected as rejection:
+            return _rejection_response(rejection)
+        try:
+            return view(*args, **kwargs)
+        finally:
+            controller.release(token)
+    return wrapper
@@ -0,0 +1,48 @@
+"""Bearer-token authentication for the JSON API."""
+import hashlib
+import secrets
+from datetime import datetime, timedelta
+from functools import wraps
+
+from flask import g, jsonify, request
+
+import user_cache
+from auth import db, ApiToken
+
+# last_used_at is informational; avoid a write on every API call.
+LAST_USED_RESOLUTION = timedelta(minutes=5)
+
+
+def hash_token(token):
+    return hashlib.sha256(token.encode('utf-8')).hexdigest()
+
+
+def create_api_token(user, name=None):
+    """Create a token for ``user`` and return the plaintext. It cannot be recovered later."""
+    token = secrets.token_urlsafe(32)
+    db.session.add(ApiToken(user_id=user.id, name=name, token_hash=hash_token(token)))
+    db.session.commit()
+    return token
+
+
+def token_required(view):
+    """Authenticate with ``Authorization: Bearer <token>`` and expose the user as ``g.api_user``."""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        header = request.headers.get('Authorization', '')
+        scheme, _, token = header.partition(' ')
+        if scheme.lower() != 'bearer' or not token.strip():
+            return jsonify({'error': 'Missing bearer token'}), 401
+
+        api_token = ApiToken.query.filter_by(token_hash=hash_token(token.strip())).first()
+        if not api_token:
+            return jsonify({'error': 'Invalid token'}), 401
+
+        now = datetime.utcnow()
+        if not api_token.last_used_at or now - api_token.last_used_at > LAST_USED_RESOLUTION:
+            api_token.last_used_at = now
+            db.session.commit()
+
+        g.api_user = user_cache.load(api_token.user_id)
+        return view(*args, **kwargs)
+    return wrapper
@@ -1,25 +1,44 @@
-from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, session, send_file
+from flask import Flask, render_template, request, redirect, url_for, flash, jsonify, send_file, g, Response, abort, stream_with_context
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
-from auth import db, User, Analysis
-from predict import predict_image, analyze_image_quality, get_storage_tips
-from camera import capture_image, check_camera_availability
-from pdf_generator import generate_pdf_report
-from email_sender import send_email_report, generate_email_body
+from auth import db, User, Analysis, AnalysisBatch, init_database
+from predict import get_storage_tips, ANALYSIS_MAX_DIMENSION
+from pipeline import allowed_file, analyze_saved_image, process_batch, MAX_BATCH_IMAGES, UPLOAD_PATH
+from api_auth import create_api_token, token_required
+from similarity import similar_analyses
+import archive
+import offload
+import storage
+import user_cache
+import fragments
 import os
-from datetime import datetime, timedelta
-from werkzeug.utils import secure_filename
+from datetime import datetime, timedelta, timezone
+from werkzeug.datastructures import FileStorage
+import base64
+import binascii
+import hashlib
+import io
+import click
 import uuid
 import json
+import time
+import metrics
+from profiling import init_profiling
+from db_profiles import init_db_profile
+from retention import init_retention
+from admission import admission_limited
 
 app = Flask(__name__)
 app.secret_key = os.environ.get('SECRET_KEY', 'food_freshness_secret_key_2024')
 app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get('DATABASE_URL', 'sqlite:///users.db')
 app.config["SQLALCHEMY_TRACK_MODIFICATIONS"] = False
 app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024
+# Browsers downscale uploads to this size before sending unless the user keeps originals
+app.config['UPLOAD_MAX_DIMENSION'] = int(os.environ.get('UPLOAD_MAX_DIMENSION', ANALYSIS_MAX_DIMENSION))
+app.config['UPLOAD_JPEG_QUALITY'] = float(os.environ.get('UPLOAD_JPEG_QUALITY', '0.85'))
+# Per-route overrides, e.g. {"predict": {"max_concurrent": 4, "max_per_user": 1}}
+app.config['ADMISSION_LIMITS'] = json.loads(os.environ.get('ADMISSION_LIMITS', '{}'))
 
-ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'webp'}
-
-db.init_app(app)
+init_db_profile(app, db)
 
 login_manager = LoginManager()
 login_manager.init_app(app)
@@ -27,16 +46,32 @@ login_manager.login_view = 'login'
 login_manager.login_message = 'Please login to access this page.'
 login_manager.login_message_category = 'info'
 
+init_profiling(app)
+init_retention(app)
+
 @login_manager.user_loader
 def load_user(user_id):
-    return User.query.get(int(user_id))
+    return user_cache.load(user_id)
+
+@app.before_request
+def start_request_timer():
+    g.request_started = time.perf_counter()
 
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+@app.after_request
+def record_request_metrics(response):
+    started = g.pop('request_started', None)
+    if started is not None:
+        endpoint = request.endpoint or 'unmatched'
+        metrics.observe("http_request_duration_seconds", time.perf_counter() - started, endpoint=endpoint)
+        metrics.inc("http_requests_total", endpoint=endpoint, status=response.status_code)
+    return response
 
-def generate_unique_filename(filename):
-    name, ext = os.path.splitext(secure_filename(filename))
-    return f"{name}_{uuid.uuid4().hex[:8]}{ext}"
+@app.route("/metrics")
+def metrics_endpoint():
+    token = os.environ.get('METRICS_TOKEN')
+    if token and request.headers.get('Authorization') != f"Bearer {token}":
+        abort(401)
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
 
 @app.route("/")
 def landing():
@@ -88,12 +123,19 @@ def register():
 @app.route("/dashboard")
 @login_required
 def dashboard():
+    from camera import check_camera_availability
     camera_available = check_camera_availability()
-    recent_analyses = Analysis.query.filter_by(user_id=current_user.id).order_by(Analysis.timestamp.desc()).limit(5).all()
-    return render_template("dashboard.html", camera_available=camera_available, recent_analyses=recent_analyses)
+    recent_analyses_html = fragments.cached_html("recent_analyses", lambda: render_template(
+        "partials/recent_analyses.html",
+        recent_analyses=recent_analyses(current_user.id, 5)
+    ), user_id=current_user.id)
+    return render_template("dashboard.html", camera_available=camera_available, recent_analyses_html=recent_analyses_html,
+                           upload_max_dimension=app.config['UPLOAD_MAX_DIMENSION'],
+                           upload_jpeg_quality=app.config['UPLOAD_JPEG_QUALITY'])
 
 @app.route("/predict", methods=["POST"])
 @login_required
+@admission_limited
 def predict():
     try:
         files = request.files.getlist('images')
@@ -102,95 +144,100 @@ def predict():
             flash("No image file selected.", "error")
             return redirect("/dashboard")
         
-        results = []
-        upload_path = os.path.join("static", "uploads")
-        os.makedirs(upload_path, exist_ok=True)
-        
-        for file in files[:10]:
-            if file and allowed_file(file.filename):
-                filename = generate_unique_filename(file.filename)
-                filepath = os.path.join(upload_path, filename)
-                file.save(filepath)
-                
-                label, confidence, food_type = predict_image(filepath)
-                quality_metrics = analyze_image_quality(filepath)
-                
-                analysis = Analysis(
-                    user_id=current_user.id,
-                    image_filename=filename,
-                    label=label,
-                    confidence=confidence,
-                    food_type=food_type,
-                    quality_score=quality_metrics.get('blur_score', 0),
-                    resolution=quality_metrics.get('resolution', 'Unknown'),
-                    blur_score=quality_metrics.get('blur_score', 0)
-                )
-                db.session.add(analysis)
-                
-                results.append({
-                    'id': None,
-                    'filename': filename,
-                    'label': label,
-                    'confidence': confidence,
-                    'food_type': food_type,
-                    'quality': quality_metrics
-                })
-        
-        db.session.commit()
-        
-        for i, result in enumerate(results):
-            result['id'] = Analysis.query.filter_by(
-                user_id=current_user.id,
-                image_filename=result['filename']
-            ).first().id
+        batch, results, rejected = process_batch(current_user.id, files, prescaled=request.form.get('prescaled') == '1')
+        for item in rejected:
+            flash(f"Skipped {item['filename']}: {item['error']}", "error")
+        if not results:
+            if not rejected:
+                flash("No valid image files uploaded.", "error")
+            return redirect("/dashboard")
         
-        session['batch_results'] = results
-        return redirect("/batch-results")
+        return redirect(f"/batch-results/{batch.id}")
         
     except Exception as e:
         print(f"Prediction error: {str(e)}")
+        metrics.record_error("app.predict")
         flash(f"Error processing images: {str(e)}", "error")
         return redirect("/dashboard")
 
 @app.route("/batch-results")
 @login_required
-def batch_results():
-    results = session.get('batch_results', [])
-    if not results:
+def latest_batch_results():
+    batch = AnalysisBatch.query.filter_by(user_id=current_user.id).order_by(AnalysisBatch.created_at.desc()).first()
+    if not batch:
         flash("No results found.", "error")
         return redirect("/dashboard")
+    return redirect(f"/batch-results/{batch.id}")
+
+@app.route("/batch-results/<batch_id>")
+@login_required
+def batch_results(batch_id):
+    batch = AnalysisBatch.query.get(batch_id)
+    if not batch or batch.user_id != current_user.id:
+        flash("No results found.", "error")
+        return redirect("/dashboard")
+    results = json.loads(batch.results)
+    # Images may have moved into shards or been purged since the batch was stored
+    current = {row.id: row for row in db.session.execute(archive.select_analyses(
+        lambda table: db.select(table.c.id, table.c.image_filename, table.c.image_purged_at)
+        .where(table.c.id.in_([item['id'] for item in results]))))}
+    for item in results:
+        row = current.get(item['id'])
+        item['image_purged'] = row is None or row.image_purged_at is not None
+        if row is not None:
+            item['filename'] = row.image_filename
     return render_template("batch_results.html", results=results)
 
 @app.route("/result/<int:analysis_id>")
 @login_required
 def result(analysis_id):
-    analysis = Analysis.query.get_or_404(analysis_id)
+    analysis = archive.get_or_404(analysis_id)
     
     if analysis.user_id != current_user.id:
         flash("Unauthorized access.", "error")
         return redirect("/dashboard")
     
-    storage_tips = get_storage_tips(analysis.food_type)
-    
     return render_template("result.html",
                          analysis=analysis,
-                         storage_tips=storage_tips)
+                         storage_tips=get_storage_tips(analysis.food_type))
 
 @app.route("/analytics")
 @login_required
 def analytics():
-    analyses = Analysis.query.filter_by(user_id=current_user.id).all()
+    # The 30-day window moves daily, so the date is part of the key
+    stats = fragments.cached("analytics", lambda: analytics_stats(current_user.id), user_id=current_user.id,
+                             extra=datetime.now().strftime('%Y-%m-%d'))
+    
+    return render_template("analytics.html",
+                         total=stats['total'],
+                         fresh=stats['fresh'],
+                         okay=stats['okay'],
+                         avoid=stats['avoid'],
+                         daily_stats=json.dumps(stats['daily_stats']),
+                         food_type_stats=json.dumps(stats['food_type_stats']))
+
+def analytics_stats(user_id):
+    # All-time counts: grouped in the database for live rows, kept up to date for archived ones
+    live = db.session.execute(
+        db.select(Analysis.label, Analysis.food_type, db.func.count())
+        .where(Analysis.user_id == user_id).group_by(Analysis.label, Analysis.food_type)).all()
+    label_counts = {}
+    food_type_stats = {}
+    for label, food_type, count in live + archive.archived_counts(user_id):
+        label_counts[label] = label_counts.get(label, 0) + count
+        food_type = food_type or 'unknown'
+        food_type_stats[food_type] = food_type_stats.get(food_type, 0) + count
     
-    total = len(analyses)
-    fresh = len([a for a in analyses if a.label == 'Fresh'])
-    okay = len([a for a in analyses if a.label == 'Okay'])
-    avoid = len([a for a in analyses if a.label == 'Avoid'])
+    total = sum(label_counts.values())
+    fresh = label_counts.get('Fresh', 0)
+    okay = label_counts.get('Okay', 0)
+    avoid = label_counts.get('Avoid', 0)
     
     last_30_days = datetime.now() - timedelta(days=30)
-    recent = Analysis.query.filter(
-        Analysis.user_id == current_user.id,
-        Analysis.timestamp >= last_30_days
-    ).all()
+    recent = db.session.execute(archive.select_analyses(
+        lambda table: db.select(table.c.timestamp, table.c.label).where(
+            table.c.user_id == user_id, table.c.timestamp >= last_30_days),
+        since=last_30_days))
     
     daily_stats = {}
     for analysis in recent:
@@ -199,47 +246,48 @@ def analytics():
             daily_stats[date_key] = {'Fresh': 0, 'Okay': 0, 'Avoid': 0}
         daily_stats[date_key][analysis.label] += 1
     
-    food_type_stats = {}
-    for analysis in analyses:
-        food_type = analysis.food_type or 'unknown'
-        if food_type not in food_type_stats:
-            food_type_stats[food_type] = 0
-        food_type_stats[food_type] += 1
-    
-    return render_template("analytics.html",
-                         total=total,
-                         fresh=fresh,
-                         okay=okay,
-                         avoid=avoid,
-                         daily_stats=json.dumps(daily_stats),
-                         food_type_stats=json.dumps(food_type_stats))
+    return {'total': total, 'fresh': fresh, 'okay': okay, 'avoid': avoid,
+            'daily_stats': daily_stats, 'food_type_stats': food_type_stats}
+
+def recent_analyses(user_id, limit):
+    """The user's ``limit`` newest analyses, newest first, reaching into the archive if needed."""
+    return archive.newest(lambda table: db.select(*archive.columns(table)).where(table.c.user_id == user_id), limit)
+
+def analysis_count(user_id):
+    live = db.session.execute(db.select(db.func.count(Analysis.id)).where(Analysis.user_id == user_id)).scalar()
+    return live + sum(count for _, _, count in archive.archived_counts(user_id))
 
 @app.route("/profile")
 @login_required
 def profile():
-    total_analyses = Analysis.query.filter_by(user_id=current_user.id).count()
+    total_analyses = analysis_count(current_user.id)
     return render_template("profile.html", total_analyses=total_analyses)
 
 @app.route("/update-profile", methods=["POST"])
 @login_required
 def update_profile():
     try:
+        # current_user is a cached snapshot; changes go through the real row
+        user = db.session.get(User, current_user.id)
         email = request.form.get("email")
         if email:
-            current_user.email = email
+            user.email = email
         
         if 'profile_picture' in request.files:
             file = request.files['profile_picture']
             if file and allowed_file(file.filename):
-                filename = f"profile_{current_user.id}_{uuid.uuid4().hex[:8]}.{file.filename.rsplit('.', 1)[1]}"
+                filename = f"profile_{user.id}_{uuid.uuid4().hex[:8]}.{file.filename.rsplit('.', 1)[1]}"
                 filepath = os.path.join("static", "profiles", filename)
                 os.makedirs(os.path.dirname(filepath), exist_ok=True)
                 file.save(filepath)
-                current_user.profile_picture = filename
+                user.profile_picture = filename
         
         db.session.commit()
+        user_cache.invalidate(user.id)
         flash("Profile updated successfully!", "success")
     except Exception as e:
+        db.session.rollback()
+        metrics.record_error("app.update_profile")
         flash(f"Error updating profile: {str(e)}", "error")
     
     return redirect("/profile")
@@ -247,7 +295,7 @@ def update_profile():
 @app.route("/download-pdf/<int:analysis_id>")
 @login_required
 def download_pdf(analysis_id):
-    analysis = Analysis.query.get_or_404(analysis_id)
+    analysis = archive.get_or_404(analysis_id)
     
     if analysis.user_id != current_user.id:
         flash("Unauthorized access.", "error")
@@ -266,14 +314,15 @@ def download_pdf(analysis_id):
             'resolution': analysis.resolution,
             'blur_score': analysis.blur_score
         },
-        'image_path': os.path.join('static', 'uploads', analysis.image_filename),
+        'image_path': storage.upload_path(analysis.image_filename),
         'storage_tips': storage_tips
     }
     
-    pdf_path = os.path.join('static', 'reports', f'report_{analysis.id}.pdf')
-    os.makedirs(os.path.dirname(pdf_path), exist_ok=True)
+    pdf_path = storage.report_path(analysis.id)
     
-    if generate_pdf_report(analysis_data, pdf_path):
+    # ReportLab and qrcode are slow to import; load them on first report
+    from pdf_generator import generate_pdf_report
+    if offload.run_pdf(generate_pdf_report, analysis_data, pdf_path):
         return send_file(pdf_path, as_attachment=True, download_name=f'analysis_report_{analysis.id}.pdf')
     else:
         flash("Error generating PDF report.", "error")
@@ -282,7 +331,7 @@ def download_pdf(analysis_id):
 @app.route("/email-report/<int:analysis_id>", methods=["POST"])
 @login_required
 def email_report(analysis_id):
-    analysis = Analysis.query.get_or_404(analysis_id)
+    analysis = archive.get_or_404(analysis_id)
     
     if analysis.user_id != current_user.id:
         return jsonify({'success': False, 'error': 'Unauthorized'}), 403
@@ -304,13 +353,14 @@ def email_report(analysis_id):
             'quality': 'Good' if analysis.blur_score > 100 else 'Fair',
             'resolution': analysis.resolution
         },
-        'image_path': os.path.join('static', 'uploads', analysis.image_filename),
+        'image_path': storage.upload_path(analysis.image_filename),
         'storage_tips': storage_tips
     }
     
-    pdf_path = os.path.join('static', 'reports', f'report_{analysis.id}.pdf')
-    os.makedirs(os.path.dirname(pdf_path), exist_ok=True)
-    generate_pdf_report(analysis_data, pdf_path)
+    pdf_path = storage.report_path(analysis.id)
+    from pdf_generator import generate_pdf_report
+    from email_sender import send_email_report, generate_email_body
+    offload.run_pdf(generate_pdf_report, analysis_data, pdf_path)
     
     subject = f"Food Freshness Analysis Report - {analysis.label}"
     body = generate_email_body(analysis_data)
@@ -320,60 +370,271 @@ def email_report(analysis_id):
     else:
         return jsonify({'success': False, 'error': 'Failed to send email'}), 500
 
+HISTORY_DEFAULT_LIMIT = 20
+HISTORY_MAX_LIMIT = 100
+
+def encode_history_cursor(analysis):
+    raw = f"{analysis.timestamp.isoformat()}|{analysis.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+def decode_history_cursor(cursor):
+    padded = cursor + '=' * (-len(cursor) % 4)
+    timestamp, _, analysis_id = base64.urlsafe_b64decode(padded.encode()).decode().partition('|')
+    return datetime.fromisoformat(timestamp), int(analysis_id)
+
 @app.route("/api/history")
 @login_required
 def api_history():
-    analyses = Analysis.query.filter_by(user_id=current_user.id).order_by(Analysis.timestamp.desc()).limit(20).all()
+    """Keyset-paginated analysis history, newest first.
+
+    Query parameters: ``limit``, ``cursor`` (from the ``X-Next-Cursor``
+    header of the previous page), ``label``, ``food_type``, ``since`` and
+    ``until`` (ISO dates or datetimes, ``until`` inclusive for plain dates).
+    Responses carry an ETag and Last-Modified derived from the user's data
+    version, so unchanged polls get ``304 Not Modified``.
+    """
+    try:
+        limit = min(max(int(request.args.get('limit', HISTORY_DEFAULT_LIMIT)), 1), HISTORY_MAX_LIMIT)
+        cursor = request.args.get('cursor')
+        after = decode_history_cursor(cursor) if cursor else None
+        since = datetime.fromisoformat(request.args['since']) if request.args.get('since') else None
+        until = datetime.fromisoformat(request.args['until']) if request.args.get('until') else None
+    except (ValueError, UnicodeDecodeError, binascii.Error):
+        return jsonify({'error': 'Invalid limit, cursor or date parameter'}), 400
+    
+    # Bumped by uploads, archiving, purges and rescoring (see fragments.py)
+    version, last_modified = fragments.data_version(current_user.id)
+    etag = hashlib.sha1(
+        f"{current_user.id}:{version}:{request.query_string.decode()}".encode()
+    ).hexdigest()
+    
+    if request.if_none_match.contains(etag) or (
+            not request.if_none_match and last_modified and request.if_modified_since
+            and last_modified.replace(microsecond=0, tzinfo=timezone.utc) <= request.if_modified_since):
+        response = Response(status=304)
+    else:
+        def build(table):
+            query = db.select(table.c.id, table.c.label, table.c.confidence, table.c.food_type, table.c.timestamp)
+            query = query.where(table.c.user_id == current_user.id)
+            if request.args.get('label'):
+                query = query.where(table.c.label == request.args['label'])
+            if request.args.get('food_type'):
+                query = query.where(table.c.food_type == request.args['food_type'])
+            if since:
+                query = query.where(table.c.timestamp >= since)
+            if until:
+                if len(request.args['until']) == 10:
+                    # A plain date includes the whole day
+                    query = query.where(table.c.timestamp < until + timedelta(days=1))
+                else:
+                    query = query.where(table.c.timestamp <= until)
+            if after:
+                after_timestamp, after_id = after
+                query = query.where(db.or_(
+                    table.c.timestamp < after_timestamp,
+                    db.and_(table.c.timestamp == after_timestamp, table.c.id < after_id)
+                ))
+            return query
+        
+        rows = archive.newest(build, limit + 1, since)
+        page = rows[:limit]
+        response = jsonify([{
+            'id': a.id,
+            'label': a.label,
+            'confidence': round(a.confidence, 2),
+            'food_type': a.food_type,
+            'timestamp': a.timestamp.strftime('%Y-%m-%d %H:%M')
+        } for a in page])
+        
+        if len(rows) > limit:
+            next_cursor = encode_history_cursor(page[-1])
+            args = request.args.to_dict()
+            args['cursor'] = next_cursor
+            response.headers['X-Next-Cursor'] = next_cursor
+            response.headers['Link'] = f'<{url_for("api_history", **args)}>; rel="next"'
+    
+    response.set_etag(etag)
+    if last_modified:
+        response.last_modified = last_modified.replace(tzinfo=timezone.utc)
+    response.headers['Cache-Control'] = 'private, no-cache'
+    return response
+
+SIMILAR_DEFAULT_K = 5
+SIMILAR_MAX_K = 20
+
+@app.route("/api/analyses/<int:analysis_id>/similar")
+@login_required
+def api_similar_analyses(analysis_id):
+    """The user's earlier analyses whose colour/spoilage profile is closest to this one."""
+    analysis = archive.get_analysis(analysis_id)
+    if analysis is None or analysis.user_id != current_user.id:
+        return jsonify({'error': 'Analysis not found'}), 404
+    try:
+        k = min(max(int(request.args.get('k', SIMILAR_DEFAULT_K)), 1), SIMILAR_MAX_K)
+    except ValueError:
+        return jsonify({'error': 'Invalid k'}), 400
+    
     return jsonify([{
         'id': a.id,
         'label': a.label,
         'confidence': round(a.confidence, 2),
         'food_type': a.food_type,
-        'timestamp': a.timestamp.strftime('%Y-%m-%d %H:%M')
-    } for a in analyses])
+        'timestamp': a.timestamp.strftime('%Y-%m-%d %H:%M'),
+        'image_url': None if a.image_purged_at else url_for('static', filename='uploads/' + a.image_filename),
+        'similarity': round(score, 4)
+    } for a, score in similar_analyses(analysis, k)])
+
+@app.route("/api/v1/tokens", methods=["POST"])
+@login_required
+def api_create_token():
+    token = create_api_token(current_user, request.form.get('name') or (request.get_json(silent=True) or {}).get('name'))
+    return jsonify({'token': token}), 201
+
+def decode_base64_images(items):
+    """Turn ``[{"filename": ..., "data": <base64 or data URL>}]`` into FileStorage objects."""
+    files = []
+    for index, item in enumerate(items):
+        if not isinstance(item, dict) or not item.get('data') or not isinstance(item['data'], str):
+            raise ValueError(f"images[{index}] must be an object with a 'data' string")
+        data = item['data']
+        if data.startswith('data:'):
+            data = data.split(',', 1)[-1]
+        try:
+            raw = base64.b64decode(data, validate=True)
+        except (binascii.Error, ValueError):
+            raise ValueError(f"images[{index}] is not valid base64")
+        filename = item.get('filename') or f"image_{index}.jpg"
+        if not isinstance(filename, str):
+            raise ValueError(f"images[{index}].filename must be a string")
+        files.append(FileStorage(stream=io.BytesIO(raw), filename=filename))
+    return files
+
+@app.route("/api/v1/upload-config")
+def api_upload_config():
+    return jsonify({
+        'max_dimension': app.config['UPLOAD_MAX_DIMENSION'],
+        'jpeg_quality': app.config['UPLOAD_JPEG_QUALITY'],
+        'max_images': MAX_BATCH_IMAGES,
+        'max_content_length': app.config['MAX_CONTENT_LENGTH']
+    })
+
+@app.route("/api/v1/predict", methods=["POST"])
+@token_required
+@admission_limited
+def api_predict():
+    if request.is_json:
+        payload = request.get_json(silent=True) or {}
+        items = payload.get('images') if isinstance(payload, dict) else None
+        if not isinstance(items, list) or not items:
+            return jsonify({'error': "Expected a non-empty 'images' list"}), 400
+        try:
+            files = decode_base64_images(items)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+    else:
+        files = request.files.getlist('images')
+    
+    if not files:
+        return jsonify({'error': 'No images provided'}), 400
+    if len(files) > MAX_BATCH_IMAGES:
+        return jsonify({'error': f'At most {MAX_BATCH_IMAGES} images per request'}), 400
+    
+    try:
+        batch, results, rejected = process_batch(g.api_user.id, files)
+    except Exception as e:
+        print(f"API prediction error: {str(e)}")
+        metrics.record_error("app.api_predict")
+        db.session.rollback()
+        return jsonify({'error': 'Prediction failed'}), 500
+    
+    if not results:
+        return jsonify({'error': 'No valid image files uploaded', 'rejected': rejected}), 400
+    
+    return jsonify({
+        'batch_id': batch.id,
+        'rejected': rejected,
+        'results': [dict(result,
+                         image_url=url_for('static', filename='uploads/' + result['filename']),
+                         heatmap_url=url_for('static', filename='uploads/' + result['heatmap_filename'])
+                         if result['heatmap_filename'] else None,
+                         storage_tips=get_storage_tips(result['food_type']))
+                    for result in results]
+    })
+
+# Usernames whose API tokens may export every user's analyses with ?scope=all
+EXPORT_ADMIN_USERS = {name.strip() for name in os.environ.get('EXPORT_ADMIN_USERS', '').split(',') if name.strip()}
+
+@app.route("/api/v1/export")
+@token_required
+def api_export():
+    """Stream analysis history as ``csv.gz``, ``parquet`` or ``arrow``.
+
+    Query parameters: ``format``, ``since`` (the ``X-Export-Watermark`` of the
+    previous export, or an ISO timestamp), ``features=1`` for the colour
+    feature columns and ``scope=all`` for every user's rows (EXPORT_ADMIN_USERS
+    only). ``204`` means nothing new since the watermark.
+    """
+    from export import CONTENT_TYPES, ExportError, decode_watermark, encode_watermark, end_watermark, stream_export
+    
+    fmt = request.args.get('format', 'csv.gz')
+    try:
+        since = decode_watermark(request.args['since']) if request.args.get('since') else None
+    except ValueError:
+        return jsonify({'error': 'Invalid since watermark'}), 400
+    user_id = g.api_user.id
+    if request.args.get('scope') == 'all':
+        if g.api_user.username not in EXPORT_ADMIN_USERS:
+            return jsonify({'error': 'Not allowed to export all users'}), 403
+        user_id = None
+    
+    until = end_watermark(since, user_id)
+    if until is None:
+        response = Response(status=204)
+        if since:
+            response.headers['X-Export-Watermark'] = encode_watermark(*since)
+        return response
+    try:
+        chunks = stream_export(fmt, since, until, user_id, features=request.args.get('features') == '1')
+    except ExportError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    metrics.inc("food_exports_total", format=fmt)
+    response = Response(stream_with_context(chunks), mimetype=CONTENT_TYPES[fmt])
+    response.headers['Content-Disposition'] = f'attachment; filename=analyses_{until[0].strftime("%Y%m%dT%H%M%S")}.{fmt}'
+    response.headers['X-Export-Watermark'] = encode_watermark(*until)
+    return response
 
 @app.route("/capture-camera", methods=["POST"])
 @login_required
+@admission_limited
 def capture_camera():
     try:
         # Check if image is from browser camera
         if 'camera_image' in request.files:
             file = request.files['camera_image']
             if file:
-                upload_path = os.path.join("static", "uploads")
-                os.makedirs(upload_path, exist_ok=True)
-                
                 timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-                filename = f"camera_{timestamp}.jpg"
-                filepath = os.path.join(upload_path, filename)
-                file.save(filepath)
+                filepath, filename = storage.new_upload(f"camera_{timestamp}_{uuid.uuid4().hex[:8]}.jpg")
+                with metrics.stage("upload.save"):
+                    file.save(filepath)
         else:
             # Fallback to OpenCV camera capture
             from camera import capture_image
-            upload_path = os.path.join("static", "uploads")
-            os.makedirs(upload_path, exist_ok=True)
-            filepath, filename = capture_image(upload_path)
+            os.makedirs(UPLOAD_PATH, exist_ok=True)
+            with metrics.stage("camera.capture"):
+                captured_path, captured_name = capture_image(UPLOAD_PATH)
+            filepath, filename = storage.new_upload(captured_name)
+            os.replace(captured_path, filepath)
         
-        label, confidence, food_type = predict_image(filepath)
-        quality_metrics = analyze_image_quality(filepath)
-        
-        analysis = Analysis(
-            user_id=current_user.id,
-            image_filename=filename,
-            label=label,
-            confidence=confidence,
-            food_type=food_type,
-            quality_score=quality_metrics.get('blur_score', 0),
-            resolution=quality_metrics.get('resolution', 'Unknown'),
-            blur_score=quality_metrics.get('blur_score', 0)
-        )
-        db.session.add(analysis)
-        db.session.commit()
+        analysis, _ = analyze_saved_image(current_user.id, filepath, filename)
+        with metrics.stage("db.commit"):
+            db.session.commit()
         
         return redirect(f"/result/{analysis.id}")
         
     except Exception as e:
         print(f"Camera capture error: {str(e)}")
+        metrics.record_error("app.capture_camera")
         flash(f"Camera error: {str(e)}", "error")
         return redirect("/dashboard")
 
@@ -383,15 +644,152 @@ def logout():
     logout_user()
     return redirect("/")
 
-# Initialize database
-with app.app_context():
-    db.create_all()
+@app.cli.command("create-api-token")
+@click.argument("username")
+@click.option("--name", default=None, help="Label to identify the token later.")
+def create_api_token_command(username, name):
+    """Create a JSON API token for USERNAME and print it once."""
+    user = User.query.filter_by(username=username).first()
+    if not user:
+        raise click.ClickException(f"No such user: {username}")
+    click.echo(create_api_token(user, name))
+
+@app.cli.command("rescore")
+@click.option("--thresholds", "thresholds_path", type=click.Path(exists=True, dir_okay=False), default=None,
+              help="JSON cutoffs to merge over predict.DEFAULT_THRESHOLDS.")
+@click.option("--scorer", default=None, help="Alternative scoring function as module:function.")
+@click.option("--user", "username", default=None, help="Only re-score this user's history.")
+@click.option("--apply", is_flag=True, help="Write changed labels back (default is a dry run).")
+@click.option("--backfill", is_flag=True, help="First store features for analyses saved without them.")
+def rescore_command(thresholds_path, scorer, username, apply, backfill):
+    """Re-label stored analyses from their feature vectors without decoding images."""
+    from predict import load_thresholds
+    from rescore import backfill_features, load_scorer, rescore_analyses
     
-    if not User.query.filter_by(username="admin").first():
-        admin = User(username="admin", email="admin@example.com", password="password")
-        db.session.add(admin)
-        db.session.commit()
+    user_id = None
+    if username:
+        user = User.query.filter_by(username=username).first()
+        if not user:
+            raise click.ClickException(f"No such user: {username}")
+        user_id = user.id
+    if backfill:
+        filled, missing = backfill_features()
+        click.echo(f"Backfilled features for {filled} analyses ({missing} images missing)")
+    
+    summary = rescore_analyses(
+        thresholds=load_thresholds(thresholds_path) if thresholds_path else None,
+        scorer=load_scorer(scorer) if scorer else None,
+        user_id=user_id,
+        apply=apply
+    )
+    click.echo(f"{summary['rows']} analyses scored, {summary['changed']} would change"
+               if not apply else f"{summary['rows']} analyses scored, {summary['changed']} updated")
+    for transition, count in summary['transitions'].items():
+        click.echo(f"  {transition}: {count}")
+    click.echo(f"load {summary['load_seconds']:.2f}s, score {summary['score_seconds']:.2f}s, "
+               f"write {summary['write_seconds']:.2f}s")
+
+@app.cli.command("send-digests")
+@click.option("--days", default=1, show_default=True, help="Whole UTC days before today to cover.")
+@click.option("--user", "username", default=None, help="Only send this user's digest.")
+@click.option("--attach-pdf", is_flag=True, help="Attach one PDF listing every item in the period.")
+@click.option("--dry-run", is_flag=True, help="Build the digests without sending them.")
+@click.option("--smtp-server", default=None, help="Override SMTP_SERVER, e.g. a local stand-in.")
+@click.option("--smtp-port", type=int, default=None, help="Override SMTP_PORT.")
+def send_digests_command(days, username, attach_pdf, dry_run, smtp_server, smtp_port):
+    """Email each user one summary of their analyses over the last DAYS days."""
+    from digest import send_digests
+    
+    user_id = None
+    if username:
+        user = User.query.filter_by(username=username).first()
+        if not user:
+            raise click.ClickException(f"No such user: {username}")
+        user_id = user.id
+    summary = send_digests(days=days, attach_pdf=attach_pdf, user_id=user_id, dry_run=dry_run,
+                           smtp_server=smtp_server, smtp_port=smtp_port)
+    click.echo(f"{summary['users']} digests covering {summary['analyses']} analyses: "
+               f"{summary['sent']} sent, {summary['failed']} failed over {summary['connections']} connection(s)")
+    click.echo(f"query {summary['query_seconds']:.2f}s, render {summary['render_seconds']:.2f}s, "
+               f"send {summary['send_seconds']:.2f}s, total {summary['seconds']:.2f}s "
+               f"({summary['messages_per_second']:.1f} messages/s, {summary['attachment_bytes'] / 1024:.0f} KB attached)")
+
+@app.cli.command("export")
+@click.argument("path", type=click.Path(dir_okay=False, writable=True))
+@click.option("--format", "fmt", type=click.Choice(['csv.gz', 'parquet', 'arrow']), default='csv.gz', show_default=True)
+@click.option("--since", default=None, help="Watermark printed by the previous export, or an ISO timestamp.")
+@click.option("--user", "username", default=None, help="Only export this user's analyses.")
+@click.option("--features", is_flag=True, help="Add the colour feature columns used for scoring.")
+@click.option("--chunk-size", type=int, default=None, help="Rows fetched and encoded per chunk.")
+def export_command(path, fmt, since, username, features, chunk_size):
+    """Stream analysis history to PATH and print the watermark for the next incremental run."""
+    from export import EXPORT_CHUNK_SIZE, ExportError, decode_watermark, encode_watermark, export_to_file
+    
+    user_id = None
+    if username:
+        user = User.query.filter_by(username=username).first()
+        if not user:
+            raise click.ClickException(f"No such user: {username}")
+        user_id = user.id
+    started = time.perf_counter()
+    try:
+        written, until = export_to_file(path, fmt, since=decode_watermark(since) if since else None, user_id=user_id,
+                                        features=features, chunk_size=chunk_size or EXPORT_CHUNK_SIZE)
+    except (ExportError, ValueError) as e:
+        raise click.ClickException(str(e))
+    if until is None:
+        click.echo("Nothing new to export")
+        return
+    elapsed = time.perf_counter() - started
+    click.echo(f"Wrote {written / (1024 * 1024):.1f} MB to {path} in {elapsed:.1f}s")
+    click.echo(f"Next run: --since '{encode_watermark(*until)}'")
+
+@app.cli.command("init-db")
+def init_db_command():
+    """Create or upgrade the schema and seed the admin user."""
+    created = init_database()
+    click.echo("Database ready" + (" (admin user created)" if created else ""))
+
+@app.cli.command("sweep")
+@click.option("--dry-run", is_flag=True, help="Report what would be deleted without deleting it.")
+@click.option("--only", "artifacts", multiple=True,
+              type=click.Choice(['originals', 'renditions', 'reports', 'orphans', 'batches', 'archive']),
+              help="Limit the sweep to these artifact types (repeatable).")
+def sweep_command(dry_run, artifacts):
+    """Delete uploads, heatmaps, reports and batch results past their retention period and archive old analyses."""
+    from retention import ARTIFACTS, run_sweep
+    
+    summary = run_sweep(artifacts=artifacts or ARTIFACTS, dry_run=dry_run)
+    if summary is None:
+        raise click.ClickException("Another sweep is running")
+    verb = "would delete" if dry_run else "deleted"
+    for artifact in artifacts or ARTIFACTS:
+        if artifact == 'archive':
+            click.echo(f"archive: {'would move' if dry_run else 'moved'} {summary[artifact]['rows']} analyses")
+            continue
+        if artifact == 'batches':
+            click.echo(f"batches: {verb} {summary[artifact]['rows']} batch results")
+            continue
+        files, reclaimed = summary[artifact]['files'], summary[artifact]['bytes']
+        click.echo(f"{artifact}: {verb} {files} files, {reclaimed / (1024 * 1024):.1f} MB")
+    total = sum(summary[a]['bytes'] for a in artifacts or ARTIFACTS)
+    click.echo(f"{'Would reclaim' if dry_run else 'Reclaimed'} {total / (1024 * 1024):.1f} MB in {summary['seconds']:.1f}s")
+
+@app.cli.command("shard-uploads")
+@click.option("--batch-size", default=500, show_default=True)
+def shard_uploads_command(batch_size):
+    """Move uploads saved before sharding into shard directories."""
+    rows, moved = storage.shard_existing_uploads(batch_size)
+    click.echo(f"Updated {rows} analyses, moved {moved} files")
+
+# Schema changes and seeding run in the release step (`flask init-db`), not on
+# every worker boot. AUTO_INIT_DB=1 restores the old behaviour for local setups.
+if os.environ.get('AUTO_INIT_DB') == '1':
+    with app.app_context():
+        init_database()
 
 if __name__ == "__main__":
+    with app.app_context():
+        init_database()
     port = int(os.environ.get('PORT', 5001))
     app.run(host='0.0.0.0', port=port, debug=True)
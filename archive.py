@@ -0,0 +1,218 @@
+"""Hot/cold split of the analysis history.
+
+Almost every read is about recent analyses: the dashboard's latest five,
+the 30-day analytics window, the first pages of ``/api/history``. The
+``analysis`` table keeps only the last ``ARCHIVE_AFTER_DAYS`` days. Older
+rows move in batches to ``analysis_archive`` (``flask sweep --only archive``
+or the background sweeper), so the indexes those reads walk stay small.
+On PostgreSQL the archive is range-partitioned by month. Partitions are
+created as rows arrive, and an old month can be detached or dropped on its
+own.
+
+Rows move oldest first in ``(timestamp, id)`` order, so the archive always
+holds a prefix of the history. Its newest timestamp, ``horizon()``,
+separates the two tables. ``select_analyses`` builds a query against
+``analysis`` alone when the requested range starts after the horizon, and
+otherwise as a UNION ALL of both tables. Ordered by ``(timestamp, id)``,
+SQLite and PostgreSQL merge the two index scans rather than sorting.
+``newest`` serves newest-first pages from the live table and reads the
+archive only when the page runs past it.
+
+All-time counts per user, label and food type are kept for the archive in
+``analysis_archive_count``, updated with each batch, so the profile and
+analytics totals never scan archived rows.
+
+Near-duplicate detection (phash.py) and similar-item search
+(similarity.py) index the live table only. ``archive_rows`` drops each
+batch from this process' indexes; other workers drop archived rows when a
+lookup returns them, or on their next reload.
+"""
+import os
+from collections import Counter
+from datetime import datetime
+
+from flask import abort
+from sqlalchemy import delete, func, select, text, union_all
+from sqlalchemy.dialects import postgresql, sqlite
+
+import fragments
+import metrics
+import phash
+import similarity
+from auth import db, Analysis, AnalysisArchive, AnalysisArchiveCount
+
+# Days an analysis stays in the live table; 0 never archives
+ARCHIVE_AFTER_DAYS = float(os.environ.get('ARCHIVE_AFTER_DAYS', 0))
+ARCHIVE_BATCH_SIZE = int(os.environ.get('ARCHIVE_BATCH_SIZE', 5000))
+
+HOT = Analysis.__table__
+COLD = AnalysisArchive.__table__
+COUNTS = AnalysisArchiveCount.__table__
+
+# INSERT ... ON CONFLICT DO UPDATE, for adding to the archive counts
+UPSERT = {'postgresql': postgresql.insert, 'sqlite': sqlite.insert}
+
+
+def horizon():
+    """Newest timestamp in the archive, or None while it is empty."""
+    return db.session.execute(select(func.max(COLD.c.timestamp))).scalar()
+
+
+def needs_archive(since=None):
+    """Whether rows at or after ``since`` (None: all time) may be in the archive."""
+    newest = horizon()
+    return newest is not None and (since is None or since <= newest)
+
+
+def tables(since=None):
+    """The tables holding rows at or after ``since``: the live table, then the archive if it reaches back that far."""
+    return (HOT, COLD) if needs_archive(since) else (HOT,)
+
+
+def select_analyses(build, since=None):
+    """``build(table)`` for the live table, UNION ALL the archive when ``since`` reaches it.
+
+    ``build`` returns a ``select`` over the table it is given, and must select
+    the same columns for both. Order or aggregate the result through its
+    ``selected_columns`` (or ``.subquery()``), which work either way.
+    """
+    statement = build(HOT)
+    if needs_archive(since):
+        statement = union_all(statement, build(COLD))
+    return statement
+
+
+def newest(build, limit, since=None):
+    """The first ``limit`` rows of ``build(table)``, newest first.
+
+    The live table is read alone first. Since the archive only holds older
+    rows, it is read (in one UNION ALL with the live table) only when that
+    comes up short.
+    """
+    query = build(HOT)
+    rows = db.session.execute(_newest_first(query).limit(limit)).all()
+    if len(rows) < limit and needs_archive(since):
+        rows = db.session.execute(_newest_first(union_all(query, build(COLD))).limit(limit)).all()
+    return rows
+
+
+def _newest_first(query):
+    return query.order_by(query.selected_columns.timestamp.desc(), query.selected_columns.id.desc())
+
+
+def columns(table):
+    """All of ``table``'s columns in the live table's order, so the two line up in a UNION."""
+    return [table.c[column.name] for column in HOT.columns]
+
+
+def archived_counts(user_id):
+    """``[(label, food_type or None, count), ...]`` over the user's archived analyses."""
+    rows = db.session.execute(select(COUNTS.c.label, COUNTS.c.food_type, COUNTS.c.total)
+                              .where(COUNTS.c.user_id == user_id))
+    return [(label, food_type or None, total) for label, food_type, total in rows]
+
+
+def _add_counts(counts):
+    rows = [{'user_id': user_id, 'label': label, 'food_type': food_type, 'total': total}
+            for (user_id, label, food_type), total in counts.items()]
+    upsert = UPSERT.get(db.engine.dialect.name)
+    if upsert is not None:
+        statement = upsert(COUNTS)
+        db.session.execute(statement.on_conflict_do_update(
+            index_elements=['user_id', 'label', 'food_type'],
+            set_={'total': COUNTS.c.total + statement.excluded.total}), rows)
+        return
+    for row in rows:
+        key = (COUNTS.c.user_id == row['user_id'], COUNTS.c.label == row['label'],
+               COUNTS.c.food_type == row['food_type'])
+        if not db.session.execute(COUNTS.update().where(*key).values(total=COUNTS.c.total + row['total'])).rowcount:
+            db.session.execute(COUNTS.insert(), row)
+
+
+def rebuild_counts():
+    """Recompute ``analysis_archive_count`` from the archive, e.g. after archived labels changed."""
+    food_type = func.coalesce(COLD.c.food_type, '')
+    db.session.execute(delete(COUNTS))
+    db.session.execute(COUNTS.insert().from_select(
+        ['user_id', 'label', 'food_type', 'total'],
+        select(COLD.c.user_id, COLD.c.label, food_type, func.count())
+        .group_by(COLD.c.user_id, COLD.c.label, food_type)))
+    db.session.commit()
+
+
+def get_analysis(analysis_id):
+    """The ``Analysis`` or ``AnalysisArchive`` with this id, or None."""
+    analysis = db.session.get(Analysis, analysis_id)
+    if analysis is None:
+        analysis = AnalysisArchive.query.filter_by(id=analysis_id).first()
+    return analysis
+
+
+def get_or_404(analysis_id):
+    analysis = get_analysis(analysis_id)
+    if analysis is None:
+        abort(404)
+    return analysis
+
+
+def _month(value):
+    return datetime(value.year, value.month, 1)
+
+
+def _next_month(value):
+    return datetime(value.year + value.month // 12, value.month % 12 + 1, 1)
+
+
+def ensure_partitions(first, last):
+    """Create the monthly archive partitions covering ``first``..``last`` (PostgreSQL only)."""
+    if db.engine.dialect.name != 'postgresql':
+        return
+    month = _month(first)
+    while month <= last:
+        following = _next_month(month)
+        db.session.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {COLD.name}_p{month:%Y_%m} PARTITION OF {COLD.name} "
+            f"FOR VALUES FROM ('{month:%Y-%m-%d}') TO ('{following:%Y-%m-%d}')"))
+        month = following
+
+
+def archive_rows(cutoff, batch_size=ARCHIVE_BATCH_SIZE, dry_run=False):
+    """Move analyses older than ``cutoff`` to the archive; returns the number of rows moved.
+
+    Each batch is copied, counted and deleted in one transaction, so readers
+    see every row exactly once.
+    """
+    # SQLite hands out max(id) + 1, so archiving the newest row would let a
+    # new analysis reuse an archived id. The newest row always stays.
+    keep_id = db.session.execute(select(func.max(HOT.c.id))).scalar()
+    if keep_id is None:
+        return 0
+    conditions = [HOT.c.timestamp < cutoff, HOT.c.id < keep_id]
+    if dry_run:
+        moved = db.session.execute(select(func.count()).where(*conditions)).scalar()
+        db.session.rollback()
+        return moved
+
+    names = [column.name for column in COLD.columns]
+    moved = 0
+    while True:
+        batch = db.session.execute(
+            select(HOT.c.timestamp, HOT.c.id, HOT.c.user_id, HOT.c.label, HOT.c.food_type).where(*conditions)
+            .order_by(HOT.c.timestamp, HOT.c.id).limit(batch_size)
+        ).all()
+        if not batch:
+            break
+        ids = [row.id for row in batch]
+        ensure_partitions(batch[0].timestamp, batch[-1].timestamp)
+        db.session.execute(COLD.insert().from_select(names, select(*(HOT.c[name] for name in names))
+                                                     .where(HOT.c.id.in_(ids))))
+        _add_counts(Counter((row.user_id, row.label, row.food_type or '') for row in batch))
+        db.session.execute(delete(HOT).where(HOT.c.id.in_(ids)))
+        # Core statements skip the session hooks that bump the cached pages' versions
+        fragments.bump_users({row.user_id for row in batch})
+        db.session.commit()
+        phash.index.remove(ids)
+        similarity.remove(ids)
+        moved += len(ids)
+        metrics.inc("food_archived_rows_total", len(ids))
+    return moved
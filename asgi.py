@@ -0,0 +1,189 @@
+"""ASGI entry point for the async serving mode (``SERVING_MODE=async``).
+
+    gunicorn asgi:application -k uvicorn_worker.UvicornWorker   # what gunicorn.conf.py runs
+    uvicorn asgi:application --workers 2                        # local
+
+Needs ``pip install uvicorn uvicorn-worker``. The Flask app itself stays
+WSGI, and ``WSGIAdapter`` runs it so that waiting for a client costs no
+thread:
+
+- The request body is received on the event loop, spooled to a temporary
+  file past ``ASGI_SPOOL_SIZE``, and refused with 413 past
+  ``MAX_CONTENT_LENGTH``. A slow upload occupies a socket, not a thread.
+- The view then runs on one of ``ASGI_THREADS`` threads. Views stay
+  synchronous, so database queries and SMTP block their thread, but
+  threads are cheap next to sync worker processes. Image analysis and
+  PDF rendering go through offload.py, which bounds how many run at once.
+- Response chunks are sent from the event loop. Files from ``send_file``
+  (PDF reports, the export) are read off the loop a chunk at a time, and
+  each write is awaited, so a slow download holds no thread either.
+
+Each request's context variables are copied once and reused for every
+call into the app, so streamed responses (``stream_with_context``) keep
+their app context from chunk to chunk.
+"""
+import asyncio
+import contextvars
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from tempfile import SpooledTemporaryFile
+
+import offload
+from app import app
+
+ASGI_THREADS = int(os.environ.get('ASGI_THREADS', 16))
+# Request bodies up to this size stay in memory
+ASGI_SPOOL_SIZE = int(os.environ.get('ASGI_SPOOL_SIZE', 1024 * 1024))
+FILE_CHUNK_SIZE = 64 * 1024
+
+_DONE = object()
+
+
+class FileWrapper:
+    """``wsgi.file_wrapper``: lets the adapter read returned files off the event loop."""
+
+    def __init__(self, file, block_size=FILE_CHUNK_SIZE):
+        self.file = file
+        self.block_size = max(block_size, FILE_CHUNK_SIZE)
+
+    def __iter__(self):
+        while True:
+            data = self.file.read(self.block_size)
+            if not data:
+                return
+            yield data
+
+    def close(self):
+        self.file.close()
+
+
+class WSGIAdapter:
+    def __init__(self, wsgi_app, threads=ASGI_THREADS, max_body=None, spool_size=ASGI_SPOOL_SIZE):
+        self.wsgi_app = wsgi_app
+        self.max_body = max_body
+        self.spool_size = spool_size
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='asgi')
+
+    async def __call__(self, scope, receive, send):
+        if scope['type'] == 'lifespan':
+            await self._lifespan(receive, send)
+        elif scope['type'] == 'http':
+            await self._http(scope, receive, send)
+        else:
+            raise ValueError(f"Unsupported ASGI scope type {scope['type']!r}")
+
+    async def _lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message['type'] == 'lifespan.startup':
+                await send({'type': 'lifespan.startup.complete'})
+            elif message['type'] == 'lifespan.shutdown':
+                self.executor.shutdown(wait=False)
+                offload.shutdown()
+                await send({'type': 'lifespan.shutdown.complete'})
+                return
+
+    async def _http(self, scope, receive, send):
+        with SpooledTemporaryFile(max_size=self.spool_size) as body:
+            received = 0
+            while True:
+                message = await receive()
+                if message['type'] == 'http.disconnect':
+                    return
+                chunk = message.get('body', b'')
+                received += len(chunk)
+                if self.max_body is not None and received > self.max_body:
+                    await _respond(send, 413, b'Request Entity Too Large')
+                    return
+                body.write(chunk)
+                if not message.get('more_body'):
+                    break
+            body.seek(0)
+            await self._run(self._environ(scope, body, received), send)
+
+    async def _run(self, environ, send):
+        loop = asyncio.get_running_loop()
+        context = contextvars.copy_context()
+        started = {}
+
+        def call(func, *args):
+            return loop.run_in_executor(self.executor, context.run, func, *args)
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and started.get('sent'):
+                raise exc_info[1].with_traceback(exc_info[2])
+            started['status'] = int(status.split(' ', 1)[0])
+            started['headers'] = [(name.lower().encode('latin-1'), value.encode('latin-1'))
+                                  for name, value in headers]
+            # The WSGI write() callable; Flask never uses it
+            return lambda data: None
+
+        async def send_body(data, more):
+            if not started.get('sent'):
+                started['sent'] = True
+                await send({'type': 'http.response.start', 'status': started['status'],
+                            'headers': started['headers']})
+            await send({'type': 'http.response.body', 'body': data, 'more_body': more})
+
+        iterable = await call(self.wsgi_app, environ, start_response)
+        try:
+            if isinstance(iterable, FileWrapper):
+                # File reads use the loop's default executor, not a request thread
+                read = iterable.file.read
+                while data := await loop.run_in_executor(None, read, iterable.block_size):
+                    await send_body(data, True)
+            else:
+                iterator = iter(iterable)
+                while (data := await call(next, iterator, _DONE)) is not _DONE:
+                    if data:
+                        await send_body(data, True)
+            await send_body(b'', False)
+        finally:
+            if hasattr(iterable, 'close'):
+                await call(iterable.close)
+
+    def _environ(self, scope, body, length):
+        root_path = scope.get('root_path', '')
+        path = scope['path']
+        if root_path and path.startswith(root_path):
+            path = path[len(root_path):]
+        server = scope.get('server') or ('localhost', 80)
+        environ = {
+            'REQUEST_METHOD': scope['method'],
+            'SCRIPT_NAME': root_path.encode('utf-8').decode('latin-1'),
+            'PATH_INFO': path.encode('utf-8').decode('latin-1'),
+            'QUERY_STRING': scope['query_string'].decode('latin-1'),
+            'SERVER_NAME': server[0],
+            'SERVER_PORT': str(server[1]),
+            'SERVER_PROTOCOL': f"HTTP/{scope['http_version']}",
+            'wsgi.version': (1, 0),
+            'wsgi.url_scheme': scope.get('scheme', 'http'),
+            'wsgi.input': body,
+            'wsgi.errors': sys.stderr,
+            'wsgi.multithread': True,
+            'wsgi.multiprocess': True,
+            'wsgi.run_once': False,
+            'wsgi.file_wrapper': FileWrapper,
+        }
+        if scope.get('client'):
+            environ['REMOTE_ADDR'] = scope['client'][0]
+        for name, value in scope['headers']:
+            name = name.decode('latin-1').upper().replace('-', '_')
+            if name not in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                name = f"HTTP_{name}"
+            value = value.decode('latin-1')
+            environ[name] = f"{environ[name]},{value}" if name in environ else value
+        # The body is buffered and de-chunked, so its length is known even without the header
+        environ.pop('HTTP_TRANSFER_ENCODING', None)
+        environ['CONTENT_LENGTH'] = str(length)
+        return environ
+
+
+async def _respond(send, status, body):
+    await send({'type': 'http.response.start', 'status': status,
+                'headers': [(b'content-type', b'text/plain'), (b'content-length', str(len(body)).encode())]})
+    await send({'type': 'http.response.body', 'body': body})
+
+
+application = WSGIAdapter(app, max_body=app.config.get('MAX_CONTENT_LENGTH'))
@@ -1,6 +1,7 @@
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
 from datetime import datetime
+from sqlalchemy import inspect, text
 
 db = SQLAlchemy()
 
@@ -12,12 +13,16 @@ class User(UserMixin, db.Model):
     profile_picture = db.Column(db.String(200), default='default.png')
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     analyses = db.relationship('Analysis', backref='user', lazy=True, cascade='all, delete-orphan')
+    archived_analyses = db.relationship('AnalysisArchive', backref='user', lazy=True, cascade='all, delete-orphan')
+    archived_counts = db.relationship('AnalysisArchiveCount', lazy=True, cascade='all, delete-orphan')
+    batches = db.relationship('AnalysisBatch', backref='user', lazy=True, cascade='all, delete-orphan')
+    api_tokens = db.relationship('ApiToken', backref='user', lazy=True, cascade='all, delete-orphan')
     
     def __repr__(self):
         return f'<User {self.username}>'
 
-class Analysis(db.Model):
-    id = db.Column(db.Integer, primary_key=True)
+class AnalysisColumns:
+    """Columns shared by the live ``analysis`` table and ``analysis_archive``."""
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     image_filename = db.Column(db.String(200), nullable=False)
     label = db.Column(db.String(50), nullable=False)
@@ -26,7 +31,127 @@ class Analysis(db.Model):
     quality_score = db.Column(db.Float, nullable=True)
     resolution = db.Column(db.String(50), nullable=True)
     blur_score = db.Column(db.Float, nullable=True)
+    # True when the primary classifier missed its deadline and the heuristic answered
+    degraded = db.Column(db.Boolean, nullable=True, default=False)
+    # float32 vector in predict.FEATURE_NAMES order, used by `flask rescore`
+    features = db.Column(db.LargeBinary, nullable=True)
+    # 64-bit dHash (stored signed) and the earlier near-duplicate it matched, if any
+    phash = db.Column(db.BigInteger, nullable=True)
+    duplicate_of = db.Column(db.Integer, nullable=True)
+    # float32 colour/spoilage embedding searched by similarity.py
+    embedding = db.Column(db.LargeBinary, nullable=True)
+    # Spoilage overlay saved next to the upload, if any spoilage was visible
+    heatmap_filename = db.Column(db.String(200), nullable=True)
+    # Set when retention.py deleted the uploaded image; the row and its features are kept
+    image_purged_at = db.Column(db.DateTime, nullable=True)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
     
     def __repr__(self):
-        return f'<Analysis {self.id} - {self.label}>'
+        return f'<{type(self).__name__} {self.id} - {self.label}>'
+
+class Analysis(AnalysisColumns, db.Model):
+    __table_args__ = (
+        db.Index('ix_analysis_user_timestamp', 'user_id', 'timestamp', 'id'),
+        # Lets exports and digests stream all users' rows in (timestamp, id) order without a sort
+        db.Index('ix_analysis_timestamp_id', 'timestamp', 'id'),
+        # Looked up by the orphan sweep in retention.py
+        db.Index('ix_analysis_image_filename', 'image_filename'),
+        db.Index('ix_analysis_heatmap_filename', 'heatmap_filename'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+
+class AnalysisArchive(AnalysisColumns, db.Model):
+    """Analyses moved out of ``analysis`` by archive.py once they are older than ``ARCHIVE_AFTER_DAYS``.
+
+    On PostgreSQL the table is range-partitioned by month, which needs the
+    partition key in the primary key. Rows keep the id they had in ``analysis``.
+    """
+    __tablename__ = 'analysis_archive'
+    __table_args__ = (
+        db.Index('ix_analysis_archive_user_timestamp', 'user_id', 'timestamp', 'id'),
+        db.Index('ix_analysis_archive_timestamp_id', 'timestamp', 'id'),
+        db.Index('ix_analysis_archive_image_filename', 'image_filename'),
+        db.Index('ix_analysis_archive_heatmap_filename', 'heatmap_filename'),
+        {'postgresql_partition_by': 'RANGE (timestamp)'},
+    )
+    
+    id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    timestamp = db.Column(db.DateTime, primary_key=True)
+
+class AnalysisArchiveCount(db.Model):
+    """Archived analyses per user, label and food type, kept up to date by archive.py.
+
+    Archived rows only change through `flask rescore`, so all-time counts
+    read these totals instead of scanning the archive.
+    """
+    __tablename__ = 'analysis_archive_count'
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    label = db.Column(db.String(50), primary_key=True)
+    # '' stands for a missing food type, which a primary key cannot hold
+    food_type = db.Column(db.String(100), primary_key=True)
+    total = db.Column(db.Integer, nullable=False)
+
+class ApiToken(db.Model):
+    """Bearer token for the JSON API. Only the SHA-256 of the token is stored."""
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    name = db.Column(db.String(100), nullable=True)
+    token_hash = db.Column(db.String(64), unique=True, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    last_used_at = db.Column(db.DateTime, nullable=True)
+    
+    def __repr__(self):
+        return f'<ApiToken {self.id} - {self.name}>'
+
+class AnalysisBatch(db.Model):
+    """Results of one multi-image upload, stored server-side instead of in the session cookie."""
+    id = db.Column(db.String(32), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False, index=True)
+    results = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    
+    def __repr__(self):
+        return f'<AnalysisBatch {self.id}>'
+
+class DataVersion(db.Model):
+    """Change counters for analyses: ``user:<id>`` per user and ``global`` (see fragments.py).
+
+    Kept in the database so every worker and CLI process sees the same value.
+    """
+    __tablename__ = 'data_version'
+    name = db.Column(db.String(50), primary_key=True)
+    version = db.Column(db.Integer, nullable=False)
+    changed_at = db.Column(db.DateTime, nullable=False)
+
+def upgrade_schema():
+    """Create missing tables, then add columns and indexes that older databases lack.
+
+    Only additive changes are handled: new nullable columns and new indexes.
+    """
+    db.create_all()
+    engine = db.engine
+    inspector = inspect(engine)
+    for table in db.metadata.sorted_tables:
+        existing_columns = {column['name'] for column in inspector.get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing_columns:
+                column_type = column.type.compile(dialect=engine.dialect)
+                with engine.begin() as conn:
+                    conn.execute(text(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}'))
+        existing_indexes = {index['name'] for index in inspector.get_indexes(table.name)}
+        for index in table.indexes:
+            if index.name not in existing_indexes:
+                index.create(bind=engine)
+
+def init_database():
+    """Bring the schema up to date and seed the default admin user.
+
+    Returns True if the admin user was created.
+    """
+    upgrade_schema()
+    if User.query.filter_by(username="admin").first():
+        return False
+    db.session.add(User(username="admin", email="admin@example.com", password="password"))
+    db.session.commit()
+    return True
@@ -0,0 +1,77 @@
+"""Cross-request dynamic micro-batching.
+
+Concurrent requests submit single items and get a Future back. A
+background thread gathers items until ``max_batch_size`` are queued or
+the first has waited ``max_wait_ms``, then runs one ``batch_fn`` call for
+the whole group and resolves each Future with its own result.
+"""
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+import metrics
+
+
+class MicroBatcher:
+    def __init__(self, batch_fn, max_batch_size=8, max_wait_ms=5.0, name='classifier'):
+        self.batch_fn = batch_fn
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000.0
+        self.name = name
+        self._queue = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _ensure_worker(self):
+        # Threads do not survive fork (gunicorn --preload), so start one per process
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._queue = queue.Queue()
+            threading.Thread(target=self._run, args=(self._queue,), name=f'microbatch-{self.name}', daemon=True).start()
+            self._pid = os.getpid()
+
+    def submit(self, item):
+        self._ensure_worker()
+        future = Future()
+        self._queue.put((item, future, time.perf_counter()))
+        return future
+
+    def _collect(self, work_queue):
+        batch = [work_queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(work_queue.get(timeout=remaining) if remaining > 0 else work_queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self, work_queue):
+        while True:
+            batch = self._collect(work_queue)
+            batch = [entry for entry in batch if entry[1].set_running_or_notify_cancel()]
+            if not batch:
+                continue
+            started = time.perf_counter()
+            for _, _, queued_at in batch:
+                metrics.observe("food_microbatch_queue_seconds", started - queued_at, batcher=self.name)
+            metrics.inc("food_microbatch_batches_total", batcher=self.name)
+            metrics.inc("food_microbatch_items_total", len(batch), batcher=self.name)
+            try:
+                with metrics.stage(f"microbatch.{self.name}"):
+                    results = list(self.batch_fn([item for item, _, _ in batch]))
+                if len(results) != len(batch):
+                    raise ValueError(f"batch_fn returned {len(results)} results for {len(batch)} items")
+                for (_, future, _), result in zip(batch, results):
+                    future.set_result(result)
+            except Exception as e:
+                print(f"Micro-batch error: {str(e)}")
+                metrics.record_error(f"microbatch.{self.name}")
+                for _, future, _ in batch:
+                    future.set_exception(e)
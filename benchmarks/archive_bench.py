@@ -0,0 +1,170 @@
+"""Hot-path query latency with and without the analysis archive.
+
+Builds a scratch SQLite database with ``--rows`` analyses spread over
+``--users`` users and the last ``--days`` days. It times the per-user reads
+behind the dashboard, ``/api/history`` and ``/analytics``, plus single-row
+inserts, with every row in ``analysis``. It then moves rows older than
+``--hot-days`` to ``analysis_archive`` with ``archive.archive_rows`` and
+times the same reads again. Each phase runs in a fresh process, and the
+fragment cache is off.
+
+    python benchmarks/archive_bench.py --rows 10000000
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = """
+import json, random, statistics, sys, time
+from datetime import datetime, timedelta
+sys.path.insert(0, {root!r})
+from app import app, recent_analyses
+from auth import db, Analysis
+import archive
+
+rng = random.Random(1)
+users = [rng.randint(2, {users} + 1) for _ in range({samples})]
+now = datetime.utcnow()
+client = app.test_client()
+
+def get(path, uid):
+    with client.session_transaction() as session:
+        session['_user_id'] = str(uid)
+        session['_fresh'] = True
+    response = client.get(path)
+    assert response.status_code == 200, (path, response.status_code)
+
+def insert(uid):
+    db.session.execute(Analysis.__table__.insert(), {{'user_id': uid, 'image_filename': 'x.jpg', 'label': 'Fresh',
+                                                      'confidence': 80.0, 'food_type': 'fruit', 'timestamp': datetime.utcnow()}})
+    db.session.commit()
+
+since_30 = (now - timedelta(days=30)).date().isoformat()
+old = (now - timedelta(days=int({days} * 0.8))).date().isoformat()
+cases = [
+    ('dashboard recent', lambda uid: recent_analyses(uid, 5)),
+    ('history page', lambda uid: get('/api/history', uid)),
+    ('history 30d', lambda uid: get('/api/history?since=' + since_30, uid)),
+    ('history old', lambda uid: get('/api/history?until=' + old, uid)),
+    ('profile count', lambda uid: get('/profile', uid)),
+    ('analytics', lambda uid: get('/analytics', uid)),
+    ('insert', insert),
+]
+results = {{}}
+with app.app_context():
+    for name, run in cases:
+        run(users[0])
+        timings = []
+        for uid in users:
+            started = time.perf_counter()
+            run(uid)
+            timings.append((time.perf_counter() - started) * 1000)
+            db.session.rollback()
+        timings.sort()
+        results[name] = (statistics.median(timings), timings[int(len(timings) * 0.95)])
+print(json.dumps(results))
+"""
+
+
+def build_table(database_url, rows, users, days, batch=100000):
+    os.environ['DATABASE_URL'] = database_url
+    sys.path.insert(0, ROOT)
+    import random
+    from datetime import datetime, timedelta
+
+    from app import app
+    from auth import db, init_database, Analysis, User
+
+    rng = random.Random(0)
+    labels = ('Fresh', 'Okay', 'Avoid')
+    food_types = ('fruit', 'vegetable', 'bread', 'dairy', 'cooked_food')
+    start = datetime.utcnow() - timedelta(days=days)
+    step = days * 86400 / rows
+    with app.app_context():
+        init_database()
+        # Ids 2..users + 1; the admin user is 1
+        db.session.add_all(User(username=f"bench{i}", password="x") for i in range(users))
+        db.session.commit()
+        table = Analysis.__table__
+        for offset in range(0, rows, batch):
+            db.session.execute(table.insert(), [{
+                'user_id': rng.randint(2, users + 1),
+                'image_filename': f"{i % 256:02x}/{i // 256 % 256:02x}/{i:09d}.jpg",
+                'label': labels[i % 3],
+                'confidence': rng.uniform(50, 95),
+                'food_type': food_types[i % 5],
+                'timestamp': start + timedelta(seconds=step * i),
+            } for i in range(offset, min(offset + batch, rows))])
+            db.session.commit()
+
+
+def archive_table(database_url, hot_days):
+    os.environ['DATABASE_URL'] = database_url
+    sys.path.insert(0, ROOT)
+    from datetime import datetime, timedelta
+
+    from app import app
+    import archive
+
+    with app.app_context():
+        started = time.perf_counter()
+        moved = archive.archive_rows(datetime.utcnow() - timedelta(days=hot_days))
+        elapsed = time.perf_counter() - started
+    batches = -(-moved // archive.ARCHIVE_BATCH_SIZE)
+    print(json.dumps({'moved': moved, 'seconds': elapsed, 'batches': batches}))
+
+
+def run_phase(env, args):
+    code = CHILD.format(root=ROOT, users=args.users, samples=args.samples, days=args.days)
+    result = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True)
+    if result.returncode:
+        sys.exit(result.stderr)
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=10_000_000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--days', type=int, default=730, help='history spread over this many days')
+    parser.add_argument('--hot-days', type=float, default=90, help='ARCHIVE_AFTER_DAYS for the archived phase')
+    parser.add_argument('--samples', type=int, default=200, help='random users timed per query')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='archive_bench_')
+    database_url = f"sqlite:///{os.path.join(directory, 'bench.db')}"
+    env = dict(os.environ, DATABASE_URL=database_url, FRAGMENT_CACHE_TTL='0')
+
+    started = time.perf_counter()
+    subprocess.run([sys.executable, __file__, '--build', database_url, str(args.rows), str(args.users),
+                    str(args.days)], check=True)
+    print(f"built {args.rows:,} rows for {args.users} users over {args.days} days in "
+          f"{time.perf_counter() - started:.0f}s")
+    single = run_phase(env, args)
+
+    result = subprocess.run([sys.executable, __file__, '--archive', database_url, str(args.hot_days)],
+                            env=env, check=True, capture_output=True, text=True)
+    moved = json.loads(result.stdout.strip().splitlines()[-1])
+    print(f"archived {moved['moved']:,} rows older than {args.hot_days:g} days in {moved['seconds']:.0f}s "
+          f"({moved['moved'] / moved['seconds']:,.0f} rows/s, {moved['seconds'] / max(moved['batches'], 1) * 1000:.0f} ms "
+          f"per batch); {args.rows - moved['moved']:,} rows stay live")
+    split = run_phase(env, args)
+
+    print(f"{'query':>18} {'single p50':>11} {'p95':>8} {'hot+archive p50':>16} {'p95':>8}   (ms)")
+    for name in single:
+        print(f"{name:>18} {single[name][0]:>11.2f} {single[name][1]:>8.2f} {split[name][0]:>16.2f} {split[name][1]:>8.2f}")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 6 and sys.argv[1] == '--build':
+        build_table(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]), int(sys.argv[5]))
+    elif len(sys.argv) == 4 and sys.argv[1] == '--archive':
+        archive_table(sys.argv[2], float(sys.argv[3]))
+    else:
+        main()
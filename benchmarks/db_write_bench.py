@@ -0,0 +1,128 @@
+"""Concurrent write benchmark for the database engine profiles.
+
+Starts ``--processes`` worker processes (like gunicorn workers), each
+running ``--threads`` threads that save ``Analysis`` rows the way
+``pipeline.analyze_saved_image`` does: add, flush, commit, one row per
+request, with feature and embedding blobs attached. ``--read-ratio`` of
+the operations read the user's recent history instead. Each profile gets
+a fresh database, and the benchmark reports throughput, commit latency
+and how many operations failed (e.g. "database is locked").
+
+    python benchmarks/db_write_bench.py --profiles default,sqlite --processes 4 --threads 8
+    DATABASE_URL=postgresql://... python benchmarks/db_write_bench.py --profiles default,postgres
+"""
+import argparse
+import multiprocessing
+import os
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+
+def run_worker(profile, database_url, threads, seconds, read_ratio, seed):
+    """Worker process body; returns ``(write_latencies, read_latencies, errors)``."""
+    os.environ['DATABASE_URL'] = database_url
+    os.environ['DB_PROFILE'] = profile
+    os.environ.pop('AUTO_INIT_DB', None)
+    import numpy as np
+
+    from app import app
+    from auth import db, Analysis
+
+    features = np.zeros(10, dtype=np.float32).tobytes()
+    embedding = np.zeros(41, dtype=np.float32).tobytes()
+    deadline = time.perf_counter() + seconds
+    lock = threading.Lock()
+    writes, reads, errors = [], [], Counter()
+
+    def loop(thread_seed):
+        rng = np.random.default_rng(thread_seed)
+        local_writes, local_reads = [], []
+        with app.app_context():
+            while time.perf_counter() < deadline:
+                started = time.perf_counter()
+                try:
+                    if rng.random() < read_ratio:
+                        (Analysis.query.filter_by(user_id=1)
+                         .order_by(Analysis.timestamp.desc(), Analysis.id.desc()).limit(20).all())
+                        db.session.rollback()
+                        local_reads.append(time.perf_counter() - started)
+                        continue
+                    analysis = Analysis(user_id=1, image_filename=f"bench_{rng.integers(1 << 30)}.jpg",
+                                        label='Fresh', confidence=float(rng.uniform(80, 95)), food_type='fruit',
+                                        quality_score=70.0, resolution='640x480', blur_score=150.0,
+                                        degraded=False, features=features, embedding=embedding)
+                    db.session.add(analysis)
+                    db.session.flush()
+                    db.session.commit()
+                    local_writes.append(time.perf_counter() - started)
+                except Exception as e:
+                    db.session.rollback()
+                    errors[type(e).__name__ + ': ' + str(e).splitlines()[0][:80]] += 1
+        with lock:
+            writes.extend(local_writes)
+            reads.extend(local_reads)
+
+    workers = [threading.Thread(target=loop, args=(seed * 1000 + i,)) for i in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return writes, reads, errors
+
+
+def init_database(profile, database_url):
+    os.environ['DATABASE_URL'] = database_url
+    os.environ['DB_PROFILE'] = profile
+    from app import app
+    from auth import init_database as bootstrap
+    with app.app_context():
+        bootstrap()
+
+
+def percentile_ms(samples, p):
+    if not samples:
+        return float('nan')
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(p * len(samples)))] * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--profiles', default='default,sqlite')
+    parser.add_argument('--processes', type=int, default=4)
+    parser.add_argument('--threads', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=10)
+    parser.add_argument('--read-ratio', type=float, default=0.3)
+    args = parser.parse_args()
+
+    base_url = os.environ.get('DATABASE_URL')
+    context = multiprocessing.get_context('spawn')
+    print(f"{args.processes} processes x {args.threads} threads, {args.seconds:g}s, read ratio {args.read_ratio}")
+    print(f"{'profile':>9} {'writes/s':>9} {'w_p50_ms':>9} {'w_p99_ms':>9} {'reads/s':>8} {'r_p99_ms':>9} {'errors':>7}")
+    for profile in args.profiles.split(','):
+        # SQLite runs each profile against a fresh file; a server database is reused as given
+        database_url = base_url or f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='db_write_bench_'), 'bench.db')}"
+        with context.Pool(1) as pool:
+            pool.apply(init_database, (profile, database_url))
+        with context.Pool(args.processes) as pool:
+            jobs = [pool.apply_async(run_worker, (profile, database_url, args.threads, args.seconds,
+                                                  args.read_ratio, seed)) for seed in range(args.processes)]
+            results = [job.get() for job in jobs]
+        writes = [t for w, _, _ in results for t in w]
+        reads = [t for _, r, _ in results for t in r]
+        errors = sum((e for _, _, e in results), Counter())
+        print(f"{profile:>9} {len(writes) / args.seconds:>9.0f} {percentile_ms(writes, 0.5):>9.1f} "
+              f"{percentile_ms(writes, 0.99):>9.1f} {len(reads) / args.seconds:>8.0f} "
+              f"{percentile_ms(reads, 0.99):>9.1f} {sum(errors.values()):>7}")
+        for message, count in errors.most_common(3):
+            print(f"{'':>9}   {count} x {message}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,136 @@
+"""Digest throughput against a local SMTP sink.
+
+Seeds ``--users`` users with ``--per-user`` analyses from yesterday into
+a scratch SQLite database, then starts a minimal SMTP server on
+localhost that accepts and discards mail. It times:
+
+* ``per-analysis``: one message and one connection per analysis, which is
+  what ``email_report`` does (PDF rendering left out, so the comparison is
+  generous to it).
+* ``digest``: ``digest.send_digests``, with one message per user over one
+  reused connection, with and without the combined PDF.
+
+``--sink-latency-ms`` adds a delay to each SMTP reply to mimic a remote server.
+
+    python benchmarks/digest_bench.py --users 200 --per-user 50
+"""
+import argparse
+import os
+import random
+import socketserver
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault('DATABASE_URL', f"sqlite:///{os.path.join(tempfile.mkdtemp(prefix='digest_bench_'), 'bench.db')}")
+os.environ['SMTP_STARTTLS'] = '0'
+os.environ['SENDER_PASSWORD'] = ''
+
+
+class SinkHandler(socketserver.StreamRequestHandler):
+    """Just enough SMTP for smtplib: every command is accepted and messages are dropped."""
+    latency = 0.0
+
+    def reply(self, line):
+        if self.latency:
+            time.sleep(self.latency)
+        self.wfile.write(line.encode() + b'\r\n')
+
+    def handle(self):
+        self.reply('220 sink ready')
+        while True:
+            line = self.rfile.readline()
+            if not line:
+                return
+            command = line[:4].upper()
+            if command == b'EHLO':
+                self.wfile.write(b'250-sink\r\n')
+                self.reply('250 SIZE 52428800')
+            elif command == b'DATA':
+                self.reply('354 go ahead')
+                while self.rfile.readline() not in (b'.\r\n', b''):
+                    pass
+                self.server.messages += 1
+                self.reply('250 queued')
+            elif command == b'QUIT':
+                self.reply('221 bye')
+                return
+            else:
+                self.reply('250 ok')
+
+
+class SinkServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+    messages = 0
+
+
+def seed(db, User, Analysis, users, per_user):
+    rng = random.Random(0)
+    yesterday = datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0) - timedelta(days=1)
+    db.session.add_all(User(username=f"bench{i}", email=f"bench{i}@example.com", password="x") for i in range(users))
+    db.session.commit()
+    user_ids = [uid for (uid,) in db.session.query(User.id).filter(User.username.like('bench%'))]
+    rows = []
+    for uid in user_ids:
+        for _ in range(per_user):
+            rows.append({'user_id': uid, 'image_filename': 'x.jpg', 'label': rng.choice(['Fresh', 'Okay', 'Avoid']),
+                         'confidence': rng.uniform(50, 95), 'food_type': rng.choice(['fruit', 'vegetable', 'bread']),
+                         'timestamp': yesterday + timedelta(seconds=rng.randint(0, 86399))})
+    db.session.execute(Analysis.__table__.insert(), rows)
+    db.session.commit()
+    return len(rows)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, default=200)
+    parser.add_argument('--per-user', type=int, default=50)
+    parser.add_argument('--sink-latency-ms', type=float, default=1.0)
+    parser.add_argument('--per-analysis-limit', type=int, default=1000, help='messages to time for the baseline')
+    args = parser.parse_args()
+
+    from app import app
+    from auth import db, init_database, Analysis, User
+    from digest import send_digests
+    from email_sender import generate_email_body, send_email_report
+
+    SinkHandler.latency = args.sink_latency_ms / 1000
+    server = SinkServer(('127.0.0.1', 0), SinkHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    host, port = server.server_address
+    import email_sender
+    email_sender.SMTP_SERVER, email_sender.SMTP_PORT = host, port
+
+    with app.app_context():
+        init_database()
+        total = seed(db, User, Analysis, args.users, args.per_user)
+        print(f"{args.users} users x {args.per_user} analyses = {total} rows, sink latency {args.sink_latency_ms} ms/reply")
+
+        analyses = Analysis.query.limit(args.per_analysis_limit).all()
+        started = time.perf_counter()
+        for analysis in analyses:
+            data = {'label': analysis.label, 'confidence': analysis.confidence, 'food_type': analysis.food_type,
+                    'timestamp': analysis.timestamp.strftime('%Y-%m-%d %H:%M:%S')}
+            send_email_report('someone@example.com', 'report', generate_email_body(data))
+        elapsed = time.perf_counter() - started
+        print(f"{'per-analysis':>14}: {len(analyses) / elapsed:8.1f} messages/s "
+              f"-> {total / (len(analyses) / elapsed):7.1f}s for all {total} analyses")
+
+        for attach in (False, True):
+            summary = send_digests(attach_pdf=attach, smtp_server=host, smtp_port=port)
+            name = 'digest+pdf' if attach else 'digest'
+            print(f"{name:>14}: {summary['messages_per_second']:8.1f} messages/s -> {summary['seconds']:7.1f}s for "
+                  f"{summary['sent']} digests (query {summary['query_seconds'] * 1000:.0f} ms, "
+                  f"render {summary['render_seconds']:.2f}s, send {summary['send_seconds']:.2f}s, "
+                  f"{summary['connections']} connection(s), {summary['failed']} failed)")
+    print(f"sink received {server.messages} messages")
+    server.shutdown()
+
+
+if __name__ == '__main__':
+    main()
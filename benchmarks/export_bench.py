@@ -0,0 +1,105 @@
+"""Export throughput and memory on a synthetic million-row Analysis table.
+
+Builds a scratch SQLite database with ``--rows`` analyses (feature blobs
+included), then runs each export format in a fresh process. It reports
+rows/s, output size and peak RSS above the post-import baseline (with
+SQLite mmap off, so that file pages are not counted). Run with
+two ``--rows`` values to see that memory follows ``--chunk-size``, not
+the row count.
+
+    python benchmarks/export_bench.py --rows 1000000
+"""
+import argparse
+import os
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = """
+import os, resource, sys, time
+sys.path.insert(0, {root!r})
+from app import app
+from export import export_to_file
+baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+with app.app_context():
+    started = time.perf_counter()
+    written, until = export_to_file({path!r}, {fmt!r}, features={features!r}, chunk_size={chunk_size!r})
+    elapsed = time.perf_counter() - started
+peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+print(elapsed, written, baseline, peak)
+"""
+
+
+def build_table(database_url, rows, batch=50000):
+    os.environ['DATABASE_URL'] = database_url
+    sys.path.insert(0, ROOT)
+    import numpy as np
+    from datetime import datetime, timedelta
+
+    from app import app
+    from auth import db, init_database, Analysis
+
+    rng = np.random.default_rng(0)
+    labels = np.array(['Fresh', 'Okay', 'Avoid'])
+    food_types = np.array(['fruit', 'vegetable', 'bread', 'dairy', 'cooked_food'])
+    start = datetime(2025, 1, 1)
+    with app.app_context():
+        init_database()
+        table = Analysis.__table__
+        for offset in range(0, rows, batch):
+            count = min(batch, rows - offset)
+            features = rng.random((count, 10), dtype=np.float32)
+            db.session.execute(table.insert(), [{
+                'user_id': 1 + (offset + i) % 1000,
+                'image_filename': f"{offset + i:08d}.jpg",
+                'label': labels[(offset + i) % 3],
+                'confidence': float(50 + 45 * features[i, 0]),
+                'food_type': food_types[(offset + i) % 5],
+                'quality_score': 120.0, 'resolution': '640x480', 'blur_score': 120.0, 'degraded': False,
+                'features': features[i].tobytes(),
+                'timestamp': start + timedelta(seconds=30 * (offset + i)),
+            } for i in range(count)])
+            db.session.commit()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--chunk-size', type=int, default=50000)
+    parser.add_argument('--formats', default='csv.gz,parquet,arrow')
+    parser.add_argument('--features', action='store_true', help='include the 10 feature columns')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='export_bench_')
+    database_url = f"sqlite:///{os.path.join(directory, 'bench.db')}"
+    started = time.perf_counter()
+    subprocess.run([sys.executable, __file__, '--build', database_url, str(args.rows)], check=True)
+    print(f"built {args.rows:,} rows in {time.perf_counter() - started:.1f}s; chunk size {args.chunk_size:,}, "
+          f"features {'on' if args.features else 'off'}")
+
+    env = dict(os.environ, DATABASE_URL=database_url, EXPORT_WATERMARK_LAG='0')
+    # Memory-mapped SQLite pages count towards RSS but are clean file cache, not export buffers
+    env.setdefault('SQLITE_MMAP_SIZE', '0')
+    print(f"{'format':>8} {'seconds':>8} {'rows/s':>10} {'MB':>8} {'peak_rss_MB':>12} {'rss_growth_MB':>14}")
+    for fmt in args.formats.split(','):
+        path = os.path.join(directory, f"export.{fmt}")
+        code = CHILD.format(root=ROOT, path=path, fmt=fmt, features=args.features, chunk_size=args.chunk_size)
+        result = subprocess.run([sys.executable, '-c', code], env=env, capture_output=True, text=True)
+        if result.returncode:
+            print(f"{fmt:>8} failed: {result.stderr.strip().splitlines()[-1]}")
+            continue
+        elapsed, written, baseline, peak = (float(v) for v in result.stdout.split()[-4:])
+        # ru_maxrss is in KB on Linux
+        print(f"{fmt:>8} {elapsed:>8.1f} {args.rows / elapsed:>10,.0f} {written / 2**20:>8.1f} "
+              f"{peak / 1024:>12.0f} {(peak - baseline) / 1024:>14.0f}")
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 4 and sys.argv[1] == '--build':
+        build_table(sys.argv[2], int(sys.argv[3]))
+    else:
+        main()
@@ -0,0 +1,97 @@
+"""Benchmark the tiled spoilage heatmap against the global analysis it extends.
+
+For synthetic JPEG photos at several sizes, times the existing per-image
+work (bounded decode, resize, HSV, masks, feature vector) and the extra
+heatmap work (area-averaged tile ratios, overlay render, PNG write), and
+reports the overhead. ``tiles_ms`` is the tile statistics step alone;
+a Python loop over tiles is timed for comparison.
+
+    python benchmarks/heatmap_bench.py --repeat 20
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import cv2  # noqa: E402
+import numpy as np  # noqa: E402
+
+from heatmap import HEATMAP_TILE, render_overlay, tile_severity  # noqa: E402
+from predict import compute_features, fit_analysis_size, image_to_hsv, load_analysis_image, spoilage_masks  # noqa: E402
+
+
+def synthetic_photo(rng, width, height):
+    image = np.zeros((height, width, 3), dtype=np.uint8)
+    image[:] = (40, 150, 60)
+    image += rng.integers(0, 40, (height, width, 3), dtype=np.uint8)
+    for _ in range(6):
+        x, y = int(rng.integers(0, width - 100)), int(rng.integers(0, height - 100))
+        cv2.circle(image, (x, y), int(rng.integers(10, 60)), (20, 30, 25), -1)
+    return image
+
+
+def looped_severity(masks, tile=HEATMAP_TILE):
+    mold, rotten, gray = masks['mold'], masks['rotten'], masks['gray']
+    rows, cols = mold.shape[0] // tile, mold.shape[1] // tile
+    out = np.zeros((rows, cols), dtype=np.float32)
+    for r in range(rows):
+        for c in range(cols):
+            window = (slice(r * tile, (r + 1) * tile), slice(c * tile, (c + 1) * tile))
+            penalty = mold[window].mean() * 200 + rotten[window].mean() * 120 + (gray[window].mean() > 0.3) * 50
+            out[r, c] = min(max(penalty / 70, 0), 1)
+    return out
+
+
+def best_of(fn, repeat):
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - started)
+    return min(times) * 1000, sorted(times)[len(times) // 2] * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', default='1024x768,2048x1536,4032x3024')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    directory = tempfile.mkdtemp(prefix='heatmap_bench_')
+    print(f"tile={HEATMAP_TILE}px, times are median ms over {args.repeat} runs")
+    print(f"{'size':>10} {'global_ms':>10} {'tiles_ms':>9} {'heatmap_ms':>11} {'overhead':>9} {'loop_tiles_ms':>14}")
+    for size in args.sizes.split(','):
+        width, height = (int(v) for v in size.split('x'))
+        path = os.path.join(directory, f"{size}.jpg")
+        cv2.imwrite(path, synthetic_photo(rng, width, height), [cv2.IMWRITE_JPEG_QUALITY, 90])
+
+        state = {}
+
+        def global_analysis():
+            image = fit_analysis_size(load_analysis_image(path))
+            hsv = image_to_hsv(image)
+            masks = spoilage_masks(hsv)
+            compute_features(hsv, masks)
+            state.update(masks=masks)
+
+        def heatmap_work():
+            severity = tile_severity(state['masks'])
+            cv2.imwrite(os.path.join(directory, 'overlay.png'), render_overlay(severity))
+
+        # Warm up both paths so one-off initialisation is not charged to the first size
+        global_analysis()
+        heatmap_work()
+        _, global_ms = best_of(global_analysis, args.repeat)
+        _, tiles_ms = best_of(lambda: tile_severity(state['masks']), args.repeat)
+        _, heatmap_ms = best_of(heatmap_work, args.repeat)
+        _, loop_ms = best_of(lambda: looped_severity(state['masks']), max(3, args.repeat // 4))
+        print(f"{size:>10} {global_ms:>10.2f} {tiles_ms:>9.2f} {heatmap_ms:>11.2f} "
+              f"{100 * heatmap_ms / global_ms:>8.1f}% {loop_ms:>14.2f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,365 @@
+"""Load test across gunicorn worker/thread configurations.
+
+Seeds a scratch SQLite database with ``--users`` users, each with a few
+real analyses (uploaded through the pipeline, so PDFs have images) and
+``--history`` synthetic rows. Then, for every config in ``--configs``, it
+starts gunicorn with gunicorn.conf.py plus that config's overrides on a
+fresh copy of the database, and replays a fixed route mix from
+``--clients`` closed-loop clients, each logged in as its own user:
+
+    predict   POST /predict with 1-3 synthetic photos
+    camera    POST /capture-camera with one photo
+    analytics GET /analytics
+    history   GET /api/history
+    pdf       GET /download-pdf/<one of the user's analyses>
+
+Route choices and images come from ``--seed``, so reruns replay the same
+requests. For each config it reports throughput, per-route p50/p95/p99,
+the error rate (429/503 from admission control are counted separately as
+``shed``) and the peak RSS of the master plus workers. It ends with the
+best config, written out as gunicorn.conf.py settings: the highest
+throughput with errors and shed requests under ``--max-error-rate``, and
+among configs within 5% of that, the lowest mean of the per-route p95s.
+
+A config is ``mode:workers`` or ``mode:workersxthreads``: ``sync:3``,
+``gthread:2x4`` (sync mode with threads), ``async:2``. The client threads
+run on the same machine, so leave them a core, or read the results as
+relative.
+
+    python benchmarks/load_test.py --cores 2 --clients 16 --duration 60
+"""
+import argparse
+import json
+import os
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter, defaultdict
+from urllib.parse import urlencode
+
+import cv2
+import numpy as np
+
+from serving_bench import free_port, percentile, request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+DEFAULT_MIX = 'predict=15,camera=5,analytics=20,history=40,pdf=20'
+PASSWORD = 'load-test'
+
+
+def synthetic_photo(rng, size=(960, 1280)):
+    """JPEG of a coloured blob with dark patches, roughly like a phone photo of food."""
+    height, width = size
+    image = np.full((height, width, 3), rng.integers(180, 240, 3), np.uint8)
+    color = tuple(int(value) for value in rng.integers(20, 230, 3))
+    cv2.ellipse(image, (width // 2, height // 2), (width // 3, height // 3), 0, 0, 360, color, -1)
+    for _ in range(rng.integers(0, 6)):
+        center = (int(rng.integers(width // 4, 3 * width // 4)), int(rng.integers(height // 4, 3 * height // 4)))
+        cv2.circle(image, center, int(rng.integers(10, 60)), (30, 40, 35), -1)
+    noise = rng.integers(0, 12, image.shape, dtype=np.uint8)
+    return cv2.imencode('.jpg', cv2.add(image, noise), [cv2.IMWRITE_JPEG_QUALITY, 88])[1].tobytes()
+
+
+def multipart(fields):
+    """``(body, content_type)`` for ``[(name, filename, data), ...]``."""
+    boundary = uuid.uuid4().hex
+    parts = []
+    for name, filename, data in fields:
+        parts.append(f"--{boundary}\r\nContent-Disposition: form-data; name=\"{name}\"; filename=\"{filename}\"\r\n"
+                     f"Content-Type: image/jpeg\r\n\r\n".encode() + data + b"\r\n")
+    return b''.join(parts) + f"--{boundary}--\r\n".encode(), f"multipart/form-data; boundary={boundary}"
+
+
+def seed(database_url, users, history, seed_value):
+    """Create users bench0..; print ``{username: [analysis ids with images]}`` as JSON."""
+    os.environ['DATABASE_URL'] = database_url
+    sys.path.insert(0, ROOT)
+    from datetime import datetime, timedelta
+
+    from app import app
+    from auth import db, init_database, Analysis, User
+
+    rng = np.random.default_rng(seed_value)
+    labels = ('Fresh', 'Okay', 'Avoid')
+    food_types = ('fruit', 'vegetable', 'bread', 'dairy', 'cooked_food')
+    owned = {}
+    with app.app_context():
+        init_database()
+        accounts = [User(username=f"bench{i}", email=f"bench{i}@example.com", password=PASSWORD)
+                    for i in range(users)]
+        db.session.add_all(accounts)
+        db.session.commit()
+        accounts = [(account.id, account.username) for account in accounts]
+        start = datetime.utcnow() - timedelta(days=365)
+        rows = []
+        for user_id, _ in accounts:
+            for i in range(history):
+                rows.append({'user_id': user_id, 'image_filename': f"seed_{user_id}_{i}.jpg",
+                             'label': labels[i % 3], 'confidence': float(rng.uniform(50, 95)),
+                             'food_type': food_types[i % 5], 'quality_score': 120.0, 'resolution': '1280x960',
+                             'blur_score': 120.0, 'timestamp': start + timedelta(minutes=int(rng.integers(0, 525600)))})
+        if rows:
+            db.session.execute(Analysis.__table__.insert(), rows)
+            db.session.commit()
+
+    client = app.test_client()
+    for _, username in accounts:
+        client.post('/auth/login', data={'username': username, 'password': PASSWORD})
+        body, content_type = multipart([('images', f"seed{i}.jpg", synthetic_photo(rng)) for i in range(3)])
+        client.post('/predict', data=body, content_type=content_type)
+        client.get('/logout')
+    with app.app_context():
+        for user_id, username in accounts:
+            owned[username] = [row.id for row in Analysis.query.filter(
+                Analysis.user_id == user_id, Analysis.image_filename.notlike('seed_%')).all()]
+        # Closing the last connection checkpoints the WAL into the file that gets copied
+        db.engine.dispose()
+    print(json.dumps(owned))
+
+
+def parse_config(spec):
+    """``'gthread:2x4'`` -> ``{'name', 'mode', 'workers', 'threads'}``."""
+    mode, _, size = spec.partition(':')
+    workers, _, threads = size.partition('x')
+    if mode not in ('sync', 'gthread', 'async') or not workers.isdigit() or (threads and not threads.isdigit()):
+        raise SystemExit(f"bad config {spec!r}; expected e.g. sync:3, gthread:2x4 or async:2")
+    threads = int(threads or (4 if mode == 'gthread' else 1))
+    return {'name': spec, 'mode': mode, 'workers': int(workers), 'threads': threads}
+
+
+def default_configs(cores):
+    specs = [f"sync:{cores}", f"sync:{2 * cores + 1}", f"gthread:{cores}x4", f"gthread:{2 * cores}x4",
+             f"async:{cores}", f"async:{2 * cores}"]
+    return ','.join(dict.fromkeys(specs))
+
+
+def start_server(config, env):
+    port = free_port()
+    env = dict(env, SERVING_MODE='async' if config['mode'] == 'async' else 'sync')
+    command = [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '-b', f'127.0.0.1:{port}',
+               '-w', str(config['workers']), '--threads', str(config['threads'])]
+    server = subprocess.Popen(command, cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.perf_counter() + 60
+    while time.perf_counter() < deadline:
+        if request(port, 'GET', '/', timeout=1)[0] == 200:
+            return server, port
+        time.sleep(0.1)
+    server.terminate()
+    raise RuntimeError(f"gunicorn ({config['name']}) did not answer in time")
+
+
+def tree_rss(pid):
+    """RSS in bytes of ``pid`` and all its descendants (Linux /proc)."""
+    total, pending = 0, [pid]
+    while pending:
+        current = pending.pop()
+        try:
+            with open(f"/proc/{current}/status") as status:
+                total += next(int(line.split()[1]) * 1024 for line in status if line.startswith('VmRSS:'))
+            with open(f"/proc/{current}/task/{current}/children") as children:
+                pending.extend(int(child) for child in children.read().split())
+        except (OSError, StopIteration):
+            continue
+    return total
+
+
+def login(port, username):
+    form = {'Content-Type': 'application/x-www-form-urlencoded'}
+    _, headers, _ = request(port, 'POST', '/auth/login', urlencode({'username': username, 'password': PASSWORD}), form)
+    return headers['Set-Cookie'].split(';', 1)[0]
+
+
+def build_requests(route, rng, photos, analysis_ids):
+    """``(method, path, body, headers, ok_location)`` for one request on ``route``."""
+    if route == 'predict':
+        count = int(rng.integers(1, 4))
+        body, content_type = multipart([('images', f"load{i}.jpg", photos[int(rng.integers(len(photos)))])
+                                        for i in range(count)])
+        return 'POST', '/predict', body, {'Content-Type': content_type}, '/batch-results/'
+    if route == 'camera':
+        body, content_type = multipart([('camera_image', 'camera.jpg', photos[int(rng.integers(len(photos)))])])
+        return 'POST', '/capture-camera', body, {'Content-Type': content_type}, '/result/'
+    if route == 'analytics':
+        return 'GET', '/analytics', None, {}, None
+    if route == 'history':
+        return 'GET', '/api/history', None, {}, None
+    return 'GET', f"/download-pdf/{analysis_ids[int(rng.integers(len(analysis_ids)))]}", None, {}, None
+
+
+def run_load(port, owned, mix, clients, warmup, duration, seed_value):
+    """Closed-loop clients; returns ``{route: {'latencies', 'errors', 'shed'}}`` for the measured window."""
+    routes, weights = zip(*mix.items())
+    usernames = sorted(owned)
+    cookies = [login(port, usernames[i % len(usernames)]) for i in range(clients)]
+    photo_rng = np.random.default_rng(seed_value)
+    photos = [synthetic_photo(photo_rng) for _ in range(8)]
+    results = defaultdict(lambda: {'latencies': [], 'errors': Counter(), 'shed': 0})
+    lock = threading.Lock()
+    measure_from = time.perf_counter() + warmup
+    deadline = measure_from + duration
+
+    def client(index):
+        rng = np.random.default_rng(seed_value * 1000 + index)
+        choose = random.Random(seed_value * 1000 + index)
+        analysis_ids = owned[usernames[index % len(usernames)]]
+        while time.perf_counter() < deadline:
+            route = choose.choices(routes, weights)[0]
+            method, path, body, headers, ok_location = build_requests(route, rng, photos, analysis_ids)
+            headers['Cookie'] = cookies[index]
+            started = time.perf_counter()
+            status, response_headers, elapsed = request(port, method, path, body, headers, timeout=60)
+            location = response_headers.get('Location', '') if response_headers else ''
+            ok = status == 200 or (status == 302 and ok_location is not None and ok_location in location)
+            if started >= measure_from and time.perf_counter() <= deadline:
+                with lock:
+                    entry = results[route]
+                    if ok:
+                        entry['latencies'].append(elapsed)
+                    elif status in (429, 503):
+                        entry['shed'] += 1
+                    else:
+                        entry['errors'][status or 'timeout'] += 1
+            if status in (429, 503):
+                # Honour Retry-After like the browser client's retry loop
+                time.sleep(min(float(response_headers.get('Retry-After', 1)), max(0, deadline - time.perf_counter())))
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return results
+
+
+def summarize(config, results, duration, peak_rss):
+    latencies = sorted(value for entry in results.values() for value in entry['latencies'])
+    errors = sum(sum(entry['errors'].values()) for entry in results.values())
+    shed = sum(entry['shed'] for entry in results.values())
+    total = len(latencies) + errors + shed
+    return {
+        'config': config['name'], 'rps': len(latencies) / duration, 'requests': total,
+        'error_rate': errors / total if total else 1.0, 'shed_rate': shed / total if total else 0.0,
+        'p50': percentile(latencies, 0.5), 'p95': percentile(latencies, 0.95), 'p99': percentile(latencies, 0.99),
+        # Every route counts the same, so cheap pages stuck behind uploads show up
+        'route_p95': float(np.mean([percentile(sorted(entry['latencies']), 0.95) for entry in results.values()])),
+        'peak_rss_mb': peak_rss / 2**20,
+    }
+
+
+def print_routes(results):
+    print(f"    {'route':>10} {'ok':>6} {'p50_ms':>8} {'p95_ms':>8} {'p99_ms':>8} {'shed':>5}  errors")
+    for route in sorted(results):
+        entry = results[route]
+        values = sorted(entry['latencies'])
+        print(f"    {route:>10} {len(values):>6} {percentile(values, 0.5):>8.0f} {percentile(values, 0.95):>8.0f} "
+              f"{percentile(values, 0.99):>8.0f} {entry['shed']:>5}  {dict(entry['errors']) or '-'}")
+
+
+def recommend(summaries, configs, max_error_rate):
+    """Highest throughput with errors plus shed requests within budget; within 5% of it, the lowest route p95."""
+    eligible = [summary for summary in summaries if summary['error_rate'] + summary['shed_rate'] <= max_error_rate]
+    if not eligible:
+        return None
+    best = max(summary['rps'] for summary in eligible)
+    choice = min((summary for summary in eligible if summary['rps'] >= 0.95 * best),
+                 key=lambda summary: summary['route_p95'])
+    return choice, next(config for config in configs if config['name'] == choice['config'])
+
+
+def print_profile(summary, config, cores):
+    print(f"\n# gunicorn.conf.py profile for {cores} core(s), from benchmarks/load_test.py:")
+    print(f"# {config['name']}: {summary['rps']:.1f} req/s, route p95 {summary['route_p95']:.0f} ms, "
+          f"{summary['error_rate']:.1%} errors, {summary['shed_rate']:.1%} shed, {summary['peak_rss_mb']:.0f} MB RSS")
+    if config['mode'] == 'async':
+        print("wsgi_app = 'asgi:application'\nworker_class = 'uvicorn_worker.UvicornWorker'")
+    else:
+        print("wsgi_app = 'app:app'")
+        print(f"worker_class = '{'gthread' if config['threads'] > 1 else 'sync'}'")
+        if config['threads'] > 1:
+            print(f"threads = {config['threads']}")
+    print(f"workers = {config['workers']}")
+    print(f"# or set SERVING_MODE={'async' if config['mode'] == 'async' else 'sync'} "
+          f"WEB_CONCURRENCY={config['workers']} GUNICORN_THREADS={config['threads']}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--cores', type=int, default=os.cpu_count() or 1, help='core count to size the default matrix for')
+    parser.add_argument('--configs', default=None, help='comma-separated configs (default: a matrix for --cores)')
+    parser.add_argument('--mix', default=DEFAULT_MIX, help='route weights')
+    parser.add_argument('--users', type=int, default=20)
+    parser.add_argument('--history', type=int, default=500, help='synthetic analyses per seeded user')
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--warmup', type=float, default=5)
+    parser.add_argument('--duration', type=float, default=30, help='measured seconds per config')
+    parser.add_argument('--max-error-rate', type=float, default=0.01, help='errors plus shed requests allowed')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    mix = {}
+    for item in args.mix.split(','):
+        route, _, weight = item.partition('=')
+        mix[route] = float(weight)
+    configs = [parse_config(spec) for spec in (args.configs or default_configs(args.cores)).split(',')]
+
+    directory = tempfile.mkdtemp(prefix='load_test_')
+    seeded = os.path.join(directory, 'seeded.db')
+    result = subprocess.run([sys.executable, __file__, '--seed-db', f"sqlite:///{seeded}", str(args.users),
+                             str(args.history), str(args.seed)], check=True, capture_output=True, text=True)
+    owned = json.loads(result.stdout.strip().splitlines()[-1])
+    print(f"seeded {args.users} users x {args.history} analyses; {args.clients} clients, mix {args.mix}, "
+          f"{args.duration:g}s per config after {args.warmup:g}s warmup")
+
+    summaries = []
+    for index, config in enumerate(configs):
+        # A new file per run: a WAL left by the previous server would be replayed onto the copy
+        database = os.path.join(directory, f"run{index}.db")
+        shutil.copyfile(seeded, database)
+        env = dict(os.environ, DATABASE_URL=f"sqlite:///{database}")
+        server, port = start_server(config, env)
+        peak = [0]
+        stop = threading.Event()
+
+        def sample():
+            while not stop.wait(0.5):
+                peak[0] = max(peak[0], tree_rss(server.pid))
+
+        sampler = threading.Thread(target=sample)
+        sampler.start()
+        try:
+            results = run_load(port, owned, mix, args.clients, args.warmup, args.duration, args.seed)
+        finally:
+            stop.set()
+            sampler.join()
+            server.terminate()
+            server.wait()
+        summary = summarize(config, results, args.duration, peak[0])
+        summaries.append(summary)
+        print(f"\n{config['name']}: {summary['rps']:.1f} req/s, {summary['error_rate']:.1%} errors, "
+              f"{summary['shed_rate']:.1%} shed, peak RSS {summary['peak_rss_mb']:.0f} MB")
+        print_routes(results)
+
+    print(f"\n{'config':>12} {'req/s':>7} {'p50_ms':>8} {'p95_ms':>8} {'p99_ms':>8} {'route_p95':>10} {'errors':>7} "
+          f"{'shed':>6} {'rss_MB':>7}")
+    for summary in summaries:
+        print(f"{summary['config']:>12} {summary['rps']:>7.1f} {summary['p50']:>8.0f} {summary['p95']:>8.0f} "
+              f"{summary['p99']:>8.0f} {summary['route_p95']:>10.0f} {summary['error_rate']:>7.1%} "
+              f"{summary['shed_rate']:>6.1%} {summary['peak_rss_mb']:>7.0f}")
+    recommended = recommend(summaries, configs, args.max_error_rate)
+    if recommended is None:
+        print(f"\nno config stayed under {args.max_error_rate:.0%} errors and shed requests")
+    else:
+        print_profile(*recommended, args.cores)
+
+
+if __name__ == '__main__':
+    if len(sys.argv) == 6 and sys.argv[1] == '--seed-db':
+        seed(sys.argv[2], int(sys.argv[3]), int(sys.argv[4]), int(sys.argv[5]))
+    else:
+        main()
@@ -0,0 +1,128 @@
+"""Load test for the classifier micro-batcher: throughput vs added latency.
+
+Closed-loop clients each submit one image at a time through a MicroBatcher
+and wait for the result. Every (max_batch_size, max_wait_ms) combination is
+measured for the same duration and compared to unbatched calls.
+
+The default backend is synthetic: a batched call costs ``--fixed-ms`` plus
+``--per-item-ms`` per image, runs one call at a time, and sleeps (releases the
+GIL) like a native or GPU forward pass would. ``--backend heuristic`` runs
+SimpleFoodClassifier.predict_batch on synthetic images instead, which shows
+the scheduler overhead on the current CPU-bound heuristic.
+
+    python benchmarks/microbatch_load.py --clients 32 --duration 5
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from batching import MicroBatcher  # noqa: E402
+
+
+def synthetic_backend(fixed_ms, per_item_ms):
+    # One model instance runs one forward pass at a time
+    device = threading.Lock()
+
+    def batch_fn(items):
+        with device:
+            time.sleep((fixed_ms + per_item_ms * len(items)) / 1000.0)
+        return [("Fresh", 90.0, "fruit") for _ in items]
+    return batch_fn
+
+
+def heuristic_backend(count=16):
+    import cv2
+    import numpy as np
+    from predict import SimpleFoodClassifier
+
+    directory = tempfile.mkdtemp(prefix='microbatch_')
+    rng = np.random.default_rng(0)
+    paths = []
+    for i in range(count):
+        path = os.path.join(directory, f"img_{i}.jpg")
+        cv2.imwrite(path, rng.integers(0, 255, (480, 640, 3), dtype=np.uint8))
+        paths.append(path)
+    return SimpleFoodClassifier(microbatch=False).predict_batch, paths
+
+
+def run(batch_fn, items, clients, duration, max_batch_size, max_wait_ms):
+    """Return (throughput, p50_ms, p95_ms, p99_ms, mean_batch) for one setting.
+
+    ``max_batch_size`` of 0 calls ``batch_fn`` directly with one item per request.
+    """
+    batcher = MicroBatcher(batch_fn, max_batch_size, max_wait_ms, name='bench') if max_batch_size else None
+    batch_sizes = []
+    if batcher:
+        def counting_fn(group):
+            batch_sizes.append(len(group))
+            return batch_fn(group)
+        batcher.batch_fn = counting_fn
+
+    latencies = []
+    lock = threading.Lock()
+    stop_at = time.perf_counter() + duration
+
+    def client(index):
+        local = []
+        n = 0
+        while time.perf_counter() < stop_at:
+            item = items[(index + n) % len(items)]
+            n += 1
+            started = time.perf_counter()
+            if batcher:
+                batcher.submit(item).result()
+            else:
+                batch_fn([item])
+            local.append(time.perf_counter() - started)
+        with lock:
+            latencies.extend(local)
+
+    threads = [threading.Thread(target=client, args=(i,)) for i in range(clients)]
+    started = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    latencies.sort()
+    def pct(p):
+        return latencies[min(len(latencies) - 1, int(p * len(latencies)))] * 1000
+    mean_batch = statistics.mean(batch_sizes) if batch_sizes else 1.0
+    return len(latencies) / elapsed, pct(0.50), pct(0.95), pct(0.99), mean_batch
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--backend', choices=('synthetic', 'heuristic'), default='synthetic')
+    parser.add_argument('--clients', type=int, default=32)
+    parser.add_argument('--duration', type=float, default=3.0)
+    parser.add_argument('--fixed-ms', type=float, default=20.0, help='synthetic per-call overhead')
+    parser.add_argument('--per-item-ms', type=float, default=2.0, help='synthetic per-image cost')
+    parser.add_argument('--sizes', default='1,4,8,16,32')
+    parser.add_argument('--waits', default='0,2,5,10')
+    args = parser.parse_args()
+
+    if args.backend == 'synthetic':
+        batch_fn, items = synthetic_backend(args.fixed_ms, args.per_item_ms), list(range(64))
+    else:
+        batch_fn, items = heuristic_backend()
+
+    print(f"backend={args.backend} clients={args.clients} duration={args.duration}s")
+    print(f"{'batch':>6} {'wait_ms':>8} {'req/s':>9} {'p50_ms':>8} {'p95_ms':>8} {'p99_ms':>8} {'mean_batch':>10}")
+    settings = [(0, 0.0)] + [(int(size), float(wait))
+                             for size in args.sizes.split(',') for wait in args.waits.split(',')]
+    for size, wait in settings:
+        throughput, p50, p95, p99, mean_batch = run(batch_fn, items, args.clients, args.duration, size, wait)
+        label = 'none' if size == 0 else str(size)
+        print(f"{label:>6} {wait:>8.1f} {throughput:>9.1f} {p50:>8.1f} {p95:>8.1f} {p99:>8.1f} {mean_batch:>10.2f}")
+
+
+if __name__ == '__main__':
+    main()
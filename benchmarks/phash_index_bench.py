@@ -0,0 +1,80 @@
+"""Benchmark the perceptual-hash index at scale.
+
+Builds a HashIndex over ``--size`` random 64-bit hashes, plants
+near-duplicates at known distances, and reports build time, single-insert
+cost, lookup latency per radius and recall against a brute-force popcount
+scan of the same user's hashes. ``--users 1`` puts every hash under one
+user, the worst case for a per-user lookup.
+
+    python benchmarks/phash_index_bench.py --size 1000000 --users 1000
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np  # noqa: E402
+
+from phash import HashIndex, popcount  # noqa: E402
+
+
+def flip_bits(rng, value, count):
+    for bit in rng.choice(64, size=count, replace=False):
+        value ^= 1 << int(bit)
+    return value
+
+
+def percentile(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(p * len(samples)))] * 1e6
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=1_000_000)
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--radii', default='2,4,6,8,10')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    hashes = rng.integers(0, 2 ** 63, size=args.size, dtype=np.uint64) * np.uint64(2) \
+        + rng.integers(0, 2, size=args.size, dtype=np.uint64)
+    ids = np.arange(1, args.size + 1, dtype=np.int64)
+    users = rng.integers(1, args.users + 1, size=args.size, dtype=np.int64)
+
+    index = HashIndex()
+    started = time.perf_counter()
+    index.add_many(ids, users, hashes)
+    print(f"built index over {args.size:,} hashes ({args.users:,} users) in {time.perf_counter() - started:.2f}s")
+
+    started = time.perf_counter()
+    for i in range(1000):
+        index.add(args.size + 1 + i, int(users[i]), int(rng.integers(0, 2 ** 63)))
+    print(f"single insert: {(time.perf_counter() - started) * 1e3:.3f} us/hash (pending buffer)")
+
+    print(f"{'radius':>6} {'p50_us':>9} {'p99_us':>9} {'brute_p50_us':>13} {'recall':>7}")
+    for radius in (int(r) for r in args.radii.split(',')):
+        targets = rng.integers(0, args.size, size=args.queries)
+        queries = [flip_bits(rng, int(hashes[t]), int(rng.integers(0, radius + 1))) for t in targets]
+        index_times, brute_times = [], []
+        found = 0
+        for target, query in zip(targets, queries):
+            started = time.perf_counter()
+            user_id = int(users[target])
+            results = index.search(query, user_id, radius)
+            index_times.append(time.perf_counter() - started)
+
+            started = time.perf_counter()
+            brute = np.flatnonzero((popcount(hashes ^ np.uint64(query)) <= radius) & (users == user_id))
+            brute_times.append(time.perf_counter() - started)
+
+            found += {int(i) for i in ids[brute]} <= {analysis_id for analysis_id, _ in results} or len(brute) > 10
+        print(f"{radius:>6} {percentile(index_times, 0.5):>9.1f} {percentile(index_times, 0.99):>9.1f} "
+              f"{percentile(brute_times, 0.5):>13.1f} {found / args.queries:>7.3f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,100 @@
+"""Benchmark re-scoring history from stored feature vectors.
+
+Fills a throwaway SQLite database with ``--rows`` analyses carrying
+synthetic feature vectors, then times a dry-run and an applied
+``rescore_analyses`` with shifted cutoffs. For comparison it also times
+``extract_features`` on a few synthetic photos and extrapolates what
+re-running the heuristic over every image would cost.
+
+    python benchmarks/rescore_bench.py --rows 1000000
+"""
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np  # noqa: E402
+
+
+def synthetic_features(rng, count):
+    from predict import FEATURE_NAMES
+    features = np.empty((count, len(FEATURE_NAMES)), dtype=np.float32)
+    features[:, 0] = rng.uniform(0, 180, count)
+    features[:, 1] = rng.uniform(0, 255, count)
+    features[:, 2] = rng.uniform(0, 255, count)
+    features[:, 3:6] = rng.beta(1, 12, (count, 3))
+    features[:, 6:10] = rng.beta(1.5, 4, (count, 4))
+    return features
+
+
+def populate(db_path, rows, rng, chunk=100_000):
+    from predict import DEFAULT_THRESHOLDS
+    from rescore import default_scorer
+
+    conn = sqlite3.connect(db_path)
+    for start in range(0, rows, chunk):
+        features = synthetic_features(rng, min(chunk, rows - start))
+        labels, food_types = default_scorer(features, DEFAULT_THRESHOLDS)
+        conn.executemany(
+            "INSERT INTO analysis (user_id, image_filename, label, confidence, food_type, features, timestamp) "
+            "VALUES (1, 'bench.jpg', ?, 85.0, ?, ?, '2024-01-01 00:00:00')",
+            ((str(label), str(food_type), row.tobytes()) for label, food_type, row in zip(labels, food_types, features))
+        )
+        conn.commit()
+    conn.close()
+
+
+def time_extraction(samples):
+    import cv2
+    from predict import extract_features
+
+    directory = tempfile.mkdtemp(prefix='rescore_bench_')
+    rng = np.random.default_rng(1)
+    paths = []
+    for i in range(samples):
+        path = os.path.join(directory, f"photo_{i}.jpg")
+        cv2.imwrite(path, rng.integers(0, 255, (1536, 2048, 3), dtype=np.uint8))
+        paths.append(path)
+    started = time.perf_counter()
+    for path in paths:
+        extract_features(path)
+    return (time.perf_counter() - started) / samples
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--rows', type=int, default=1_000_000)
+    parser.add_argument('--samples', type=int, default=10, help='images timed for the decode comparison')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='rescore_bench_')
+    db_path = os.path.join(directory, 'bench.db')
+    os.environ['DATABASE_URL'] = f"sqlite:///{db_path}"
+    from app import app
+    from predict import merge_thresholds
+    from rescore import rescore_analyses
+
+    started = time.perf_counter()
+    populate(db_path, args.rows, np.random.default_rng(0))
+    print(f"populated {args.rows} rows in {time.perf_counter() - started:.1f}s ({db_path})")
+
+    thresholds = merge_thresholds({'labels': {'default': {'fresh': 65, 'okay': 40}}})
+    with app.app_context():
+        for apply in (False, True):
+            summary = rescore_analyses(thresholds=thresholds, apply=apply)
+            total = summary['load_seconds'] + summary['score_seconds'] + summary['write_seconds']
+            print(f"{'apply' if apply else 'dry-run':>8}: {summary['rows']} rows, {summary['changed']} changed | "
+                  f"load {summary['load_seconds']:.2f}s score {summary['score_seconds']:.3f}s "
+                  f"write {summary['write_seconds']:.2f}s | {summary['rows'] / total:,.0f} rows/s")
+
+    per_image = time_extraction(args.samples)
+    print(f"re-decoding instead: {per_image * 1000:.1f} ms/image -> ~{per_image * args.rows / 3600:.1f} h "
+          f"for {args.rows} images on one core")
+
+
+if __name__ == '__main__':
+    main()
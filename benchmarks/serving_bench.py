@@ -0,0 +1,228 @@
+"""Concurrent-connection capacity of the sync and async serving modes.
+
+Starts gunicorn with ``gunicorn.conf.py`` once per ``SERVING_MODE`` (same
+``--workers``) against a scratch SQLite database and measures two things:
+
+- Slow clients: ``--slow`` connections each upload a ``--slow-kb`` body
+  spread over ``--slow-seconds`` (a phone on a bad network). Meanwhile
+  ``--probes`` clients request ``/`` in a loop. The table shows how many
+  probe requests were answered, their latency, and how many timed out.
+  A sync worker is tied up for the whole upload; the async mode receives
+  it on the event loop.
+- CPU-bound uploads: ``--clients`` clients post one synthetic image to
+  ``/predict`` at a time, for throughput and latency of the analysis path.
+  Each client logs in as its own user and backs off for ``Retry-After``
+  when admission control answers 429/503. The images are saved under
+  static/uploads like any other upload.
+
+    python benchmarks/serving_bench.py --workers 2 --slow 0,8,32,128
+"""
+import argparse
+import http.client
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from collections import Counter
+from urllib.parse import urlencode
+
+import cv2
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def request(port, method, path, body=None, headers=None, timeout=10):
+    """``(status, headers, seconds)``; ``status`` is None on a timeout or connection error."""
+    started = time.perf_counter()
+    connection = http.client.HTTPConnection('127.0.0.1', port, timeout=timeout)
+    try:
+        connection.request(method, path, body=body, headers=headers or {})
+        response = connection.getresponse()
+        response.read()
+        return response.status, response.headers, time.perf_counter() - started
+    except OSError:
+        return None, None, time.perf_counter() - started
+    finally:
+        connection.close()
+
+
+def start_server(mode, workers, env):
+    port = free_port()
+    env = dict(env, SERVING_MODE=mode, WEB_CONCURRENCY=str(workers))
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', '-b', f'127.0.0.1:{port}'],
+                              cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    deadline = time.perf_counter() + 60
+    while time.perf_counter() < deadline:
+        if request(port, 'GET', '/', timeout=1)[0] == 200:
+            return server, port
+        time.sleep(0.1)
+    server.terminate()
+    raise RuntimeError(f'gunicorn ({mode}) did not answer in time')
+
+
+def login(port):
+    form = {'Content-Type': 'application/x-www-form-urlencoded'}
+    username = f"bench_{uuid.uuid4().hex[:8]}"
+    request(port, 'POST', '/auth/register', urlencode({'username': username, 'email': f"{username}@example.com",
+                                                        'password': 'bench'}), form)
+    _, headers, _ = request(port, 'POST', '/auth/login', urlencode({'username': username, 'password': 'bench'}), form)
+    return headers['Set-Cookie'].split(';', 1)[0]
+
+
+def percentile(values, fraction):
+    return values[min(len(values) - 1, int(len(values) * fraction))] * 1000 if values else float('nan')
+
+
+def slow_uploads(port, count, size, seconds, stop):
+    """Open ``count`` connections and trickle a ``size``-byte body to each over ``seconds``."""
+    sockets = []
+    for _ in range(count):
+        try:
+            sock = socket.create_connection(('127.0.0.1', port), timeout=5)
+            sock.sendall(f"POST /auth/login HTTP/1.1\r\nHost: bench\r\nContent-Type: application/x-www-form-urlencoded\r\n"
+                         f"Content-Length: {size}\r\nConnection: close\r\n\r\n".encode())
+            sockets.append(sock)
+        except OSError:
+            break
+    ticks = max(1, int(seconds / 0.1))
+    # A form body, so the login view reads all of it
+    chunk = b'x' * -(-size // ticks)
+    sent = 0
+    for _ in range(ticks):
+        if stop.is_set():
+            break
+        time.sleep(0.1)
+        for sock in sockets:
+            try:
+                sock.sendall(chunk[:size - sent])
+            except OSError:
+                pass
+        sent = min(size, sent + len(chunk))
+    for sock in sockets:
+        sock.close()
+    return len(sockets)
+
+
+def probe(port, seconds, clients):
+    """Closed-loop GET / from ``clients`` threads; returns (latencies, failures)."""
+    latencies, failures = [], []
+    deadline = time.perf_counter() + seconds
+
+    def run():
+        while time.perf_counter() < deadline:
+            status, _, elapsed = request(port, 'GET', '/', timeout=5)
+            (latencies if status == 200 else failures).append(elapsed)
+
+    threads = [threading.Thread(target=run) for _ in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sorted(latencies), failures
+
+
+def image_body():
+    rng = np.random.default_rng(0)
+    image = np.full((960, 1280, 3), (40, 160, 60), np.uint8)
+    image[200:500, 300:700] = rng.integers(0, 255, (300, 400, 3), dtype=np.uint8)
+    boundary = uuid.uuid4().hex
+    data = cv2.imencode('.jpg', image)[1].tobytes()
+    body = (f"--{boundary}\r\nContent-Disposition: form-data; name=\"images\"; filename=\"bench.jpg\"\r\n"
+            f"Content-Type: image/jpeg\r\n\r\n").encode() + data + f"\r\n--{boundary}--\r\n".encode()
+    return body, f"multipart/form-data; boundary={boundary}"
+
+
+def predict_load(port, clients, seconds):
+    """Closed-loop /predict uploads, each client as its own user (admission allows 2 in flight per user)."""
+    body, content_type = image_body()
+    cookies = [login(port) for _ in range(clients)]
+    latencies, errors = [], []
+    deadline = time.perf_counter() + seconds
+
+    def run(cookie):
+        headers = {'Content-Type': content_type, 'Cookie': cookie}
+        while time.perf_counter() < deadline:
+            status, response_headers, elapsed = request(port, 'POST', '/predict', body, headers, timeout=60)
+            if status == 302:
+                latencies.append(elapsed)
+                continue
+            errors.append(status)
+            # Back off like a well-behaved client when admission control turns the upload away
+            if status in (429, 503):
+                time.sleep(min(float(response_headers.get('Retry-After', 1)), max(0, deadline - time.perf_counter())))
+
+    threads = [threading.Thread(target=run, args=(cookie,)) for cookie in cookies]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return sorted(latencies), errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--modes', default='sync,async')
+    parser.add_argument('--workers', type=int, default=2, help='gunicorn worker processes in every mode')
+    parser.add_argument('--slow', default='0,8,32,128', help='slow upload connections per run (comma separated)')
+    parser.add_argument('--slow-kb', type=int, default=256)
+    parser.add_argument('--slow-seconds', type=float, default=8)
+    parser.add_argument('--probes', type=int, default=4, help='clients requesting / during the slow uploads')
+    parser.add_argument('--clients', type=int, default=8, help='concurrent /predict clients')
+    parser.add_argument('--duration', type=float, default=15, help='seconds of /predict load')
+    args = parser.parse_args()
+
+    directory = tempfile.mkdtemp(prefix='serving_bench_')
+    env = dict(os.environ, DATABASE_URL=f"sqlite:///{os.path.join(directory, 'bench.db')}")
+    subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', 'init-db'], cwd=ROOT, env=env,
+                   check=True, capture_output=True)
+
+    print(f"{args.workers} workers; slow uploads of {args.slow_kb} KB over {args.slow_seconds:g}s, "
+          f"{args.probes} clients requesting / meanwhile")
+    print(f"{'mode':>6} {'slow':>5} {'held':>5} {'/ ok':>6} {'req/s':>7} {'p50_ms':>8} {'p99_ms':>8} {'timeouts':>9}")
+    predict_rows = []
+    for mode in args.modes.split(','):
+        server, port = start_server(mode, args.workers, env)
+        try:
+            for count in (int(value) for value in args.slow.split(',')):
+                stop = threading.Event()
+                held = []
+                uploader = threading.Thread(target=lambda: held.append(
+                    slow_uploads(port, count, args.slow_kb * 1024, args.slow_seconds, stop)))
+                uploader.start()
+                # Let the slow connections get accepted before probing
+                time.sleep(0.5)
+                latencies, failures = probe(port, args.slow_seconds - 1, args.probes)
+                stop.set()
+                uploader.join()
+                print(f"{mode:>6} {count:>5} {held[0]:>5} {len(latencies):>6} "
+                      f"{len(latencies) / (args.slow_seconds - 1):>7.1f} {percentile(latencies, 0.5):>8.1f} "
+                      f"{percentile(latencies, 0.99):>8.1f} {len(failures):>9}")
+                # Wait for the server to drain the aborted uploads
+                time.sleep(1)
+
+            latencies, errors = predict_load(port, args.clients, args.duration)
+            predict_rows.append((mode, latencies, errors))
+        finally:
+            server.terminate()
+            server.wait()
+
+    print(f"\n/predict, {args.clients} clients for {args.duration:g}s, one {args.workers}-worker server per mode")
+    print(f"{'mode':>6} {'ok':>6} {'img/s':>7} {'p50_ms':>8} {'p95_ms':>8}  errors by status")
+    for mode, latencies, errors in predict_rows:
+        print(f"{mode:>6} {len(latencies):>6} {len(latencies) / args.duration:>7.2f} {percentile(latencies, 0.5):>8.0f} "
+              f"{percentile(latencies, 0.95):>8.0f}  {dict(Counter(errors)) or '-'}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,84 @@
+"""Benchmark similar-analysis search at a million vectors.
+
+Builds one user's VectorIndex from ``--size`` clustered synthetic
+embeddings and reports IVF training time, query latency for brute force
+and for the IVF index at several ``nprobe`` settings, recall@k against
+brute force, and the cost of incremental inserts.
+
+    python benchmarks/similarity_bench.py --size 1000000
+"""
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import numpy as np  # noqa: E402
+
+import similarity  # noqa: E402
+from similarity import EMBEDDING_DIM, VectorIndex, _top_k  # noqa: E402
+
+
+def synthetic_embeddings(rng, count, clusters=500):
+    centers = rng.random((clusters, EMBEDDING_DIM), dtype=np.float32) ** 3
+    vectors = centers[rng.integers(0, clusters, count)] + rng.normal(0, 0.05, (count, EMBEDDING_DIM)).astype(np.float32)
+    np.maximum(vectors, 0, out=vectors)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    return vectors
+
+
+def percentile_ms(samples, p):
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(p * len(samples)))] * 1000
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=1_000_000)
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('-k', type=int, default=10)
+    parser.add_argument('--nprobes', default='1,4,8,16,32')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    vectors = synthetic_embeddings(rng, args.size)
+    ids = np.arange(1, args.size + 1, dtype=np.int64)
+
+    index = VectorIndex()
+    started = time.perf_counter()
+    index.add_many(ids, vectors)
+    index.train()
+    print(f"{args.size:,} vectors x {EMBEDDING_DIM} dims: built in {time.perf_counter() - started:.2f}s "
+          f"({0 if index.centroids is None else len(index.centroids)} IVF lists)")
+
+    queries = synthetic_embeddings(rng, args.queries)
+    brute_times, truth = [], []
+    for query in queries:
+        started = time.perf_counter()
+        truth.append({i for i, _ in _top_k(ids, vectors @ query, args.k)})
+        brute_times.append(time.perf_counter() - started)
+    print(f"{'mode':>10} {'p50_ms':>8} {'p99_ms':>8} {'recall@' + str(args.k):>10}")
+    print(f"{'brute':>10} {percentile_ms(brute_times, 0.5):>8.2f} {percentile_ms(brute_times, 0.99):>8.2f} {1.0:>10.3f}")
+
+    for nprobe in (int(n) for n in args.nprobes.split(',')):
+        similarity.SIMILAR_NPROBE = nprobe
+        times, hits = [], 0
+        for query, expected in zip(queries, truth):
+            started = time.perf_counter()
+            found = index.search(query, args.k)
+            times.append(time.perf_counter() - started)
+            hits += len(expected & {i for i, _ in found})
+        print(f"{'nprobe=' + str(nprobe):>10} {percentile_ms(times, 0.5):>8.2f} {percentile_ms(times, 0.99):>8.2f} "
+              f"{hits / (args.k * len(queries)):>10.3f}")
+
+    extra = synthetic_embeddings(rng, 10_000)
+    started = time.perf_counter()
+    for i, vector in enumerate(extra):
+        index.add(args.size + 1 + i, vector)
+    print(f"incremental insert: {(time.perf_counter() - started) * 1e6 / len(extra):.1f} us/vector "
+          f"(tail merged every {similarity.MERGE_THRESHOLD})")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,142 @@
+"""Measure worker startup: import cost of ``app`` and time to the first served request.
+
+Runs ``python -X importtime -c "import app"`` in a fresh interpreter and
+prints the slowest top-level imports, then times fresh processes from
+spawn to the first ``GET /`` answered (through the Flask test client, or a
+real gunicorn worker with ``--gunicorn``). The database is bootstrapped
+once beforehand, the way the release step does it.
+
+Used as a regression guard, it exits non-zero if ``app`` pulls in any of
+``--forbid`` at import time, or if the import takes longer than
+``--max-import-ms``.
+
+    python benchmarks/startup_bench.py --runs 5 --max-import-ms 1500
+"""
+import argparse
+import os
+import re
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import urllib.request
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+IMPORTTIME_LINE = re.compile(r'import time:\s+(\d+) \|\s+(\d+) \|(\s+)(\S+)')
+# Only needed by the report, email and camera routes
+DEFAULT_FORBIDDEN = 'reportlab,qrcode,smtplib,camera,pdf_generator,email_sender'
+
+FIRST_REQUEST = """
+import time
+started = time.perf_counter()
+from app import app
+imported = time.perf_counter()
+response = app.test_client().get('/')
+assert response.status_code == 200, response.status_code
+print(imported - started, time.perf_counter() - imported)
+"""
+
+
+def run_env(database_url):
+    env = dict(os.environ, DATABASE_URL=database_url, PYTHONPATH=ROOT)
+    env.pop('AUTO_INIT_DB', None)
+    return env
+
+
+def import_breakdown(env):
+    """``(total_us, {module: (self_us, cumulative_us)}, {direct_import: cumulative_us})`` for ``import app``."""
+    result = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'],
+                            cwd=ROOT, env=env, capture_output=True, text=True, check=True)
+    modules = {}
+    top_level = {}
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_LINE.match(line)
+        if not match:
+            continue
+        self_us, cumulative_us, indent, name = int(match[1]), int(match[2]), len(match[3]), match[4]
+        modules[name] = (self_us, cumulative_us)
+        # Direct imports of ``app`` are indented by three spaces
+        if indent == 3:
+            top_level[name] = cumulative_us
+    return modules.get('app', (0, 0))[1], modules, top_level
+
+
+def first_request_testclient(env):
+    started = time.perf_counter()
+    result = subprocess.run([sys.executable, '-c', FIRST_REQUEST], cwd=ROOT, env=env,
+                            capture_output=True, text=True, check=True)
+    total = time.perf_counter() - started
+    import_s, request_s = (float(v) for v in result.stdout.split()[-2:])
+    return total, import_s, request_s
+
+
+def free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def first_request_gunicorn(env, timeout=60):
+    port = free_port()
+    started = time.perf_counter()
+    server = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-w', '1', '-b', f'127.0.0.1:{port}', 'app:app'],
+                              cwd=ROOT, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.perf_counter() - started < timeout:
+            try:
+                with urllib.request.urlopen(f'http://127.0.0.1:{port}/', timeout=1) as response:
+                    if response.status == 200:
+                        return time.perf_counter() - started
+            except OSError:
+                time.sleep(0.02)
+        raise RuntimeError('gunicorn did not answer in time')
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--top', type=int, default=12, help='slowest direct imports to list')
+    parser.add_argument('--gunicorn', action='store_true', help='also time a real gunicorn worker')
+    parser.add_argument('--forbid', default=DEFAULT_FORBIDDEN, help='modules that must stay lazy (comma separated)')
+    parser.add_argument('--max-import-ms', type=float, default=None, help='fail if importing app takes longer')
+    args = parser.parse_args()
+
+    database = os.path.join(tempfile.mkdtemp(prefix='startup_bench_'), 'bench.db')
+    env = run_env(f'sqlite:///{database}')
+    subprocess.run([sys.executable, '-m', 'flask', '--app', 'app', 'init-db'], cwd=ROOT, env=env,
+                   check=True, capture_output=True)
+
+    totals = []
+    for _ in range(args.runs):
+        totals.append(import_breakdown(env))
+    totals.sort(key=lambda item: item[0])
+    total_us, modules, top_level = totals[len(totals) // 2]
+    print(f"import app: {total_us / 1000:.1f} ms (median of {args.runs}, -X importtime)")
+    for name, cumulative_us in sorted(top_level.items(), key=lambda item: -item[1])[:args.top]:
+        print(f"  {cumulative_us / 1000:8.1f} ms  {name}")
+
+    samples = sorted(first_request_testclient(env) for _ in range(args.runs))
+    total, import_s, request_s = samples[len(samples) // 2]
+    print(f"spawn -> first response (test client): {total * 1000:.0f} ms "
+          f"(import {import_s * 1000:.0f} ms, first request {request_s * 1000:.1f} ms)")
+    if args.gunicorn:
+        boots = sorted(first_request_gunicorn(env) for _ in range(args.runs))
+        print(f"spawn -> first response (gunicorn, 1 worker): {boots[len(boots) // 2] * 1000:.0f} ms")
+
+    failures = []
+    forbidden = [name for name in args.forbid.split(',') if name and name in modules]
+    if forbidden:
+        failures.append(f"imported at startup: {', '.join(forbidden)}")
+    if args.max_import_ms is not None and total_us / 1000 > args.max_import_ms:
+        failures.append(f"import took {total_us / 1000:.0f} ms > {args.max_import_ms:.0f} ms")
+    for failure in failures:
+        print(f"FAIL: {failure}")
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -5,3 +5,6 @@ pip install --upgrade pip
 pip install -r requirements.txt
 
 mkdir -p static/uploads static/reports static/profiles instance
+
+# Schema changes and the admin seed run here, not on every worker boot
+flask --app app init-db
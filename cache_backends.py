@@ -0,0 +1,111 @@
+"""Small key/value caches with per-entry TTLs.
+
+``MemoryCache`` is a per-process LRU dict. ``RedisCache`` shares entries
+between gunicorn workers and hosts; it needs the optional ``redis``
+package and is chosen by ``make_cache`` when ``CACHE_URL`` is a
+``redis://`` URL. Both store JSON-serialisable values only, so anything
+cached reads back the same from either backend.
+"""
+import json
+import os
+import threading
+import time
+from collections import OrderedDict
+
+CACHE_URL = os.environ.get('CACHE_URL', '')
+
+
+class MemoryCache:
+    def __init__(self, max_entries=10000):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires, value = entry
+            if expires is not None and expires <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        expires = time.monotonic() + ttl if ttl else None
+        with self._lock:
+            self._entries[key] = (expires, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def incr(self, key):
+        """Atomically add one to an integer entry (missing counts as 0) and return it."""
+        with self._lock:
+            _, value = self._entries.get(key, (None, 0))
+            self._entries[key] = (None, value + 1)
+            self._entries.move_to_end(key)
+            return value + 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class RedisCache:
+    """Redis-backed cache. Connection errors are logged and treated as misses, never raised."""
+
+    def __init__(self, url, prefix='food:'):
+        import redis
+
+        self.prefix = prefix
+        self._client = redis.Redis.from_url(url, socket_timeout=0.5, socket_connect_timeout=0.5)
+        self._errors = redis.RedisError
+
+    def get(self, key):
+        try:
+            raw = self._client.get(self.prefix + key)
+        except self._errors as e:
+            print(f"Cache get error: {str(e)}")
+            return None
+        return None if raw is None else json.loads(raw)
+
+    def set(self, key, value, ttl=None):
+        try:
+            self._client.set(self.prefix + key, json.dumps(value), ex=max(1, int(ttl)) if ttl else None)
+        except self._errors as e:
+            print(f"Cache set error: {str(e)}")
+
+    def delete(self, key):
+        try:
+            self._client.delete(self.prefix + key)
+        except self._errors as e:
+            print(f"Cache delete error: {str(e)}")
+
+    def incr(self, key):
+        try:
+            return int(self._client.incr(self.prefix + key))
+        except self._errors as e:
+            print(f"Cache incr error: {str(e)}")
+            return None
+
+    def clear(self):
+        for key in self._client.scan_iter(match=self.prefix + '*'):
+            self._client.delete(key)
+
+
+def make_cache(namespace, max_entries=10000, url=None):
+    """A shared cache for ``namespace`` if ``CACHE_URL`` points at Redis, else an in-process one."""
+    url = CACHE_URL if url is None else url
+    if url.startswith(('redis://', 'rediss://', 'unix://')):
+        try:
+            return RedisCache(url, prefix=f"food:{namespace}:")
+        except ImportError:
+            print("Cache backend error: CACHE_URL is set but the redis package is not installed")
+    return MemoryCache(max_entries)
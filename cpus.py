@@ -0,0 +1,33 @@
+"""How many CPUs this process may actually use.
+
+``os.cpu_count()`` reports every core of the host, but containers usually
+run under a CPU affinity mask or a cgroup CPU quota. Worker counts and
+pool sizes (gunicorn.conf.py, offload.py, admission.py) come from
+``available_cores`` instead.
+"""
+import math
+import os
+
+
+def available_cores():
+    """CPUs this process can use: its affinity mask, capped by a cgroup v2 or v1 CPU quota."""
+    try:
+        cores = len(os.sched_getaffinity(0))
+    except AttributeError:
+        cores = os.cpu_count() or 1
+    quotas = (('/sys/fs/cgroup/cpu.max', None),
+              ('/sys/fs/cgroup/cpu/cpu.cfs_quota_us', '/sys/fs/cgroup/cpu/cpu.cfs_period_us'))
+    for quota_path, period_path in quotas:
+        try:
+            with open(quota_path) as f:
+                fields = f.read().split()
+            if period_path:
+                with open(period_path) as f:
+                    fields.append(f.read().strip())
+        except OSError:
+            continue
+        # "max" (v2) or -1 (v1) means no quota
+        if fields[0] not in ('max', '-1'):
+            cores = min(cores, math.ceil(int(fields[0]) / int(fields[1])))
+        break
+    return max(cores, 1)
@@ -0,0 +1,108 @@
+"""Named database engine profiles.
+
+``DB_PROFILE`` picks how the SQLAlchemy engine is tuned:
+
+``sqlite``
+    WAL journal so readers no longer block the writer, ``synchronous=NORMAL``
+    (durable at checkpoints, not every commit), a busy timeout so concurrent
+    writers from several gunicorn workers wait for the lock instead of
+    failing with "database is locked", and memory-mapped reads.
+``postgres``
+    A bounded connection pool with overflow, recycling, pre-ping so a
+    connection dropped by the server is replaced before use, and a
+    server-side statement timeout.
+``default``
+    SQLAlchemy's own defaults, as before.
+
+The default, ``auto``, picks ``sqlite`` or ``postgres`` from the
+``DATABASE_URL`` scheme. The individual settings are read from the
+environment variables below.
+"""
+import os
+
+from sqlalchemy import event
+
+import metrics
+
+DB_PROFILE = os.environ.get('DB_PROFILE', 'auto')
+
+SQLITE_BUSY_TIMEOUT_MS = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 10000))
+SQLITE_SYNCHRONOUS = os.environ.get('SQLITE_SYNCHRONOUS', 'NORMAL')
+SQLITE_MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+SQLITE_CACHE_SIZE_KB = int(os.environ.get('SQLITE_CACHE_SIZE_KB', 16000))
+
+DB_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', 5))
+DB_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', 10))
+DB_POOL_RECYCLE = int(os.environ.get('DB_POOL_RECYCLE', 1800))
+DB_POOL_TIMEOUT = int(os.environ.get('DB_POOL_TIMEOUT', 10))
+DB_STATEMENT_TIMEOUT_MS = int(os.environ.get('DB_STATEMENT_TIMEOUT_MS', 30000))
+
+PROFILES = ('default', 'sqlite', 'postgres')
+
+
+def resolve_profile(url, profile=None):
+    profile = profile or DB_PROFILE
+    if profile == 'auto':
+        if url.startswith('sqlite'):
+            return 'sqlite'
+        if url.startswith(('postgresql', 'postgres')):
+            return 'postgres'
+        return 'default'
+    if profile not in PROFILES:
+        raise ValueError(f"Unknown DB_PROFILE {profile!r}; expected auto or one of {', '.join(PROFILES)}")
+    return profile
+
+
+def engine_options(profile):
+    """Keyword arguments for ``create_engine`` under ``profile``."""
+    if profile == 'sqlite':
+        # pysqlite's own lock wait, in seconds; the PRAGMA below covers other drivers
+        return {'connect_args': {'timeout': SQLITE_BUSY_TIMEOUT_MS / 1000}}
+    if profile == 'postgres':
+        options = {
+            'pool_size': DB_POOL_SIZE,
+            'max_overflow': DB_MAX_OVERFLOW,
+            'pool_recycle': DB_POOL_RECYCLE,
+            'pool_timeout': DB_POOL_TIMEOUT,
+            'pool_pre_ping': True,
+        }
+        if DB_STATEMENT_TIMEOUT_MS > 0:
+            options['connect_args'] = {'options': f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"}
+        return options
+    return {}
+
+
+def _sqlite_on_connect(dbapi_connection, connection_record):
+    cursor = dbapi_connection.cursor()
+    try:
+        cursor.execute(f"PRAGMA busy_timeout={SQLITE_BUSY_TIMEOUT_MS}")
+        # WAL needs a real file; in-memory databases report "memory" and keep going
+        cursor.execute("PRAGMA journal_mode=WAL")
+        cursor.execute(f"PRAGMA synchronous={SQLITE_SYNCHRONOUS}")
+        cursor.execute(f"PRAGMA mmap_size={SQLITE_MMAP_SIZE}")
+        cursor.execute(f"PRAGMA cache_size=-{SQLITE_CACHE_SIZE_KB}")
+        cursor.execute("PRAGMA temp_store=MEMORY")
+    except Exception as e:
+        print(f"SQLite profile error: {str(e)}")
+    finally:
+        cursor.close()
+
+
+def install_profile(engine, profile):
+    """Attach the per-connection setup ``profile`` needs to ``engine``."""
+    if profile == 'sqlite':
+        event.listen(engine, 'connect', _sqlite_on_connect)
+
+
+def init_db_profile(app, db, profile=None):
+    """Apply the engine profile for ``app``'s database, then bind ``db`` to ``app``."""
+    profile = resolve_profile(app.config['SQLALCHEMY_DATABASE_URI'], profile)
+    options = engine_options(profile)
+    options.update(app.config.get('SQLALCHEMY_ENGINE_OPTIONS', {}))
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = options
+    db.init_app(app)
+    with app.app_context():
+        install_profile(db.engine, profile)
+    app.config['DB_PROFILE'] = profile
+    metrics.set_gauge("food_db_profile_info", 1, profile=profile)
+    return profile
@@ -0,0 +1,170 @@
+"""Per-user digest emails summarising a period of analyses.
+
+Instead of one email and one PDF per analysis, ``send_digests`` sends each
+user with an email address one summary for the period:
+counts by label and by food type, built from a single GROUP BY query over
+all users. With ``attach_pdf`` a second query streams the period's rows
+ordered by user, and each digest gets one PDF listing its items (at most
+``DIGEST_MAX_ITEMS``). All messages go out over one reused SMTP connection.
+
+Run it from cron with ``flask send-digests``; ``--smtp-server`` and
+``--smtp-port`` point it at a local stand-in for testing.
+"""
+import io
+import os
+import smtplib
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, select
+
+import metrics
+from archive import select_analyses
+from auth import db, User
+from email_sender import SMTPSession, build_message, generate_digest_body
+
+DIGEST_MAX_ITEMS = int(os.environ.get('DIGEST_MAX_ITEMS', 500))
+# Give up on the run after this many sends fail in a row (e.g. the SMTP server is down)
+MAX_CONSECUTIVE_FAILURES = 5
+
+
+def digest_period(days=1, end=None):
+    """``(start, end)`` covering the ``days`` whole UTC days before ``end`` (default: today)."""
+    end = end or datetime.utcnow()
+    end = end.replace(hour=0, minute=0, second=0, microsecond=0)
+    return end - timedelta(days=days), end
+
+
+def format_period(start, end):
+    last_day = end - timedelta(days=1)
+    if last_day.date() == start.date():
+        return start.strftime('%Y-%m-%d')
+    return f"{start.strftime('%Y-%m-%d')} to {last_day.strftime('%Y-%m-%d')}"
+
+
+def collect_digests(start, end, user_id=None):
+    """One digest dict per user with an email address and analyses in ``[start, end)``."""
+    def build(table):
+        query = (select(table.c.user_id, table.c.label, table.c.food_type, table.c.confidence)
+                 .where(table.c.timestamp >= start, table.c.timestamp < end))
+        if user_id is not None:
+            query = query.where(table.c.user_id == user_id)
+        return query
+
+    analysis, user = select_analyses(build, start).subquery(), User.__table__
+    food_type = func.coalesce(analysis.c.food_type, 'unknown')
+    query = (select(user.c.id, user.c.username, user.c.email, analysis.c.label, food_type,
+                    func.count(), func.avg(analysis.c.confidence))
+             .join(user, user.c.id == analysis.c.user_id)
+             .where(user.c.email.isnot(None), user.c.email != '')
+             .group_by(user.c.id, user.c.username, user.c.email, analysis.c.label, food_type)
+             .order_by(user.c.id))
+
+    period = format_period(start, end)
+    digests = {}
+    for uid, username, email, label, food, count, avg_confidence in db.session.execute(query):
+        digest = digests.get(uid)
+        if digest is None:
+            digest = digests[uid] = {'user_id': uid, 'username': username, 'email': email, 'period': period,
+                                     'total': 0, 'labels': {}, 'food_types': {}}
+        digest['total'] += count
+        digest['labels'][label] = digest['labels'].get(label, 0) + count
+        row = digest['food_types'].setdefault(food, {'food_type': food, 'total': 0, 'Fresh': 0, 'Okay': 0,
+                                                     'Avoid': 0, 'confidence_sum': 0.0})
+        row['total'] += count
+        row[label] = row.get(label, 0) + count
+        row['confidence_sum'] += float(avg_confidence or 0) * count
+
+    for digest in digests.values():
+        rows = sorted(digest['food_types'].values(), key=lambda r: -r['total'])
+        for row in rows:
+            row['avg_confidence'] = row.pop('confidence_sum') / row['total']
+        digest['food_types'] = rows
+    return list(digests.values())
+
+
+def iter_items(start, end, user_id=None, limit=DIGEST_MAX_ITEMS, chunk_size=5000):
+    """``(user_id, [item, ...])`` for each user, newest first, streamed from one ordered query."""
+    def build(table):
+        query = (select(table.c.user_id, table.c.timestamp, table.c.label, table.c.confidence, table.c.food_type)
+                 .where(table.c.timestamp >= start, table.c.timestamp < end))
+        if user_id is not None:
+            query = query.where(table.c.user_id == user_id)
+        return query
+
+    query = select_analyses(build, start)
+    columns = query.selected_columns
+    query = query.order_by(columns.user_id, columns.timestamp.desc()).execution_options(yield_per=chunk_size)
+
+    current, items = None, []
+    for uid, timestamp, label, confidence, food_type in db.session.execute(query):
+        if uid != current:
+            if current is not None:
+                yield current, items
+            current, items = uid, []
+        if len(items) < limit:
+            items.append({'timestamp': timestamp, 'label': label, 'confidence': confidence, 'food_type': food_type})
+    if current is not None:
+        yield current, items
+
+
+def send_digests(days=1, end=None, attach_pdf=False, user_id=None, dry_run=False,
+                 smtp_server=None, smtp_port=None):
+    """Build and send the digests for the period; returns a throughput summary."""
+    started = time.perf_counter()
+    start, end = digest_period(days, end)
+    with metrics.stage("digest.query"):
+        digests = collect_digests(start, end, user_id)
+    query_seconds = time.perf_counter() - started
+
+    items_by_user = {}
+    if attach_pdf and digests:
+        wanted = {digest['user_id'] for digest in digests}
+        with metrics.stage("digest.items"):
+            items_by_user = {uid: items for uid, items in iter_items(start, end, user_id) if uid in wanted}
+
+    summary = {'users': len(digests), 'analyses': sum(d['total'] for d in digests), 'sent': 0, 'failed': 0,
+               'attachment_bytes': 0, 'connections': 0, 'query_seconds': query_seconds,
+               'render_seconds': 0.0, 'send_seconds': 0.0}
+    consecutive_failures = 0
+    with SMTPSession(smtp_server, smtp_port) as session:
+        for digest in digests:
+            render_started = time.perf_counter()
+            attachments = []
+            if attach_pdf:
+                # ReportLab is slow to import; load it only when attachments are wanted
+                from pdf_generator import generate_digest_pdf
+                buffer = io.BytesIO()
+                if generate_digest_pdf(digest, items_by_user.get(digest['user_id'], []), buffer):
+                    digest['attachment'] = True
+                    attachments.append((f"digest_{end.strftime('%Y%m%d')}.pdf", buffer.getvalue()))
+                    summary['attachment_bytes'] += buffer.tell()
+            subject = f"Food Freshness Digest - {digest['total']} items, {digest['period']}"
+            msg = build_message(digest['email'], subject, generate_digest_body(digest), attachments)
+            summary['render_seconds'] += time.perf_counter() - render_started
+
+            if dry_run:
+                continue
+            send_started = time.perf_counter()
+            try:
+                with metrics.stage("digest.send"):
+                    session.send(msg)
+                summary['sent'] += 1
+                consecutive_failures = 0
+                metrics.inc("food_digests_total", outcome="sent")
+            except (smtplib.SMTPException, OSError) as e:
+                print(f"Digest email error for user {digest['user_id']}: {str(e)}")
+                summary['failed'] += 1
+                consecutive_failures += 1
+                metrics.inc("food_digests_total", outcome="failed")
+            summary['send_seconds'] += time.perf_counter() - send_started
+            if consecutive_failures >= MAX_CONSECUTIVE_FAILURES:
+                remaining = len(digests) - summary['sent'] - summary['failed']
+                print(f"Digest run aborted after {consecutive_failures} consecutive failures; {remaining} not sent")
+                summary['failed'] += remaining
+                break
+        summary['connections'] = session.connections
+
+    summary['seconds'] = time.perf_counter() - started
+    summary['messages_per_second'] = summary['sent'] / summary['seconds'] if summary['seconds'] else 0.0
+    return summary
@@ -3,42 +3,106 @@ from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from email.mime.base import MIMEBase
 from email import encoders
+from html import escape
 import os
+import metrics
 
-SMTP_SERVER = "smtp.gmail.com"
-SMTP_PORT = 587
-SENDER_EMAIL = "your-email@gmail.com"
-SENDER_PASSWORD = "your-app-password"
+SMTP_SERVER = os.environ.get('SMTP_SERVER', 'smtp.gmail.com')
+SMTP_PORT = int(os.environ.get('SMTP_PORT', 587))
+SENDER_EMAIL = os.environ.get('SENDER_EMAIL', 'your-email@gmail.com')
+SENDER_PASSWORD = os.environ.get('SENDER_PASSWORD', 'your-app-password')
+# Local SMTP stand-ins usually speak neither TLS nor AUTH
+SMTP_STARTTLS = os.environ.get('SMTP_STARTTLS', '1') == '1'
+SMTP_TIMEOUT = float(os.environ.get('SMTP_TIMEOUT', 30))
+
+def build_message(recipient_email, subject, body, attachments=()):
+    """HTML message with ``attachments`` given as file paths or ``(filename, bytes)`` pairs."""
+    msg = MIMEMultipart()
+    msg['From'] = SENDER_EMAIL
+    msg['To'] = recipient_email
+    msg['Subject'] = subject
+    
+    msg.attach(MIMEText(body, 'html'))
+    
+    for attachment in attachments:
+        if isinstance(attachment, str):
+            if not os.path.exists(attachment):
+                continue
+            with open(attachment, 'rb') as handle:
+                attachment = (os.path.basename(attachment), handle.read())
+        filename, payload = attachment
+        with metrics.stage("email.attach"):
+            part = MIMEBase('application', 'octet-stream')
+            part.set_payload(payload)
+            encoders.encode_base64(part)
+            part.add_header('Content-Disposition', f'attachment; filename= {filename}')
+            msg.attach(part)
+    return msg
+
+def open_smtp(server=None, port=None):
+    connection = smtplib.SMTP(server or SMTP_SERVER, port or SMTP_PORT, timeout=SMTP_TIMEOUT)
+    if SMTP_STARTTLS:
+        connection.starttls()
+    if SENDER_PASSWORD:
+        connection.login(SENDER_EMAIL, SENDER_PASSWORD)
+    return connection
+
+class SMTPSession:
+    """One SMTP connection reused for many messages, reopened once if the server drops it.
+
+    Servers often cap messages per connection, so the connection is also
+    recycled after ``max_messages``.
+    """
+    def __init__(self, server=None, port=None, max_messages=100):
+        self.server = server
+        self.port = port
+        self.max_messages = max_messages
+        self.connections = 0
+        self._connection = None
+        self._sent_on_connection = 0
+    
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *exc):
+        self.close()
+    
+    def _connect(self):
+        self.close()
+        self._connection = open_smtp(self.server, self.port)
+        self.connections += 1
+        self._sent_on_connection = 0
+    
+    def send(self, msg):
+        if self._connection is None or self._sent_on_connection >= self.max_messages:
+            self._connect()
+        try:
+            self._connection.send_message(msg)
+        except smtplib.SMTPServerDisconnected:
+            self._connect()
+            self._connection.send_message(msg)
+        self._sent_on_connection += 1
+    
+    def close(self):
+        if self._connection is not None:
+            try:
+                self._connection.quit()
+            except (smtplib.SMTPException, OSError) as e:
+                print(f"SMTP quit error: {str(e)}")
+            self._connection = None
 
 def send_email_report(recipient_email, subject, body, attachment_path=None):
     try:
-        msg = MIMEMultipart()
-        msg['From'] = SENDER_EMAIL
-        msg['To'] = recipient_email
-        msg['Subject'] = subject
-        
-        msg.attach(MIMEText(body, 'html'))
-        
-        if attachment_path and os.path.exists(attachment_path):
-            with open(attachment_path, 'rb') as attachment:
-                part = MIMEBase('application', 'octet-stream')
-                part.set_payload(attachment.read())
-                encoders.encode_base64(part)
-                part.add_header(
-                    'Content-Disposition',
-                    f'attachment; filename= {os.path.basename(attachment_path)}'
-                )
-                msg.attach(part)
+        msg = build_message(recipient_email, subject, body, [attachment_path] if attachment_path else [])
         
-        server = smtplib.SMTP(SMTP_SERVER, SMTP_PORT)
-        server.starttls()
-        server.login(SENDER_EMAIL, SENDER_PASSWORD)
-        server.send_message(msg)
-        server.quit()
+        with metrics.stage("email.smtp_send"):
+            with SMTPSession() as session:
+                session.send(msg)
         
         return True
     except Exception as e:
         print(f"Email sending error: {str(e)}")
+        metrics.record_error("send_email_report")
         return False
 
 def generate_email_body(analysis_data):
@@ -68,7 +132,7 @@ def generate_email_body(analysis_data):
                     </tr>
                     <tr>
                         <td style="padding: 10px; background: #f9f9f9; font-weight: bold;">Food Type:</td>
-                        <td style="padding: 10px;">{food_type.title()}</td>
+                        <td style="padding: 10px;">{escape(str(food_type).title())}</td>
                     </tr>
                     <tr>
                         <td style="padding: 10px; background: #f9f9f9; font-weight: bold;">Date:</td>
@@ -93,3 +157,63 @@ def generate_email_body(analysis_data):
     """
     
     return html
+
+def generate_digest_body(digest):
+    """Summary email for one user's analyses over a period, in the style of ``generate_email_body``."""
+    labels = digest['labels']
+    colors = {'Fresh': '#4CAF50', 'Okay': '#FF9800', 'Avoid': '#f44336'}
+    
+    label_cells = "".join(
+        f"""<td style="padding: 10px; text-align: center;"><div style="font-size: 24px; font-weight: bold; color: {colors[label]};">{labels.get(label, 0)}</div><div style="color: #777;">{label}</div></td>"""
+        for label in ('Fresh', 'Okay', 'Avoid')
+    )
+    food_rows = "".join(
+        f"""
+                    <tr>
+                        <td style="padding: 8px; background: #f9f9f9; font-weight: bold;">{escape(row['food_type'].title())}</td>
+                        <td style="padding: 8px; text-align: center;">{row['total']}</td>
+                        <td style="padding: 8px; text-align: center; color: {colors['Fresh']};">{row['Fresh']}</td>
+                        <td style="padding: 8px; text-align: center; color: {colors['Okay']};">{row['Okay']}</td>
+                        <td style="padding: 8px; text-align: center; color: {colors['Avoid']};">{row['Avoid']}</td>
+                        <td style="padding: 8px; text-align: center;">{row['avg_confidence']:.1f}%</td>
+                    </tr>"""
+        for row in digest['food_types']
+    )
+    attachment_note = ("<p style=\"color: #555; line-height: 1.6;\">Every item is listed in the attached PDF.</p>"
+                       if digest.get('attachment') else "")
+    
+    html = f"""
+    <html>
+        <body style="font-family: Arial, sans-serif; padding: 20px; background-color: #f5f5f5;">
+            <div style="max-width: 600px; margin: 0 auto; background: white; border-radius: 10px; padding: 30px; box-shadow: 0 2px 10px rgba(0,0,0,0.1);">
+                <h1 style="color: #4CAF50; text-align: center;">Food Freshness Digest</h1>
+                <p style="text-align: center; color: #777;">{digest['total']} items analyzed for {escape(digest['username'])}, {digest['period']}</p>
+                <hr style="border: 1px solid #e0e0e0;">
+                
+                <table style="width: 100%; border-collapse: collapse;">
+                    <tr>{label_cells}</tr>
+                </table>
+                
+                <h2 style="color: #333;">By Food Type</h2>
+                <table style="width: 100%; border-collapse: collapse;">
+                    <tr>
+                        <th style="padding: 8px; text-align: left;">Food</th>
+                        <th style="padding: 8px;">Items</th>
+                        <th style="padding: 8px;">Fresh</th>
+                        <th style="padding: 8px;">Okay</th>
+                        <th style="padding: 8px;">Avoid</th>
+                        <th style="padding: 8px;">Avg. confidence</th>
+                    </tr>{food_rows}
+                </table>
+                {attachment_note}
+                
+                <div style="margin-top: 30px; text-align: center; color: #999; font-size: 12px;">
+                    <p>Generated by Food Freshness Classifier</p>
+                    <p>&copy; 2024 All rights reserved</p>
+                </div>
+            </div>
+        </body>
+    </html>
+    """
+    
+    return html
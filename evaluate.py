@@ -0,0 +1,266 @@
+"""Evaluate the freshness heuristic on a labeled image directory and tune its thresholds.
+
+Expected layouts (directory names are case-insensitive)::
+
+    DATASET/<Fresh|Okay|Avoid>/*.jpg
+    DATASET/<food_type>/<Fresh|Okay|Avoid>/*.jpg
+
+Features are extracted once and cached in ``DATASET/.features.npz``; later
+runs only decode new or modified files. Every metric and every threshold
+candidate is then computed over that matrix with NumPy, so a grid search
+costs milliseconds rather than one pipeline run per candidate.
+
+    python evaluate.py DATASET                    # report with the current thresholds
+    python evaluate.py DATASET --tune -o thresholds.json
+
+Load the written file at startup with ``THRESHOLDS_PATH=thresholds.json``.
+"""
+import argparse
+import json
+import os
+import time
+
+import numpy as np
+
+from pipeline import allowed_file
+from predict import (FEATURE_NAMES, THRESHOLDS, extract_features, food_categories,
+                     freshness_labels, freshness_scores, load_thresholds, merge_thresholds)
+
+LABELS = ('Fresh', 'Okay', 'Avoid')
+FOOD_TYPES = ('fruit', 'vegetable', 'bread', 'dairy', 'cooked_food')
+CACHE_NAME = '.features.npz'
+# Grid cells (candidates x images) scored per NumPy pass
+GRID_CHUNK_CELLS = 20_000_000
+
+
+def scan_dataset(root):
+    """Return ``(paths, labels, food_types)``; food type is '' for the flat layout."""
+    label_names = {label.lower(): label for label in LABELS}
+    food_names = {food_type.lower(): food_type for food_type in FOOD_TYPES}
+    paths, labels, food_types = [], [], []
+
+    def add_label_dir(directory, label, food_type):
+        for name in sorted(os.listdir(directory)):
+            path = os.path.join(directory, name)
+            if os.path.isfile(path) and allowed_file(name):
+                paths.append(path)
+                labels.append(label)
+                food_types.append(food_type)
+
+    for entry in sorted(os.listdir(root)):
+        directory = os.path.join(root, entry)
+        if not os.path.isdir(directory):
+            continue
+        if entry.lower() in label_names:
+            add_label_dir(directory, label_names[entry.lower()], '')
+        elif entry.lower() in food_names:
+            for sub in sorted(os.listdir(directory)):
+                if sub.lower() in label_names and os.path.isdir(os.path.join(directory, sub)):
+                    add_label_dir(os.path.join(directory, sub), label_names[sub.lower()], food_names[entry.lower()])
+    return paths, np.array(labels, dtype=str), np.array(food_types, dtype=str)
+
+
+def load_features(root, paths, refresh=False):
+    """Feature matrix for ``paths``, reusing cached rows whose size and mtime match.
+
+    Returns ``(features, valid, extract_seconds, extracted)``; ``valid`` is
+    False for unreadable images.
+    """
+    cache_path = os.path.join(root, CACHE_NAME)
+    stamps = np.array([[os.path.getsize(p), os.path.getmtime(p)] for p in paths], dtype=np.float64).reshape(-1, 2)
+    cached = {}
+    if not refresh and os.path.exists(cache_path):
+        with np.load(cache_path) as data:
+            if tuple(data['feature_names']) == FEATURE_NAMES:
+                for i, path in enumerate(data['paths']):
+                    cached[str(path)] = (data['stamps'][i], data['features'][i], data['valid'][i])
+
+    features = np.zeros((len(paths), len(FEATURE_NAMES)), dtype=np.float32)
+    valid = np.zeros(len(paths), dtype=bool)
+    extracted = 0
+    started = time.perf_counter()
+    for i, path in enumerate(paths):
+        relative = os.path.relpath(path, root)
+        hit = cached.get(relative)
+        if hit is not None and np.array_equal(hit[0], stamps[i]):
+            features[i], valid[i] = hit[1], hit[2]
+            continue
+        row = extract_features(path)
+        extracted += 1
+        if row is not None:
+            features[i], valid[i] = row, True
+    extract_seconds = time.perf_counter() - started
+
+    if extracted or len(cached) != len(paths):
+        np.savez(cache_path, paths=np.array([os.path.relpath(p, root) for p in paths], dtype=str),
+                 stamps=stamps, features=features, valid=valid, feature_names=np.array(FEATURE_NAMES))
+    return features, valid, extract_seconds, extracted
+
+
+def confusion_matrix(actual, predicted, classes):
+    index = {name: i for i, name in enumerate(classes)}
+    a = np.array([index[x] for x in actual], dtype=np.int64)
+    p = np.array([index.get(x, -1) for x in predicted], dtype=np.int64)
+    known = p >= 0
+    return np.bincount(a[known] * len(classes) + p[known], minlength=len(classes) ** 2).reshape(len(classes), -1)
+
+
+def classification_report(matrix, classes):
+    """Accuracy plus per-class precision/recall/F1/support from a confusion matrix."""
+    true_positive = np.diag(matrix).astype(np.float64)
+    support = matrix.sum(axis=1)
+    predicted = matrix.sum(axis=0)
+    precision = np.divide(true_positive, predicted, out=np.zeros_like(true_positive), where=predicted > 0)
+    recall = np.divide(true_positive, support, out=np.zeros_like(true_positive), where=support > 0)
+    f1 = np.divide(2 * precision * recall, precision + recall,
+                   out=np.zeros_like(true_positive), where=(precision + recall) > 0)
+    return {
+        'accuracy': float(true_positive.sum() / max(matrix.sum(), 1)),
+        'classes': {name: {'precision': float(precision[i]), 'recall': float(recall[i]),
+                           'f1': float(f1[i]), 'support': int(support[i])}
+                    for i, name in enumerate(classes)},
+        'confusion': matrix.tolist(),
+    }
+
+
+def evaluate(features, labels, food_types, thresholds):
+    """Reports for freshness labels overall, per predicted food type, and for food type if labeled."""
+    scores = freshness_scores(features)
+    categories = food_categories(features, thresholds)
+    predicted = freshness_labels(scores, categories, thresholds)
+    report = {'label': classification_report(confusion_matrix(labels, predicted, LABELS), LABELS), 'by_food_type': {}}
+    for food_type in FOOD_TYPES:
+        selected = categories == food_type
+        if selected.any():
+            matrix = confusion_matrix(labels[selected], predicted[selected], LABELS)
+            report['by_food_type'][food_type] = classification_report(matrix, LABELS)
+    labeled = food_types != ''
+    if labeled.any():
+        matrix = confusion_matrix(food_types[labeled], categories[labeled], FOOD_TYPES)
+        report['food_type'] = classification_report(matrix, FOOD_TYPES)
+    return report
+
+
+def search_cutoffs(scores, labels, step=1.0):
+    """Best ``(fresh, okay, accuracy)`` cutoffs for one group by exhaustive vectorized search."""
+    grid = np.arange(0, 100 + step, step)
+    fresh, okay = np.meshgrid(grid, grid, indexing='ij')
+    candidates = fresh >= okay
+    fresh, okay = fresh[candidates], okay[candidates]
+    target = np.select([labels == 'Fresh', labels == 'Okay'], [0, 1], default=2)
+
+    correct = np.empty(len(fresh), dtype=np.int64)
+    chunk = max(1, GRID_CHUNK_CELLS // max(len(scores), 1))
+    for start in range(0, len(fresh), chunk):
+        f = fresh[start:start + chunk, None]
+        o = okay[start:start + chunk, None]
+        predicted = np.where(scores >= f, 0, np.where(scores >= o, 1, 2))
+        correct[start:start + chunk] = (predicted == target).sum(axis=1)
+    best = int(np.argmax(correct))
+    return float(fresh[best]), float(okay[best]), float(correct[best] / max(len(scores), 1))
+
+
+def tune_label_cutoffs(features, labels, thresholds, min_samples=20, step=1.0):
+    """Per-food-type Fresh/Okay cutoffs; groups smaller than ``min_samples`` keep the current ones."""
+    tuned = merge_thresholds(thresholds)
+    scores = freshness_scores(features)
+    categories = food_categories(features, thresholds)
+    fresh, okay, _ = search_cutoffs(scores, labels, step)
+    tuned['labels']['default'] = {'fresh': fresh, 'okay': okay}
+    for food_type in FOOD_TYPES:
+        selected = categories == food_type
+        if selected.sum() >= min_samples:
+            fresh, okay, _ = search_cutoffs(scores[selected], labels[selected], step)
+            tuned['labels'][food_type] = {'fresh': fresh, 'okay': okay}
+    return tuned
+
+
+def tune_category_thresholds(features, food_types, thresholds, rounds=2, points=21):
+    """Coordinate search over the food-category ratio thresholds against labeled food types."""
+    tuned = merge_thresholds(thresholds)
+    labeled = food_types != ''
+    features, food_types = features[labeled], food_types[labeled]
+    if not len(food_types):
+        return tuned
+
+    def accuracy(candidate):
+        return float((food_categories(features, candidate) == food_types).mean())
+
+    best = accuracy(tuned)
+    for _ in range(rounds):
+        for key, current in list(tuned['categories'].items()):
+            high = 255.0 if current > 1 else 1.0
+            for value in np.linspace(0, high, points):
+                candidate = merge_thresholds(tuned)
+                candidate['categories'][key] = float(value)
+                score = accuracy(candidate)
+                if score > best:
+                    best, tuned = score, candidate
+    return tuned
+
+
+def print_report(title, report):
+    print(f"\n{title}: accuracy {report['accuracy']:.3f}")
+    classes = list(report['classes'])
+    print(f"  {'class':<12} {'precision':>9} {'recall':>7} {'f1':>6} {'support':>8}")
+    for name, row in report['classes'].items():
+        print(f"  {name:<12} {row['precision']:>9.3f} {row['recall']:>7.3f} {row['f1']:>6.3f} {row['support']:>8}")
+    print(f"  confusion (rows actual, cols predicted: {', '.join(classes)})")
+    for name, row in zip(classes, report['confusion']):
+        print(f"  {name:<12} " + ' '.join(f"{count:>6}" for count in row))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('dataset')
+    parser.add_argument('--thresholds', help='start from this thresholds file instead of the loaded ones')
+    parser.add_argument('--tune', action='store_true', help='grid-search cutoffs per food type')
+    parser.add_argument('--step', type=float, default=1.0, help='cutoff grid step for --tune')
+    parser.add_argument('--min-samples', type=int, default=20, help='smallest food-type group to tune separately')
+    parser.add_argument('-o', '--output', help='write the tuned thresholds JSON here')
+    parser.add_argument('--refresh', action='store_true', help='ignore the feature cache')
+    parser.add_argument('--json', action='store_true', help='print the reports as JSON')
+    args = parser.parse_args()
+
+    paths, labels, food_types = scan_dataset(args.dataset)
+    if not paths:
+        parser.error(f"no labeled images found under {args.dataset}")
+    features, valid, extract_seconds, extracted = load_features(args.dataset, paths, args.refresh)
+    features, labels, food_types = features[valid], labels[valid], food_types[valid]
+    print(f"{len(paths)} images, {int((~valid).sum())} unreadable, {extracted} decoded this run")
+    if extracted:
+        print(f"feature extraction: {extracted / extract_seconds:.1f} images/s ({1000 * extract_seconds / extracted:.1f} ms/image)")
+
+    thresholds = load_thresholds(args.thresholds) if args.thresholds else merge_thresholds(THRESHOLDS)
+    started = time.perf_counter()
+    report = evaluate(features, labels, food_types, thresholds)
+    scoring_seconds = time.perf_counter() - started
+    print(f"scoring: {len(features) / max(scoring_seconds, 1e-9):,.0f} images/s from cached features")
+    reports = {'current': report}
+
+    if args.tune:
+        started = time.perf_counter()
+        thresholds = tune_category_thresholds(features, food_types, thresholds)
+        thresholds = tune_label_cutoffs(features, labels, thresholds, args.min_samples, args.step)
+        print(f"tuning: {time.perf_counter() - started:.2f}s")
+        reports['tuned'] = evaluate(features, labels, food_types, thresholds)
+
+    if args.json:
+        print(json.dumps(reports, indent=2))
+    else:
+        for name, result in reports.items():
+            print_report(f"{name} freshness", result['label'])
+            for food_type, by_type in result['by_food_type'].items():
+                count = sum(row['support'] for row in by_type['classes'].values())
+                print(f"  {food_type}: accuracy {by_type['accuracy']:.3f} on {count} images")
+            if 'food_type' in result:
+                print_report(f"{name} food type", result['food_type'])
+
+    if args.output:
+        with open(args.output, 'w') as fh:
+            json.dump(thresholds, fh, indent=2)
+        print(f"\nwrote {args.output}")
+
+
+if __name__ == '__main__':
+    main()
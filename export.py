@@ -0,0 +1,232 @@
+"""Streaming export of analysis history for offline modelling.
+
+Rows are read through a server-side cursor in ``chunk_size`` partitions
+and each partition is encoded and handed on before the next is fetched.
+Memory therefore depends on the chunk size, not the row count, whether
+the output goes to a file (``flask export``) or an HTTP response
+(``/api/v1/export``).
+
+Formats: gzip CSV (``csv.gz``), plus Parquet (``parquet``) and Arrow IPC
+stream (``arrow``) when the optional ``pyarrow`` package is installed.
+
+Exports are ordered by ``(timestamp, id)``. An export covers rows after
+the ``since`` watermark, up to a watermark fixed when it starts. That end
+watermark is reported, and passing it as the next ``since`` continues the
+export without gaps or repeats. Rows newer than ``EXPORT_WATERMARK_LAG``
+seconds are left for the next run, so that transactions still in flight
+when the export starts are not skipped. Archived analyses (archive.py) are
+included when the range reaches back to them.
+"""
+import csv
+import gzip
+import io
+import os
+from datetime import datetime, timedelta
+
+import numpy as np
+from sqlalchemy import and_, func, or_, select
+
+from archive import select_analyses, tables as archive_tables
+from auth import db
+from predict import FEATURE_NAMES
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError:
+    pyarrow = None
+
+EXPORT_CHUNK_SIZE = int(os.environ.get('EXPORT_CHUNK_SIZE', 50000))
+EXPORT_WATERMARK_LAG = float(os.environ.get('EXPORT_WATERMARK_LAG', 60))
+
+FORMATS = ('csv.gz', 'parquet', 'arrow')
+CONTENT_TYPES = {
+    'csv.gz': 'application/gzip',
+    'parquet': 'application/vnd.apache.parquet',
+    'arrow': 'application/vnd.apache.arrow.stream',
+}
+COLUMNS = ('id', 'user_id', 'timestamp', 'label', 'confidence', 'food_type', 'quality_score', 'resolution',
+           'blur_score', 'degraded', 'duplicate_of', 'image_filename')
+
+
+class ExportError(Exception):
+    pass
+
+
+def encode_watermark(timestamp, row_id):
+    return f"{timestamp.isoformat()}|{row_id}"
+
+
+def decode_watermark(value):
+    """``(timestamp, id)`` from ``encode_watermark`` output or a plain ISO timestamp (id 0)."""
+    timestamp, _, row_id = value.partition('|')
+    return datetime.fromisoformat(timestamp), int(row_id or 0)
+
+
+def _after(table, watermark):
+    timestamp, row_id = watermark
+    return or_(table.c.timestamp > timestamp, and_(table.c.timestamp == timestamp, table.c.id > row_id))
+
+
+def _filters(table, since, user_id):
+    conditions = []
+    if since is not None:
+        conditions.append(_after(table, since))
+    if user_id is not None:
+        conditions.append(table.c.user_id == user_id)
+    return conditions
+
+
+def end_watermark(since=None, user_id=None, now=None):
+    """Last ``(timestamp, id)`` an export starting now will include, or None if there is nothing new."""
+    cutoff = (now or datetime.utcnow()) - timedelta(seconds=EXPORT_WATERMARK_LAG)
+    # Archived rows all precede live ones, so the archive only matters when the live table has no match
+    for table in archive_tables(since[0] if since else None):
+        conditions = _filters(table, since, user_id) + [table.c.timestamp <= cutoff]
+        latest = db.session.execute(select(func.max(table.c.timestamp)).where(*conditions)).scalar()
+        if latest is not None:
+            row_id = db.session.execute(
+                select(func.max(table.c.id)).where(*conditions, table.c.timestamp == latest)).scalar()
+            return latest, row_id
+    return None
+
+
+def iter_chunks(since=None, until=None, user_id=None, features=False, chunk_size=EXPORT_CHUNK_SIZE):
+    """Column dicts of up to ``chunk_size`` rows with ``since < (timestamp, id) <= until``."""
+
+    def build(table):
+        selected = [table.c[name] for name in COLUMNS] + ([table.c.features] if features else [])
+        conditions = _filters(table, since, user_id)
+        if until is not None:
+            conditions.append(~_after(table, until))
+        return select(*selected).where(*conditions)
+
+    query = select_analyses(build, since[0] if since else None)
+    query = (query.order_by(query.selected_columns.timestamp, query.selected_columns.id)
+             .execution_options(yield_per=chunk_size))
+    width = len(FEATURE_NAMES)
+    for partition in db.session.execute(query).partitions():
+        columns = dict(zip(COLUMNS, (list(values) for values in zip(*partition))))
+        if features:
+            blobs = [row[-1] for row in partition]
+            matrix = np.full((len(blobs), width), np.nan, dtype=np.float32)
+            for i, blob in enumerate(blobs):
+                if blob is not None and len(blob) == width * 4:
+                    matrix[i] = np.frombuffer(blob, dtype=np.float32)
+            for j, name in enumerate(FEATURE_NAMES):
+                columns[name] = matrix[:, j]
+        yield columns
+
+
+def column_names(features=False):
+    return list(COLUMNS) + (list(FEATURE_NAMES) if features else [])
+
+
+class _Drain(io.RawIOBase):
+    """Write-only file object whose contents are collected and handed out by ``take``."""
+
+    def __init__(self):
+        self._parts = []
+        self._position = 0
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._parts.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def take(self):
+        data = b''.join(self._parts)
+        self._parts = []
+        return data
+
+
+def _csv_gzip(chunks, names):
+    drain = _Drain()
+    with gzip.GzipFile(fileobj=drain, mode='wb', compresslevel=6) as compressed:
+        text = io.TextIOWrapper(compressed, encoding='utf-8', newline='')
+        writer = csv.writer(text)
+        writer.writerow(names)
+        for columns in chunks:
+            values = []
+            for name in names:
+                column = columns[name]
+                if name == 'timestamp':
+                    column = [value.isoformat(sep=' ') for value in column]
+                elif isinstance(column, np.ndarray):
+                    # float32 -> shortest float64 repr that round-trips at 7 digits
+                    column = column.astype(np.float64).round(7).tolist()
+                values.append(column)
+            # csv writes None as an empty field
+            writer.writerows(zip(*values))
+            text.flush()
+            yield drain.take()
+        text.flush()
+        text.detach()
+    yield drain.take()
+
+
+def _arrow_schema(names):
+    types = {
+        'id': pyarrow.int64(), 'user_id': pyarrow.int64(), 'timestamp': pyarrow.timestamp('us'),
+        'label': pyarrow.string(), 'confidence': pyarrow.float64(), 'food_type': pyarrow.string(),
+        'quality_score': pyarrow.float64(), 'resolution': pyarrow.string(), 'blur_score': pyarrow.float64(),
+        'degraded': pyarrow.bool_(), 'duplicate_of': pyarrow.int64(), 'image_filename': pyarrow.string(),
+    }
+    return pyarrow.schema([(name, types.get(name, pyarrow.float32())) for name in names])
+
+
+def _arrow(chunks, names, parquet):
+    schema = _arrow_schema(names)
+    drain = _Drain()
+    if parquet:
+        writer = pyarrow.parquet.ParquetWriter(drain, schema, compression='zstd')
+    else:
+        writer = pyarrow.ipc.new_stream(drain, schema)
+    for columns in chunks:
+        batch = pyarrow.record_batch([pyarrow.array(columns[name], type=schema.field(name).type) for name in names],
+                                     schema=schema)
+        # One Parquet row group per chunk keeps the writer's buffers bounded
+        if parquet:
+            writer.write_batch(batch, row_group_size=batch.num_rows)
+        else:
+            writer.write_batch(batch)
+        yield drain.take()
+    writer.close()
+    yield drain.take()
+
+
+def stream_export(fmt, since=None, until=None, user_id=None, features=False, chunk_size=EXPORT_CHUNK_SIZE):
+    """Encoded export as an iterator of byte strings."""
+    if fmt not in FORMATS:
+        raise ExportError(f"Unknown format {fmt!r}; expected one of {', '.join(FORMATS)}")
+    if fmt != 'csv.gz' and pyarrow is None:
+        raise ExportError(f"The {fmt} format needs pyarrow (pip install pyarrow)")
+    names = column_names(features)
+    chunks = iter_chunks(since, until, user_id, features, chunk_size)
+    if fmt == 'csv.gz':
+        return _csv_gzip(chunks, names)
+    return _arrow(chunks, names, parquet=(fmt == 'parquet'))
+
+
+def export_to_file(path, fmt, since=None, user_id=None, features=False, chunk_size=EXPORT_CHUNK_SIZE):
+    """Write an export to ``path``; returns ``(bytes_written, end_watermark)``.
+
+    The end watermark is None when nothing newer than ``since`` was ready,
+    in which case no file is written.
+    """
+    until = end_watermark(since, user_id)
+    if until is None:
+        return 0, None
+    written = 0
+    with open(path, 'wb') as handle:
+        for data in stream_export(fmt, since, until, user_id, features, chunk_size):
+            handle.write(data)
+            written += len(data)
+    return written, until
@@ -0,0 +1,127 @@
+"""Cache for rendered page fragments and per-user aggregates.
+
+Entries are keyed by user and that user's data version, so they never
+need to be deleted. Versions are counters in the ``data_version`` table
+(``DataVersion``), so every worker and CLI process agrees on them
+without a shared cache, and reading them is one primary-key lookup:
+
+- ``user:<id>`` is bumped in the same transaction as any ORM insert,
+  update or delete of that user's ``Analysis`` rows (a ``before_commit``
+  hook), and by ``bump_users`` from bulk jobs that move or purge rows
+  (archiving, retention);
+- ``global`` is bumped by ``bump_global`` after bulk writes that change
+  rows of many users in place (``flask rescore --apply``, re-sharding).
+
+The ``/api/history`` validators use the same versions. ``CACHE_URL``
+(see ``cache_backends.make_cache``) shares the cached fragments
+themselves between workers; without it each worker builds its own. Only
+cache what costs more than the version lookup. Hits and misses are
+counted per fragment in ``food_fragment_cache_total``.
+"""
+import os
+from datetime import datetime
+
+from markupsafe import Markup
+from sqlalchemy import event, select
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.orm import Session
+
+import metrics
+from auth import db, Analysis, DataVersion
+from cache_backends import make_cache
+
+FRAGMENT_CACHE_TTL = float(os.environ.get('FRAGMENT_CACHE_TTL', 300))
+FRAGMENT_CACHE_MAX_ENTRIES = int(os.environ.get('FRAGMENT_CACHE_MAX_ENTRIES', 20000))
+
+_cache = make_cache('fragment', max_entries=FRAGMENT_CACHE_MAX_ENTRIES)
+DATA_VERSION = DataVersion.__table__
+
+# INSERT ... ON CONFLICT DO UPDATE, so two first bumps of the same name cannot collide
+UPSERT = {'postgresql': postgresql.insert, 'sqlite': sqlite.insert}
+
+
+def data_version(user_id):
+    """``(version, changed_at)`` of ``user_id``'s analyses; ``changed_at`` is None until the first bump."""
+    rows = {name: (version, changed_at) for name, version, changed_at in db.session.execute(
+        select(DATA_VERSION.c.name, DATA_VERSION.c.version, DATA_VERSION.c.changed_at)
+        .where(DATA_VERSION.c.name.in_(('global', f'user:{user_id}'))))}
+    global_version, global_changed = rows.get('global', (0, None))
+    user_version, user_changed = rows.get(f'user:{user_id}', (0, None))
+    changed_at = max((t for t in (global_changed, user_changed) if t), default=None)
+    return f"{global_version}.{user_version}", changed_at
+
+
+def _bump(session, names):
+    now = datetime.utcnow()
+    rows = [{'name': name, 'version': 1, 'changed_at': now} for name in sorted(names)]
+    upsert = UPSERT.get(db.engine.dialect.name)
+    if upsert is not None:
+        statement = upsert(DATA_VERSION)
+        session.execute(statement.on_conflict_do_update(
+            index_elements=['name'],
+            set_={'version': DATA_VERSION.c.version + 1, 'changed_at': statement.excluded.changed_at}), rows)
+        return
+    for row in rows:
+        if not session.execute(DATA_VERSION.update().where(DATA_VERSION.c.name == row['name'])
+                               .values(version=DATA_VERSION.c.version + 1, changed_at=now)).rowcount:
+            session.execute(DATA_VERSION.insert(), row)
+
+
+def bump_users(user_ids):
+    """Bump the versions of ``user_ids`` in the current transaction; the caller commits."""
+    if user_ids:
+        _bump(db.session, {f'user:{user_id}' for user_id in user_ids})
+
+
+def bump_global():
+    """Record a bulk change to many users' analyses; commits on its own."""
+    _bump(db.session, {'global'})
+    db.session.commit()
+
+
+def cached(name, build, user_id, extra=''):
+    """Cached result of ``build()``, tied to ``user_id``'s data version.
+
+    ``build`` must return a JSON-serialisable value.
+    """
+    if FRAGMENT_CACHE_TTL <= 0:
+        return build()
+    key = f"{name}:{user_id}:{data_version(user_id)[0]}:{extra}"
+    value = _cache.get(key)
+    if value is not None:
+        metrics.inc("food_fragment_cache_total", fragment=name, result="hit")
+        return value
+    metrics.inc("food_fragment_cache_total", fragment=name, result="miss")
+    value = build()
+    _cache.set(key, value, ttl=FRAGMENT_CACHE_TTL)
+    return value
+
+
+def cached_html(name, render, user_id, extra=''):
+    """``cached`` for a rendered template fragment, returned as ``Markup`` for ``{{ }}``."""
+    return Markup(cached(name, lambda: str(render()), user_id, extra))
+
+
+def _changed_users(session, objects):
+    users = session.info.setdefault('fragment_users', set())
+    users.update(obj.user_id for obj in objects if isinstance(obj, Analysis))
+
+
+@event.listens_for(Session, 'after_flush')
+def _collect_flushed(session, flush_context):
+    _changed_users(session, (*session.new, *session.dirty, *session.deleted))
+
+
+@event.listens_for(Session, 'before_commit')
+def _bump_changed_users(session):
+    # Objects not flushed yet are flushed by this commit, after this hook
+    _changed_users(session, (*session.new, *session.dirty, *session.deleted))
+    users = session.info.pop('fragment_users', None)
+    if users:
+        # Same transaction as the change, so no reader sees new data under the old version
+        _bump(session, {f'user:{user_id}' for user_id in users})
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_changed_users(session):
+    session.info.pop('fragment_users', None)
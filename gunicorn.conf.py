@@ -0,0 +1,42 @@
+"""gunicorn settings, used by the Procfile and render.yaml (``gunicorn -c gunicorn.conf.py``).
+
+``SERVING_MODE`` picks how requests are served:
+
+- ``sync`` (default): ``app:app`` on gunicorn's gthread workers,
+  ``GUNICORN_THREADS`` (4) requests per worker process at a time, so cheap
+  requests and health checks are not stuck behind an analysis.
+  ``GUNICORN_THREADS=1`` uses plain sync workers.
+- ``async``: ``asgi:application`` on uvicorn workers; each process keeps
+  many connections open and runs up to ``ASGI_THREADS`` requests at once
+  (see asgi.py). Needs ``pip install uvicorn uvicorn-worker``.
+
+The analysis routes are CPU-bound and admission control already limits
+them across all workers, so the default is one worker per core. The core count
+is ``GUNICORN_CORES`` if set, else the CPUs this process may actually use:
+its CPU affinity, capped by a cgroup CPU quota (containers usually get a
+quota while ``os.cpu_count()`` still reports every core of the host, and
+each worker takes about 170 MB). Under the load-test mix of
+benchmarks/load_test.py on a 1-core instance, the usual ``2 * cores + 1``
+gave lower throughput, a higher p95 and 2.5x the memory; larger instances
+were not measured, so run the load test there before relying on the
+default. ``WEB_CONCURRENCY`` sets the worker count directly. gunicorn reads
+the bind address from ``PORT`` itself.
+"""
+import os
+
+from cpus import available_cores
+
+SERVING_MODE = os.environ.get('SERVING_MODE', 'sync')
+CORES = int(os.environ.get('GUNICORN_CORES', 0)) or available_cores()
+
+workers = int(os.environ.get('WEB_CONCURRENCY', CORES))
+
+if SERVING_MODE == 'async':
+    wsgi_app = 'asgi:application'
+    worker_class = 'uvicorn_worker.UvicornWorker'
+elif SERVING_MODE == 'sync':
+    wsgi_app = 'app:app'
+    # More than one thread switches gunicorn to gthread workers
+    threads = int(os.environ.get('GUNICORN_THREADS', 4))
+else:
+    raise RuntimeError(f"Unknown SERVING_MODE {SERVING_MODE!r}; expected sync or async")
@@ -0,0 +1,76 @@
+"""Tiled spoilage heatmaps.
+
+The global ratios in ``predict.compute_features`` dilute a small mold
+patch on a large plate. Here the same spoilage masks are averaged per
+tile in one pass, with no Python loop over tiles: an ``INTER_AREA``
+resize to the tile grid averages each mask exactly over every cell. The
+grid has ``ceil(size / HEATMAP_TILE)`` cells per side, all the same
+(fractional) size, so it covers the whole image, edges included. Tile
+severities use the penalty weights of the freshness score and are saved
+next to the upload as a small transparent overlay, one pixel per tile,
+that the result page stretches over the photo; because the cells split
+the image evenly, the stretched overlay lines up with it at any size.
+"""
+import os
+
+import cv2
+import numpy as np
+
+import metrics
+
+HEATMAP_ENABLED = os.environ.get('HEATMAP_ENABLED', '1') == '1'
+HEATMAP_TILE = int(os.environ.get('HEATMAP_TILE', 32))
+# Tiles below this severity are left untinted
+MIN_VISIBLE_SEVERITY = 0.05
+
+
+def tile_ratios(mask, tile=HEATMAP_TILE):
+    """Fraction of set pixels in each cell of an even grid of cells at most ``tile`` pixels on a side."""
+    if not mask.size:
+        return np.zeros((1, 1), dtype=np.float32)
+    rows, cols = -(-mask.shape[0] // tile), -(-mask.shape[1] // tile)
+    # Float input: on uint8 the cell means would be rounded to 0 or 1
+    return cv2.resize(mask.astype(np.float32), (cols, rows), interpolation=cv2.INTER_AREA).reshape(rows, cols)
+
+
+def tile_severity(masks, tile=HEATMAP_TILE):
+    """Per-tile spoilage severity in 0..1, weighted like the freshness score penalties."""
+    penalty = (tile_ratios(masks['mold'], tile) * 200
+               + tile_ratios(masks['rotten'], tile) * 120
+               + (tile_ratios(masks['gray'], tile) > 0.3) * 50)
+    # 70 is the score a clean image starts from
+    return np.clip(penalty / 70, 0, 1).astype(np.float32)
+
+
+def render_overlay(severity):
+    """Transparent BGRA overlay at tile-grid resolution; the page stretches it over the photo.
+
+    Each pixel is one tile, so the file is tiny and nothing at photo
+    resolution has to be blended or re-encoded.
+    """
+    colors = cv2.applyColorMap(cv2.convertScaleAbs(severity, alpha=255), cv2.COLORMAP_JET)
+    visible = severity >= MIN_VISIBLE_SEVERITY
+    alpha = np.where(visible, 255 * (0.25 + 0.4 * severity), 0).astype(np.uint8)
+    return np.dstack([colors, alpha])
+
+
+def heatmap_filename(filename):
+    stem, _ = os.path.splitext(filename)
+    return f"{stem}_heatmap.png"
+
+
+def save_heatmap(masks, filepath, filename):
+    """Write the overlay for the upload saved at ``filepath`` and stored as ``filename``.
+
+    Returns ``(heatmap_name, max_severity)``, with a None name when the image has no
+    visible spoilage. The name is relative like ``filename``, in the same directory.
+    """
+    with metrics.stage("heatmap.tiles"):
+        severity = tile_severity(masks)
+    peak = float(severity.max()) if severity.size else 0.0
+    if peak < MIN_VISIBLE_SEVERITY:
+        return None, peak
+    with metrics.stage("heatmap.render"):
+        cv2.imwrite(heatmap_filename(filepath), render_overlay(severity))
+    metrics.inc("food_heatmaps_total")
+    return heatmap_filename(filename), peak
@@ -0,0 +1,132 @@
+"""Header-only image inspection and bounded decodes.
+
+``sniff_image`` reads just the file header through Pillow's lazy loader to get
+format, dimensions and EXIF orientation, so oversized inputs and
+decompression bombs are rejected before any pixel data is decoded.
+``decode_image`` uses those dimensions to pick a reduced-resolution decode
+and caps how many large decodes run at once in a worker. OpenCV applies
+the EXIF orientation while decoding; ``oriented_size`` gives the matching
+size from the header.
+"""
+import os
+import threading
+
+import cv2
+from PIL import Image, UnidentifiedImageError
+
+import metrics
+
+ALLOWED_FORMATS = {'JPEG', 'MPO', 'PNG', 'GIF', 'BMP', 'WEBP'}
+MAX_IMAGE_PIXELS = int(os.environ.get('MAX_IMAGE_PIXELS', 40_000_000))
+MAX_IMAGE_DIMENSION = int(os.environ.get('MAX_IMAGE_DIMENSION', 12000))
+# Decodes producing at least this many pixels count against the heavy-decode limit
+HEAVY_DECODE_PIXELS = int(os.environ.get('HEAVY_DECODE_PIXELS', 8_000_000))
+MAX_CONCURRENT_HEAVY_DECODES = int(os.environ.get('MAX_CONCURRENT_HEAVY_DECODES', 2))
+
+EXIF_ORIENTATION = 0x0112
+# EXIF orientations that rotate by 90 degrees, swapping width and height
+TRANSPOSED_ORIENTATIONS = {5, 6, 7, 8}
+# Formats libjpeg decodes at 1/2, 1/4 or 1/8 scale; OpenCV decodes the others in full and then shrinks
+SCALED_DECODE_FORMATS = {'JPEG', 'MPO'}
+REDUCED_DECODE_FLAGS = (
+    (8, cv2.IMREAD_REDUCED_COLOR_8),
+    (4, cv2.IMREAD_REDUCED_COLOR_4),
+    (2, cv2.IMREAD_REDUCED_COLOR_2),
+)
+
+_heavy_decodes = threading.BoundedSemaphore(MAX_CONCURRENT_HEAVY_DECODES)
+
+
+class ImageRejected(Exception):
+    def __init__(self, reason, message):
+        super().__init__(message)
+        self.reason = reason
+
+
+def sniff_image(source):
+    """Return ``{'format', 'width', 'height', 'orientation', 'pixels'}`` from the header only.
+
+    ``source`` is a path or a seekable file object; file objects are rewound.
+    Raises ImageRejected if the data is not a recognisable image.
+    """
+    position = source.tell() if hasattr(source, 'tell') else None
+    try:
+        with metrics.stage("image.sniff"):
+            with Image.open(source) as img:
+                width, height = img.size
+                info = {
+                    'format': img.format,
+                    'width': width,
+                    'height': height,
+                    'orientation': img.getexif().get(EXIF_ORIENTATION, 1),
+                    'pixels': width * height,
+                }
+    except Image.DecompressionBombError:
+        raise ImageRejected('too_large', "Image exceeds the decompression bomb limit")
+    except (UnidentifiedImageError, OSError, SyntaxError):
+        raise ImageRejected('unreadable', "Not a readable image file")
+    finally:
+        if position is not None:
+            source.seek(position)
+    return info
+
+
+def check_admissible(info):
+    """Raise ImageRejected if a sniffed image should not be decoded at all."""
+    if info['format'] not in ALLOWED_FORMATS:
+        raise ImageRejected('format', f"Unsupported image format: {info['format']}")
+    if info['pixels'] > MAX_IMAGE_PIXELS or max(info['width'], info['height']) > MAX_IMAGE_DIMENSION:
+        raise ImageRejected(
+            'too_large',
+            f"Image is {info['width']}x{info['height']}; the limit is {MAX_IMAGE_PIXELS // 1_000_000} megapixels "
+            f"and {MAX_IMAGE_DIMENSION}px per side"
+        )
+
+
+def oriented_size(info):
+    """``(width, height)`` of a sniffed image once its EXIF orientation is applied."""
+    if info['orientation'] in TRANSPOSED_ORIENTATIONS:
+        return info['height'], info['width']
+    return info['width'], info['height']
+
+
+def reduced_decode_factor(width, height, max_dimension):
+    """Largest power-of-two shrink that keeps the long side at or above ``max_dimension``."""
+    for factor, flag in REDUCED_DECODE_FLAGS:
+        if max(width, height) // factor >= max_dimension:
+            return factor, flag
+    return 1, cv2.IMREAD_COLOR
+
+
+def decode_image(image_path, max_dimension=None):
+    """``cv2.imread`` that decodes at reduced resolution when possible.
+
+    With ``max_dimension`` a JPEG may be decoded shrunk by 2, 4 or 8, but
+    never below ``max_dimension`` on the long side; callers still resize
+    the remainder. Other formats are always decoded in full. Decodes of at
+    least HEAVY_DECODE_PIXELS wait for one of MAX_CONCURRENT_HEAVY_DECODES
+    slots.
+    Returns None if the image cannot be read, like ``cv2.imread``.
+    """
+    try:
+        info = sniff_image(image_path)
+    except ImageRejected:
+        return None
+
+    factor, flag = (1, cv2.IMREAD_COLOR)
+    if max_dimension and info['format'] in SCALED_DECODE_FORMATS:
+        factor, flag = reduced_decode_factor(info['width'], info['height'], max_dimension)
+    if factor > 1:
+        metrics.inc("food_reduced_decodes_total", factor=factor)
+
+    if info['pixels'] // (factor * factor) < HEAVY_DECODE_PIXELS:
+        return cv2.imread(image_path, flag)
+
+    with metrics.stage("image.heavy_decode_wait"):
+        _heavy_decodes.acquire()
+    metrics.add_gauge("food_heavy_decodes_in_progress", 1)
+    try:
+        return cv2.imread(image_path, flag)
+    finally:
+        metrics.add_gauge("food_heavy_decodes_in_progress", -1)
+        _heavy_decodes.release()
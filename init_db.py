@@ -1,19 +1,12 @@
-from flask import Flask
-from auth import db, User
+"""Create or upgrade the database and seed the admin user.
 
-app = Flask(__name__)
-app.config["SQLALCHEMY_DATABASE_URI"] = "sqlite:///users.db"
-db.init_app(app)
+Same as `flask --app app init-db`; uses the app's DATABASE_URL.
+"""
+from app import app
+from auth import init_database
 
 with app.app_context():
-    db.create_all()
-    
-    # Check if user already exists
-    existing_user = User.query.filter_by(username="admin").first()
-    if not existing_user:
-        user = User(username="admin", password="password")
-        db.session.add(user)
-        db.session.commit()
+    if init_database():
         print("User 'admin' created with password 'password'")
     else:
-        print("User 'admin' already exists")
\ No newline at end of file
+        print("User 'admin' already exists")
@@ -0,0 +1,150 @@
+"""Lightweight in-process metrics exposed in Prometheus text format.
+
+Counters, gauges and histograms live in module-level dicts guarded by a single
+lock, so recording a sample costs a dict lookup and a few additions. Values are
+per process: under gunicorn every worker keeps its own registry and a scrape of
+``/metrics`` reports the worker that served it.
+"""
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from functools import wraps
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+_lock = threading.Lock()
+_counters = {}
+_gauges = {}
+_histograms = {}
+_help = {}
+
+
+def _key(name, labels):
+    return name, tuple(sorted(labels.items()))
+
+
+def describe(name, text):
+    _help[name] = text
+
+
+def inc(name, value=1, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _counters[key] = _counters.get(key, 0) + value
+
+
+def set_gauge(name, value, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _gauges[key] = value
+
+
+def add_gauge(name, delta, **labels):
+    key = _key(name, labels)
+    with _lock:
+        _gauges[key] = _gauges.get(key, 0) + delta
+
+
+def observe(name, value, **labels):
+    key = _key(name, labels)
+    with _lock:
+        hist = _histograms.get(key)
+        if hist is None:
+            hist = _histograms[key] = [[0] * (len(DEFAULT_BUCKETS) + 1), 0.0, 0]
+        hist[0][bisect_left(DEFAULT_BUCKETS, value)] += 1
+        hist[1] += value
+        hist[2] += 1
+
+
+@contextmanager
+def timer(name, **labels):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(name, time.perf_counter() - start, **labels)
+
+
+def stage(name):
+    """Time one pipeline stage into the shared stage histogram."""
+    return timer("food_stage_duration_seconds", stage=name)
+
+
+def timed(stage_name):
+    """Decorator form of :func:`stage`."""
+    def decorator(func):
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with stage(stage_name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def record_error(where):
+    inc("food_errors_total", where=where)
+
+
+def record_fallback(path):
+    inc("food_fallbacks_total", path=path)
+
+
+def _format_labels(labels, extra=None):
+    items = list(labels) + ([extra] if extra else [])
+    if not items:
+        return ""
+    body = ",".join(
+        '%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for k, v in items
+    )
+    return "{" + body + "}"
+
+
+def _header(lines, seen, name, kind):
+    if name in seen:
+        return
+    seen.add(name)
+    if name in _help:
+        lines.append(f"# HELP {name} {_help[name]}")
+    lines.append(f"# TYPE {name} {kind}")
+
+
+def render():
+    """Render every registered metric in the Prometheus text exposition format."""
+    with _lock:
+        counters = sorted(_counters.items())
+        gauges = sorted(_gauges.items())
+        histograms = sorted((k, (list(v[0]), v[1], v[2])) for k, v in _histograms.items())
+
+    lines = []
+    seen = set()
+    for (name, labels), value in counters:
+        _header(lines, seen, name, "counter")
+        lines.append(f"{name}{_format_labels(labels)} {value}")
+    for (name, labels), value in gauges:
+        _header(lines, seen, name, "gauge")
+        lines.append(f"{name}{_format_labels(labels)} {value}")
+    for (name, labels), (buckets, total, count) in histograms:
+        _header(lines, seen, name, "histogram")
+        cumulative = 0
+        for bound, bucket_count in zip(DEFAULT_BUCKETS + ("+Inf",), buckets):
+            cumulative += bucket_count
+            lines.append(f"{name}_bucket{_format_labels(labels, ('le', bound))} {cumulative}")
+        lines.append(f"{name}_sum{_format_labels(labels)} {total}")
+        lines.append(f"{name}_count{_format_labels(labels)} {count}")
+    return "\n".join(lines) + "\n"
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _gauges.clear()
+        _histograms.clear()
+
+
+describe("food_stage_duration_seconds", "Time spent in each processing stage.")
+describe("food_errors_total", "Errors caught and logged, by location.")
+describe("food_fallbacks_total", "Fallback or default results returned, by path.")
+describe("http_requests_total", "HTTP requests served, by endpoint and status.")
+describe("http_request_duration_seconds", "HTTP request latency, by endpoint.")
@@ -0,0 +1,96 @@
+"""Bounded executors for the CPU-heavy parts of a request.
+
+Under the async serving mode (``SERVING_MODE=async``, see asgi.py) one
+worker process serves up to ``ASGI_THREADS`` requests at once. Most of
+them wait on the network, the database or SMTP. Image analysis (decode,
+features, heatmap, classifier, quality check) and ReportLab rendering go
+through ``run_cpu`` / ``run_pdf`` instead of running on the request thread,
+so at most ``OFFLOAD_WORKERS`` of them compete for the CPU per process,
+however many requests are open.
+
+OpenCV and numpy release the GIL, so analysis runs on a thread pool.
+ReportLab is pure Python and holds the GIL; with ``OFFLOAD_PDF_PROCESSES``
+set, reports render in a separate process pool instead. Timings recorded
+inside those processes (the ``pdf.*`` stages) are not in this worker's
+``/metrics``.
+
+With ``OFFLOAD_WORKERS=0`` (the default in sync mode, whose few threads
+per worker are already bounded by admission control) every call runs
+inline.
+
+``run_background`` is separate: one thread per process for maintenance
+that no request should wait for, such as rebuilding the similarity and
+near-duplicate indexes.
+"""
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
+import metrics
+from cpus import available_cores
+
+SERVING_MODE = os.environ.get('SERVING_MODE', 'sync')
+OFFLOAD_WORKERS = int(os.environ.get('OFFLOAD_WORKERS', available_cores() if SERVING_MODE == 'async' else 0))
+OFFLOAD_PDF_PROCESSES = int(os.environ.get('OFFLOAD_PDF_PROCESSES', 0))
+
+_executors = {}
+
+
+def _executor(kind):
+    # Created on first use: threads and processes do not survive fork (gunicorn --preload)
+    executor = _executors.get(kind)
+    if executor is None:
+        if kind == 'background':
+            executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='background')
+        elif kind == 'pdf':
+            # forkserver: never fork a process that is already running request threads
+            executor = ProcessPoolExecutor(max_workers=OFFLOAD_PDF_PROCESSES,
+                                           mp_context=multiprocessing.get_context('forkserver'))
+        else:
+            executor = ThreadPoolExecutor(max_workers=OFFLOAD_WORKERS, thread_name_prefix='offload')
+        executor = _executors.setdefault(kind, executor)
+    return executor
+
+
+def _run(kind, func, args, kwargs):
+    # Running plus queued; above the pool size means requests are waiting for a CPU slot
+    metrics.add_gauge("food_offload_inflight", 1, pool=kind)
+    try:
+        return _executor(kind).submit(func, *args, **kwargs).result()
+    finally:
+        metrics.add_gauge("food_offload_inflight", -1, pool=kind)
+
+
+def run_cpu(func, *args, **kwargs):
+    """``func(*args, **kwargs)`` on the CPU pool; waits for and returns its result.
+
+    ``func`` runs outside the Flask app and request context, so it must not
+    touch ``db``, ``current_user`` or ``current_app``.
+    """
+    if OFFLOAD_WORKERS <= 0:
+        return func(*args, **kwargs)
+    return _run('cpu', func, args, kwargs)
+
+
+def run_pdf(func, *args):
+    """Render a report with ``func(*args)``: in the PDF process pool when enabled, else like ``run_cpu``.
+
+    ``func`` and its arguments must be picklable (module-level function, plain data).
+    """
+    if OFFLOAD_PDF_PROCESSES <= 0:
+        return run_cpu(func, *args)
+    return _run('pdf', func, args, {})
+
+
+def run_background(func, *args):
+    """Queue ``func(*args)`` on this process' background thread and return at once.
+
+    ``func`` runs outside any app context and must log its own errors.
+    """
+    _executor('background').submit(func, *args)
+
+
+def shutdown():
+    for executor in _executors.values():
+        executor.shutdown(wait=False, cancel_futures=True)
+    _executors.clear()
@@ -5,9 +5,11 @@ from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph,
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.enums import TA_CENTER, TA_LEFT
 from datetime import datetime
+from xml.sax.saxutils import escape
 import qrcode
 import io
 import os
+import metrics
 
 def generate_pdf_report(analysis_data, output_path):
     try:
@@ -81,14 +83,15 @@ def generate_pdf_report(analysis_data, output_path):
             
             story.append(tips_table)
         
-        qr = qrcode.QRCode(version=1, box_size=3, border=2)
-        qr.add_data(f"Analysis ID: {analysis_data.get('id', 'N/A')}")
-        qr.make(fit=True)
-        qr_img = qr.make_image(fill_color="black", back_color="white")
-        
-        qr_buffer = io.BytesIO()
-        qr_img.save(qr_buffer, format='PNG')
-        qr_buffer.seek(0)
+        with metrics.stage("pdf.qrcode"):
+            qr = qrcode.QRCode(version=1, box_size=3, border=2)
+            qr.add_data(f"Analysis ID: {analysis_data.get('id', 'N/A')}")
+            qr.make(fit=True)
+            qr_img = qr.make_image(fill_color="black", back_color="white")
+            
+            qr_buffer = io.BytesIO()
+            qr_img.save(qr_buffer, format='PNG')
+            qr_buffer.seek(0)
         
         story.append(Spacer(1, 0.3*inch))
         qr_image = RLImage(qr_buffer, width=1.5*inch, height=1.5*inch)
@@ -101,8 +104,56 @@ def generate_pdf_report(analysis_data, output_path):
         story.append(Spacer(1, 0.2*inch))
         story.append(footer)
         
-        doc.build(story)
+        with metrics.stage("pdf.build"):
+            doc.build(story)
         return True
     except Exception as e:
         print(f"PDF generation error: {str(e)}")
+        metrics.record_error("generate_pdf_report")
+        return False
+
+def generate_digest_pdf(digest, items, output):
+    """One PDF listing every analysis in a digest; ``output`` is a path or a binary file object."""
+    try:
+        doc = SimpleDocTemplate(output, pagesize=letter)
+        styles = getSampleStyleSheet()
+        title_style = ParagraphStyle(
+            'DigestTitle',
+            parent=styles['Heading1'],
+            fontSize=20,
+            textColor=colors.HexColor('#4CAF50'),
+            spaceAfter=12,
+            alignment=TA_CENTER
+        )
+        story = [
+            Paragraph("Food Freshness Digest", title_style),
+            Paragraph(f"{escape(digest['username'])} &middot; {digest['period']} &middot; {digest['total']} items", styles['Normal']),
+            Spacer(1, 0.2*inch),
+        ]
+        
+        rows = [['Date', 'Result', 'Confidence', 'Food Type']]
+        rows += [[item['timestamp'].strftime('%Y-%m-%d %H:%M'), item['label'], f"{item['confidence']:.1f}%",
+                  (item['food_type'] or 'N/A').title()] for item in items]
+        label_colors = {'Fresh': '#4CAF50', 'Okay': '#FF9800', 'Avoid': '#f44336'}
+        table_style = [
+            ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#f0f0f0')),
+            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+            ('FONTSIZE', (0, 0), (-1, -1), 9),
+            ('GRID', (0, 0), (-1, -1), 0.5, colors.grey)
+        ]
+        table_style += [('TEXTCOLOR', (1, row), (1, row), colors.HexColor(label_colors.get(item['label'], '#000000')))
+                        for row, item in enumerate(items, start=1)]
+        table = Table(rows, colWidths=[1.8*inch, 1.2*inch, 1.2*inch, 1.8*inch], repeatRows=1)
+        table.setStyle(TableStyle(table_style))
+        story.append(table)
+        if digest['total'] > len(items):
+            story.append(Spacer(1, 0.1*inch))
+            story.append(Paragraph(f"<i>{digest['total'] - len(items)} more items not listed</i>", styles['Normal']))
+        
+        with metrics.stage("pdf.build"):
+            doc.build(story)
+        return True
+    except Exception as e:
+        print(f"Digest PDF generation error: {str(e)}")
+        metrics.record_error("generate_digest_pdf")
         return False
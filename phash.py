@@ -0,0 +1,371 @@
+"""Perceptual hashing and a near-duplicate index for uploads.
+
+``dhash`` turns an image into a 64-bit difference hash that survives
+re-encoding, small crops and exposure changes, so burst shots of the same
+item land within a few bits of each other.
+
+``HashIndex`` is a multi-index hash over those values. Each hash is split
+into four 16-bit chunks. If two hashes are within Hamming distance ``r``,
+at least one chunk differs by no more than ``r // 4`` bits, so a lookup
+only probes the chunk values within that radius in four arrays sorted by
+``(user_id, chunk)`` and checks the few candidates with a popcount.
+Duplicates only count within one user's uploads, so the user id is part
+of every key and other users' rows are never touched.
+
+Users with few hashes for the radius are scanned directly instead: rows
+are grouped by user, so that is one popcount over a contiguous slice and
+beats probing hundreds of chunk buckets.
+
+The index is loaded from ``Analysis.phash`` on first use in each process.
+Every ``PHASH_RELOAD_SECONDS`` a fresh copy is loaded on the background
+thread (``offload.run_background``) and swapped in, so uploads never wait
+on a full reload. An upload's hash goes into the index only once its
+session commits (``add_on_commit``); until then only lookups in that
+same session see it, so a rollback leaves nothing behind. Before every
+lookup the index also reads rows above the highest id it has loaded,
+which picks up other workers' uploads quickly. On PostgreSQL a row can
+commit after one with a higher id, and that catch-up misses it until the
+next reload. Rows archived or deleted elsewhere are dropped from the
+index when a lookup finds them gone.
+"""
+import itertools
+import os
+import threading
+import time
+
+import cv2
+import numpy as np
+from flask import current_app
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+
+import metrics
+import offload
+from auth import db, Analysis
+
+PHASH_ENABLED = os.environ.get('PHASH_ENABLED', '1') == '1'
+# Largest Hamming distance (out of 64 bits) that counts as a near-duplicate
+PHASH_RADIUS = int(os.environ.get('PHASH_RADIUS', 8))
+# Reuse the earlier analysis' prediction for near-duplicates instead of classifying again
+DEDUP_REUSE = os.environ.get('DEDUP_REUSE', '0') == '1'
+# Seconds between full reloads of the index; 0 never reloads
+PHASH_RELOAD_SECONDS = float(os.environ.get('PHASH_RELOAD_SECONDS', 300))
+
+CHUNKS = 4
+CHUNK_BITS = 16
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+# Hashes added since the last merge are scanned linearly
+MERGE_THRESHOLD = 4096
+# A user's hashes are scanned directly unless they outnumber the chunk
+# probes of a lookup by this much (measured with benchmarks/phash_index_bench.py)
+LINEAR_SCAN_ROWS_PER_PROBE = 2500
+
+if hasattr(np, 'bitwise_count'):
+    def popcount(values):
+        return np.bitwise_count(values)
+else:
+    _BYTE_COUNTS = np.array([bin(i).count('1') for i in range(256)], dtype=np.uint8)
+
+    def popcount(values):
+        return _BYTE_COUNTS[np.ascontiguousarray(values).view(np.uint8)].reshape(-1, 8).sum(axis=1)
+
+
+def dhash(image, hash_size=8):
+    """64-bit difference hash of a BGR or grayscale image, as an unsigned int."""
+    gray = image if image.ndim == 2 else cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+    small = cv2.resize(gray, (hash_size + 1, hash_size), interpolation=cv2.INTER_AREA)
+    bits = (small[:, 1:] > small[:, :-1]).flatten()
+    return int(np.packbits(bits).view('>u8')[0])
+
+
+def to_signed(value):
+    """Unsigned 64-bit hash -> value that fits a signed BIGINT column."""
+    return value - (1 << 64) if value >= (1 << 63) else value
+
+
+def to_unsigned(value):
+    return value + (1 << 64) if value < 0 else value
+
+
+def _flip_masks(bits, radius):
+    masks = [0]
+    for r in range(1, radius + 1):
+        for positions in itertools.combinations(range(bits), r):
+            masks.append(sum(1 << p for p in positions))
+    return masks
+
+
+class HashIndex:
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._flip_cache = {}
+        self.reset()
+
+    def reset(self):
+        self.hashes = np.empty(0, dtype=np.uint64)
+        self.ids = np.empty(0, dtype=np.int64)
+        self.users = np.empty(0, dtype=np.int64)
+        # Per chunk: rows sorted by (user_id, chunk value) and the sorted keys themselves
+        self._orders = [np.empty(0, dtype=np.int64) for _ in range(CHUNKS)]
+        self._keys = [np.empty(0, dtype=np.int64) for _ in range(CHUNKS)]
+        self._pending_hashes = np.empty(MERGE_THRESHOLD, dtype=np.uint64)
+        self._pending_ids = np.empty(MERGE_THRESHOLD, dtype=np.int64)
+        self._pending_users = np.empty(MERGE_THRESHOLD, dtype=np.int64)
+        self._pending = 0
+        self.loaded = False
+        self.loaded_at = 0.0
+        # Highest id loaded from the database, and ids added above it since
+        self.max_id = 0
+        self._added = set()
+        # Ids removed while a replacement index loads in the background
+        self._rebuilding = False
+        self._removed = []
+
+    def __len__(self):
+        return len(self.hashes) + self._pending
+
+    def add(self, analysis_id, user_id, value):
+        with self._lock:
+            self._pending_hashes[self._pending] = value
+            self._pending_ids[self._pending] = analysis_id
+            self._pending_users[self._pending] = user_id
+            self._pending += 1
+            if analysis_id > self.max_id:
+                self._added.add(analysis_id)
+            if self._pending == MERGE_THRESHOLD:
+                self._merge()
+            metrics.set_gauge("food_phash_index_size", len(self))
+
+    def add_many(self, ids, users, values):
+        """Bulk insert of loaded rows; ``values`` are unsigned hashes as a uint64 array or ints.
+
+        Ids already inserted with ``add`` are skipped, and the largest id
+        becomes ``max_id``.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        users = np.asarray(users, dtype=np.int64)
+        values = np.asarray(values, dtype=np.uint64)
+        with self._lock:
+            if not len(ids):
+                return
+            self.max_id = max(self.max_id, int(np.max(ids)))
+            if self._added:
+                new = ~np.isin(ids, list(self._added))
+                ids, users, values = ids[new], users[new], values[new]
+                self._added = {added for added in self._added if added > self.max_id}
+            if len(ids):
+                self._merge(ids, users, values)
+
+    def remove(self, ids):
+        """Drop ``ids`` (archived or deleted analyses) from the index."""
+        ids = np.asarray(ids, dtype=np.int64)
+        with self._lock:
+            n = self._pending
+            keep = ~np.isin(self.ids, ids)
+            keep_pending = ~np.isin(self._pending_ids[:n], ids)
+            if keep.all() and keep_pending.all():
+                return
+            self.ids, self.users, self.hashes = self.ids[keep], self.users[keep], self.hashes[keep]
+            if self._rebuilding:
+                self._removed.append(ids)
+            self._pending = int(keep_pending.sum())
+            for pending in (self._pending_ids, self._pending_users, self._pending_hashes):
+                pending[:self._pending] = pending[:n][keep_pending]
+            self._merge()
+
+    def _merge(self, ids=None, users=None, values=None):
+        n = self._pending
+        parts = [(self.ids, self.users, self.hashes),
+                 (self._pending_ids[:n], self._pending_users[:n], self._pending_hashes[:n])]
+        if ids is not None:
+            parts.append((ids, users, values))
+        self.ids = np.concatenate([p[0] for p in parts])
+        self.users = np.concatenate([p[1] for p in parts])
+        self.hashes = np.concatenate([p[2] for p in parts])
+        self._pending = 0
+        with metrics.stage("phash.index_build"):
+            # Rows grouped by user, so a user's rows are one slice for the linear scan
+            by_user = np.argsort(self.users, kind='stable')
+            self.ids, self.users, self.hashes = self.ids[by_user], self.users[by_user], self.hashes[by_user]
+            for c in range(CHUNKS):
+                chunk = ((self.hashes >> np.uint64(c * CHUNK_BITS)) & np.uint64(CHUNK_MASK)).astype(np.int64)
+                keys = (self.users << CHUNK_BITS) | chunk
+                self._orders[c] = np.argsort(keys, kind='stable')
+                self._keys[c] = keys[self._orders[c]]
+        metrics.set_gauge("food_phash_index_size", len(self))
+
+    def _masks(self, radius):
+        sub_radius = radius // CHUNKS
+        masks = self._flip_cache.get(sub_radius)
+        if masks is None:
+            masks = self._flip_cache[sub_radius] = np.array(_flip_masks(CHUNK_BITS, sub_radius), dtype=np.int64)
+        return masks
+
+    def _candidates(self, value, user_id, masks):
+        found = []
+        for c in range(CHUNKS):
+            probes = (user_id << CHUNK_BITS) | (((value >> (c * CHUNK_BITS)) & CHUNK_MASK) ^ masks)
+            starts = np.searchsorted(self._keys[c], probes, 'left')
+            lengths = np.searchsorted(self._keys[c], probes, 'right') - starts
+            total = int(lengths.sum())
+            if total:
+                # Concatenate the buckets' row ranges without a Python loop
+                positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(total)
+                found.append(self._orders[c][positions])
+        if not found:
+            return np.empty(0, dtype=np.int64)
+        return np.unique(np.concatenate(found))
+
+    @staticmethod
+    def _matches(hashes, ids, value, radius, keep=None):
+        distances = popcount(hashes ^ np.uint64(value))
+        keep = distances <= radius if keep is None else keep & (distances <= radius)
+        return list(zip(ids[keep].tolist(), distances[keep].astype(np.int64).tolist()))
+
+    def search(self, value, user_id, radius=PHASH_RADIUS, limit=10):
+        """``user_id``'s ``[(analysis_id, distance), ...]`` within ``radius`` of ``value``, nearest first."""
+        with self._lock:
+            masks = self._masks(radius)
+            start, end = np.searchsorted(self.users, [user_id, user_id + 1])
+            if end - start <= LINEAR_SCAN_ROWS_PER_PROBE * len(masks):
+                # Rows are grouped by user, so this is one contiguous slice
+                results = self._matches(self.hashes[start:end], self.ids[start:end], value, radius)
+            else:
+                candidates = self._candidates(value, user_id, masks)
+                results = self._matches(self.hashes[candidates], self.ids[candidates], value, radius)
+            n = self._pending
+            if n:
+                results.extend(self._matches(self._pending_hashes[:n], self._pending_ids[:n], value, radius,
+                                             keep=self._pending_users[:n] == user_id))
+        # A reload can pick up a row that was also added on commit
+        results = list(dict(results).items())
+        results.sort(key=lambda item: (item[1], -item[0]))
+        return results[:limit]
+
+
+index = HashIndex()
+
+
+def _load_rows(after_id, chunk_size=50000):
+    table = Analysis.__table__
+    query = (select(table.c.id, table.c.user_id, table.c.phash)
+             .where(table.c.phash.isnot(None), table.c.id > after_id)
+             .order_by(table.c.id)
+             .execution_options(yield_per=chunk_size))
+    # The session sees its own flushed rows; those are added when it commits
+    uncommitted = {analysis_id for analysis_id, _, _ in db.session.info.get('phash_pending', ())}
+    ids, users, values = [], [], []
+    for row_id, user_id, value in db.session.execute(query):
+        if row_id in uncommitted:
+            continue
+        ids.append(row_id)
+        users.append(user_id)
+        values.append(value)
+    return ids, users, np.array(values, dtype=np.int64).view(np.uint64)
+
+
+def sync_index():
+    """Load the index on first use, else pick up rows above ``max_id``.
+
+    Schedules a background rebuild every ``PHASH_RELOAD_SECONDS``.
+    """
+    current = index
+    with current._lock:
+        if not current.loaded:
+            # Nothing to serve lookups from yet, so the first load is inline
+            with metrics.stage("phash.index_load"):
+                current.add_many(*_load_rows(0))
+            current.loaded = True
+            current.loaded_at = time.monotonic()
+            return
+        ids, users, values = _load_rows(current.max_id)
+        if ids:
+            current.add_many(ids, users, values)
+        rebuild = (PHASH_RELOAD_SECONDS > 0 and not current._rebuilding
+                   and time.monotonic() - current.loaded_at > PHASH_RELOAD_SECONDS)
+        if rebuild:
+            current._rebuilding = True
+    if rebuild:
+        offload.run_background(_rebuild, current_app._get_current_object())
+
+
+def _rebuild(app):
+    """Load a fresh index and swap it in for ``index``; runs on the background thread."""
+    global index
+    old = index
+    try:
+        with app.app_context():
+            fresh = HashIndex()
+            with metrics.stage("phash.index_load"):
+                fresh.add_many(*_load_rows(0))
+        fresh.loaded = True
+        fresh.loaded_at = time.monotonic()
+        with old._lock:
+            # Removals seen while the new index was loading
+            if old._removed:
+                fresh.remove(np.concatenate(old._removed))
+            index = fresh
+    except Exception as e:
+        print(f"Hash index rebuild error: {str(e)}")
+        metrics.record_error("phash.rebuild")
+    finally:
+        with old._lock:
+            old._rebuilding = False
+            old._removed = []
+
+
+def add_on_commit(analysis_id, user_id, value):
+    """Add a flushed analysis' hash to the index once the current session commits."""
+    db.session.info.setdefault('phash_pending', []).append((analysis_id, user_id, value))
+
+
+def _uncommitted_matches(user_id, value, radius):
+    # Earlier uploads of the same batch, flushed but not yet committed
+    matches = []
+    for analysis_id, other_user, other in db.session.info.get('phash_pending', ()):
+        distance = bin(other ^ value).count('1')
+        if other_user == user_id and distance <= radius:
+            matches.append((analysis_id, distance))
+    return matches
+
+
+@event.listens_for(Session, 'after_commit')
+def _add_committed(session):
+    pending = session.info.pop('phash_pending', None)
+    if not pending:
+        return
+    current = index
+    with current._lock:
+        # Not loaded yet: the first load reads these rows from the database
+        if current.loaded:
+            for analysis_id, user_id, value in pending:
+                current.add(analysis_id, user_id, value)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_pending(session):
+    session.info.pop('phash_pending', None)
+
+
+def find_duplicate(user_id, value, radius=PHASH_RADIUS):
+    """Nearest earlier Analysis of ``user_id`` within ``radius`` of ``value``, or None."""
+    with metrics.stage("phash.lookup"):
+        sync_index()
+        while True:
+            matches = index.search(value, user_id, radius, limit=5) + _uncommitted_matches(user_id, value, radius)
+            missing = []
+            for analysis_id, distance in sorted(matches, key=lambda item: (item[1], -item[0])):
+                analysis = db.session.get(Analysis, analysis_id)
+                if analysis is None:
+                    missing.append(analysis_id)
+                elif analysis.user_id == user_id:
+                    break
+            else:
+                analysis = None
+            if missing:
+                # Archived or deleted since the index was loaded; without them the next search fills up again
+                index.remove(missing)
+            if analysis is not None:
+                return analysis, distance
+            if not missing:
+                return None
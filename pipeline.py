@@ -0,0 +1,169 @@
+"""Shared upload -> analysis -> persistence pipeline.
+
+Used by the HTML form routes and the JSON API so both produce identical
+Analysis rows and batch results.
+"""
+import json
+import os
+import uuid
+
+from werkzeug.utils import secure_filename
+
+import metrics
+import heatmap
+import offload
+import phash
+import similarity
+import storage
+from auth import db, Analysis, AnalysisBatch
+from image_io import ImageRejected, check_admissible, sniff_image
+from predict import (predict_image_detailed, analyze_image_quality, compute_features, fit_analysis_size,
+                     image_to_hsv, load_analysis_image, pack_features, spoilage_masks)
+
+ALLOWED_EXTENSIONS = {'png', 'jpg', 'jpeg', 'gif', 'bmp', 'webp'}
+MAX_BATCH_IMAGES = 10
+UPLOAD_PATH = storage.UPLOAD_ROOT
+
+
+def allowed_file(filename):
+    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+
+
+def generate_unique_filename(filename):
+    name, ext = os.path.splitext(secure_filename(filename))
+    return f"{name}_{uuid.uuid4().hex[:8]}{ext}"
+
+
+def _decode(filepath):
+    """``(image, masks, features, embedding, image_hash)``; all None if the image cannot be read."""
+    image = load_analysis_image(filepath)
+    if image is None:
+        return None, None, None, None, None
+    image = fit_analysis_size(image)
+    hsv = image_to_hsv(image)
+    masks = spoilage_masks(hsv)
+    features = compute_features(hsv, masks)
+    image_hash = phash.dhash(image) if phash.PHASH_ENABLED else None
+    return image, masks, features, similarity.embed(hsv, features), image_hash
+
+
+def analyze_saved_image(user_id, filepath, filename):
+    """Run prediction and quality analysis on a saved image and stage an Analysis row.
+
+    The image is decoded once for its feature vector, similarity embedding,
+    perceptual hash and spoilage heatmap. The decoding and classifier steps
+    run through ``offload.run_cpu``.
+    With ``DEDUP_REUSE`` a near-duplicate of one of the user's earlier
+    uploads reuses that analysis' prediction instead of classifying again.
+
+    Returns ``(analysis, result)`` where ``result`` is the dict shown on the
+    batch results page. The caller commits.
+    """
+    with metrics.stage("features"):
+        image, masks, features, embedding, image_hash = offload.run_cpu(_decode, filepath)
+    duplicate = heatmap_name = None
+    if image is not None and heatmap.HEATMAP_ENABLED:
+        with metrics.stage("heatmap"):
+            heatmap_name, _ = offload.run_cpu(heatmap.save_heatmap, masks, filepath, filename)
+    if image_hash is not None:
+        duplicate = phash.find_duplicate(user_id, image_hash)
+
+    if duplicate is not None and phash.DEDUP_REUSE:
+        earlier = duplicate[0]
+        metrics.inc("food_duplicates_total", action="reused")
+        prediction = {'label': earlier.label, 'confidence': earlier.confidence, 'food_type': earlier.food_type,
+                      'degraded': bool(earlier.degraded)}
+    else:
+        if duplicate is not None:
+            metrics.inc("food_duplicates_total", action="detected")
+        with metrics.stage("predict"):
+            prediction = offload.run_cpu(predict_image_detailed, filepath, features=features)
+    label, confidence, food_type = prediction['label'], prediction['confidence'], prediction['food_type']
+    with metrics.stage("quality"):
+        quality_metrics = offload.run_cpu(analyze_image_quality, filepath)
+
+    analysis = Analysis(
+        user_id=user_id,
+        image_filename=filename,
+        label=label,
+        confidence=confidence,
+        food_type=food_type,
+        quality_score=quality_metrics.get('blur_score', 0),
+        resolution=quality_metrics.get('resolution', 'Unknown'),
+        blur_score=quality_metrics.get('blur_score', 0),
+        degraded=prediction['degraded'],
+        features=pack_features(features),
+        embedding=similarity.pack_embedding(embedding),
+        heatmap_filename=heatmap_name,
+        phash=phash.to_signed(image_hash) if image_hash is not None else None,
+        duplicate_of=duplicate[0].id if duplicate is not None else None
+    )
+    db.session.add(analysis)
+    if image is not None:
+        # Flush for the id so later images in the same batch can match this one
+        db.session.flush()
+        if image_hash is not None:
+            phash.add_on_commit(analysis.id, user_id, image_hash)
+        similarity.add_on_commit(user_id, analysis.id, embedding)
+
+    result = {
+        'id': None,
+        'filename': filename,
+        'label': label,
+        'confidence': confidence,
+        'food_type': food_type,
+        'quality': quality_metrics,
+        'degraded': prediction['degraded'],
+        'duplicate_of': analysis.duplicate_of,
+        'heatmap_filename': heatmap_name
+    }
+    return analysis, result
+
+
+def process_batch(user_id, files, prescaled=False):
+    """Save, analyze and persist up to MAX_BATCH_IMAGES uploaded files.
+
+    ``files`` is a list of werkzeug ``FileStorage`` objects. Files with a
+    disallowed extension are skipped. Each file's header is checked before
+    it is saved; unreadable or oversized images are not decoded and are
+    reported in ``rejected`` as ``{'filename', 'reason', 'error'}``.
+    ``prescaled`` marks uploads the browser already downscaled.
+
+    Returns ``(batch, results, rejected)``; ``batch`` is None when nothing
+    could be analyzed.
+    """
+    results = []
+    analyses = []
+    rejected = []
+    for file in files[:MAX_BATCH_IMAGES]:
+        if file and file.filename and allowed_file(file.filename):
+            try:
+                check_admissible(sniff_image(file.stream))
+            except ImageRejected as e:
+                metrics.inc("food_uploads_rejected_total", reason=e.reason)
+                rejected.append({'filename': file.filename, 'reason': e.reason, 'error': str(e)})
+                continue
+
+            filepath, filename = storage.new_upload(generate_unique_filename(file.filename))
+            with metrics.stage("upload.save"):
+                file.save(filepath)
+            metrics.inc("food_uploads_total", prescaled=str(prescaled).lower())
+            metrics.inc("food_upload_bytes_total", os.path.getsize(filepath), prescaled=str(prescaled).lower())
+
+            analysis, result = analyze_saved_image(user_id, filepath, filename)
+            analyses.append(analysis)
+            results.append(result)
+
+    if not results:
+        return None, [], rejected
+
+    db.session.flush()
+    for result, analysis in zip(results, analyses):
+        result['id'] = analysis.id
+
+    batch = AnalysisBatch(id=uuid.uuid4().hex, user_id=user_id, results=json.dumps(results))
+    db.session.add(batch)
+    with metrics.stage("db.commit"):
+        db.session.commit()
+
+    return batch, results, rejected
@@ -2,9 +2,19 @@ import cv2
 import numpy as np
 from PIL import Image
 import os
+import copy
+import json
+import metrics
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from resilience import CircuitBreaker
+from batching import MicroBatcher
+from image_io import decode_image, oriented_size, sniff_image
 
 LABELS = ["Fresh", "Okay", "Avoid"]
 
+# Images are analyzed at most this large; uploads pre-scaled to it skip the server resize.
+ANALYSIS_MAX_DIMENSION = 640
+
 FOOD_TYPES = {
     'fruit': ['apple', 'banana', 'orange', 'strawberry', 'grape', 'watermelon', 'mango', 'pineapple'],
     'vegetable': ['tomato', 'carrot', 'lettuce', 'broccoli', 'cucumber', 'pepper', 'spinach', 'cabbage'],
@@ -67,150 +77,331 @@ STORAGE_TIPS = {
     }
 }
 
+# Features computed by simulate_prediction, stored with each Analysis for re-scoring
+FEATURE_NAMES = (
+    'h_mean', 's_mean', 'v_mean',
+    'mold_ratio', 'rotten_ratio', 'gray_ratio',
+    'white_ratio', 'green_ratio', 'orange_ratio', 'brown_ratio',
+)
+FEATURE_INDEX = {name: i for i, name in enumerate(FEATURE_NAMES)}
+
+# Freshness-score cutoffs per food type and food-category ratio thresholds
+DEFAULT_THRESHOLDS = {
+    'labels': {
+        'default': {'fresh': 60, 'okay': 35},
+        'cooked_food': {'fresh': 65, 'okay': 40},
+    },
+    'categories': {
+        'cooked_white': 0.25, 'cooked_orange': 0.15, 'cooked_green': 0.10,
+        'dairy_white': 0.50,
+        'bread_brown': 0.30, 'bread_saturation': 50,
+        'vegetable_green': 0.25,
+        'fruit_saturation': 60, 'fruit_value': 100,
+    },
+}
+THRESHOLDS = copy.deepcopy(DEFAULT_THRESHOLDS)
+
+CONFIDENCE_RANGES = {
+    ('cooked_food', 'Fresh'): (82, 92),
+    ('cooked_food', 'Okay'): (72, 85),
+    ('cooked_food', 'Avoid'): (82, 95),
+    ('default', 'Fresh'): (85, 95),
+    ('default', 'Okay'): (70, 85),
+    ('default', 'Avoid'): (80, 95),
+}
+
+def merge_thresholds(overrides):
+    """DEFAULT_THRESHOLDS updated with a (possibly partial) thresholds dict."""
+    merged = copy.deepcopy(DEFAULT_THRESHOLDS)
+    for section, values in (overrides or {}).items():
+        for key, value in values.items():
+            if isinstance(value, dict):
+                merged[section].setdefault(key, {}).update(value)
+            else:
+                merged[section][key] = value
+    return merged
+
+def load_thresholds(path):
+    with open(path) as fh:
+        return merge_thresholds(json.load(fh))
+
+# Tuned cutoffs written by evaluate.py
+THRESHOLDS_PATH = os.environ.get('THRESHOLDS_PATH')
+if THRESHOLDS_PATH:
+    try:
+        THRESHOLDS = load_thresholds(THRESHOLDS_PATH)
+    except Exception as e:
+        print(f"Thresholds load error: {str(e)}")
+        metrics.record_error("load_thresholds")
+
+# Cross-request micro-batching of classifier calls (off by default: the heuristic
+# gains nothing from batching, a batched model forward pass does)
+MICROBATCH_ENABLED = os.environ.get('MICROBATCH_ENABLED', '0').lower() in ('1', 'true', 'yes', 'on')
+MICROBATCH_MAX_SIZE = int(os.environ.get('MICROBATCH_MAX_SIZE', 8))
+MICROBATCH_MAX_WAIT_MS = float(os.environ.get('MICROBATCH_MAX_WAIT_MS', 5))
+
 class SimpleFoodClassifier:
-    def predict(self, image_path):
-        return simulate_prediction(image_path)
+    """Primary classifier backend.
+
+    ``predict`` returns ``(label, confidence, food_type)``. A heavier model
+    can replace ``model`` as long as it keeps that interface. ``predict_batch``
+    is the batched form; with MICROBATCH_ENABLED, ``predict`` and ``submit``
+    queue single images from concurrent requests into ``predict_batch`` calls.
+    """
+    def __init__(self, microbatch=MICROBATCH_ENABLED):
+        self.batcher = None
+        if microbatch:
+            self.batcher = MicroBatcher(self._predict_items, max_batch_size=MICROBATCH_MAX_SIZE,
+                                        max_wait_ms=MICROBATCH_MAX_WAIT_MS, name='classifier')
+    
+    def predict(self, image_path, features=None):
+        if self.batcher:
+            return self.batcher.submit((image_path, features)).result()
+        return simulate_prediction(image_path, features)
+    
+    def submit(self, image_path, features=None):
+        """Future-returning form of ``predict``; only available with micro-batching."""
+        return self.batcher.submit((image_path, features))
+    
+    def predict_batch(self, image_paths, features=None):
+        features = features or [None] * len(image_paths)
+        return [simulate_prediction(image_path, f) for image_path, f in zip(image_paths, features)]
+    
+    def _predict_items(self, items):
+        image_paths, features = zip(*items)
+        return self.predict_batch(list(image_paths), list(features))
     
     def detect_food_type(self, image_path):
         return detect_food_category(image_path)
 
 model = SimpleFoodClassifier()
 
-def predict_image(image_path):
-    try:
-        if not os.path.exists(image_path):
-            return "Error", 0.0, "unknown"
-        
-        label, confidence = model.predict(image_path)
-        food_type = model.detect_food_type(image_path)
-        return label, confidence, food_type
-    except Exception as e:
-        print(f"Prediction error: {str(e)}")
-        return simulate_prediction(image_path)
+# Latency budget for the primary backend; 0 disables the deadline
+PREDICT_BUDGET_MS = float(os.environ.get('PREDICT_BUDGET_MS', 2000))
+BACKEND_WORKERS = int(os.environ.get('PREDICT_BACKEND_WORKERS', 4))
+breaker = CircuitBreaker(
+    'primary_backend',
+    failure_threshold=int(os.environ.get('PREDICT_BREAKER_FAILURES', 5)),
+    reset_timeout=float(os.environ.get('PREDICT_BREAKER_RESET_SECONDS', 30)),
+)
+_backend_executor = ThreadPoolExecutor(max_workers=BACKEND_WORKERS, thread_name_prefix='predict-backend')
+metrics.set_gauge("food_predict_budget_seconds", PREDICT_BUDGET_MS / 1000.0)
 
-def simulate_prediction(image_path):
+def _call_primary(image_path, features, budget_ms):
+    if budget_ms <= 0:
+        return model.predict(image_path, features)
+    if getattr(model, 'batcher', None):
+        future = model.submit(image_path, features)
+    else:
+        future = _backend_executor.submit(model.predict, image_path, features)
     try:
-        image = cv2.imread(image_path)
-        if image is None:
-            return "Error", 0.0, "unknown"
-        
-        # Resize for faster processing (max 640px)
-        height, width = image.shape[:2]
-        if width > 640 or height > 640:
-            scale = 640 / max(width, height)
+        return future.result(timeout=budget_ms / 1000.0)
+    except FutureTimeout:
+        # The call keeps running in its worker thread; its result is discarded
+        future.cancel()
+        raise
+
+def predict_image_detailed(image_path, features=None, budget_ms=None):
+    """Classify with the primary backend inside a latency budget.
+
+    Falls back to the ``simulate_prediction`` HSV heuristic when the backend
+    times out, raises, or its circuit breaker is open, and marks the result
+    ``degraded`` with the reason. ``features`` from ``extract_features`` is
+    passed to both so the image is not decoded again.
+    """
+    if not os.path.exists(image_path):
+        return {'label': "Error", 'confidence': 0.0, 'food_type': "unknown", 'degraded': False, 'degraded_reason': None}
+    
+    budget_ms = PREDICT_BUDGET_MS if budget_ms is None else budget_ms
+    if breaker.allow():
+        try:
+            with metrics.stage("predict.primary"):
+                label, confidence, food_type = _call_primary(image_path, features, budget_ms)
+            breaker.record_success()
+            metrics.inc("food_backend_calls_total", outcome="ok")
+            return {'label': label, 'confidence': confidence, 'food_type': food_type, 'degraded': False, 'degraded_reason': None}
+        except FutureTimeout:
+            breaker.record_failure()
+            reason = 'timeout'
+        except Exception as e:
+            print(f"Prediction error: {str(e)}")
+            metrics.record_error("predict_image")
+            breaker.record_failure()
+            reason = 'error'
+    else:
+        reason = 'circuit_open'
+    
+    metrics.inc("food_backend_calls_total", outcome=reason)
+    metrics.record_fallback(f"predict_image.{reason}")
+    with metrics.stage("predict.fallback"):
+        label, confidence, food_type = simulate_prediction(image_path, features)
+    return {'label': label, 'confidence': confidence, 'food_type': food_type, 'degraded': True, 'degraded_reason': reason}
+
+def predict_image(image_path):
+    result = predict_image_detailed(image_path)
+    return result['label'], result['confidence'], result['food_type']
+
+def fit_analysis_size(image):
+    """Shrink a BGR image so its long side is at most ANALYSIS_MAX_DIMENSION."""
+    height, width = image.shape[:2]
+    if width > ANALYSIS_MAX_DIMENSION or height > ANALYSIS_MAX_DIMENSION:
+        with metrics.stage("simulate.resize"):
+            scale = ANALYSIS_MAX_DIMENSION / max(width, height)
             image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
-        
-        # Convert to HSV only (faster)
-        hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
-        
-        # Quick statistics
-        h_mean = np.mean(hsv[:, :, 0])
-        s_mean = np.mean(hsv[:, :, 1])
-        v_mean = np.mean(hsv[:, :, 2])
-        
-        total_pixels = hsv.shape[0] * hsv.shape[1]
-        
-        # Simplified spoilage detection (only critical ones)
+    return image
+
+def image_to_hsv(image):
+    """Shrink a BGR image to at most ANALYSIS_MAX_DIMENSION and convert it to HSV."""
+    image = fit_analysis_size(image)
+    with metrics.stage("simulate.color_convert"):
+        return cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+
+def spoilage_masks(hsv):
+    h, s, v = hsv[:, :, 0], hsv[:, :, 1], hsv[:, :, 2]
+    return {
         # 1. Mold (green/black spots)
-        mold_mask = ((hsv[:, :, 0] >= 80) & (hsv[:, :, 0] <= 140) & (hsv[:, :, 1] > 30) & (hsv[:, :, 2] < 100)) | \
-                    ((hsv[:, :, 1] < 20) & (hsv[:, :, 2] < 40))
-        mold_ratio = np.sum(mold_mask) / total_pixels
-        
+        'mold': ((h >= 80) & (h <= 140) & (s > 30) & (v < 100)) | ((s < 20) & (v < 40)),
         # 2. Dark brown rot
-        rotten_mask = (hsv[:, :, 0] >= 5) & (hsv[:, :, 0] <= 25) & (hsv[:, :, 1] > 40) & (hsv[:, :, 2] < 60)
-        rotten_ratio = np.sum(rotten_mask) / total_pixels
-        
+        'rotten': (h >= 5) & (h <= 25) & (s > 40) & (v < 60),
         # 3. Gray discoloration (cooked food)
-        gray_mask = (hsv[:, :, 1] < 30) & (hsv[:, :, 2] > 40) & (hsv[:, :, 2] < 120)
-        gray_ratio = np.sum(gray_mask) / total_pixels
-        
-        # Calculate freshness score
-        freshness_score = 70
-        freshness_score -= mold_ratio * 200
-        freshness_score -= rotten_ratio * 120
-        if gray_ratio > 0.3:
-            freshness_score -= 50
-        if v_mean < 35:
-            freshness_score -= 30
-        elif v_mean > 200:
-            freshness_score += 5
-        if s_mean > 100 and v_mean > 100:
-            freshness_score += 10
-        
-        freshness_score = max(0, min(100, freshness_score))
-        
-        # Quick food type detection
-        food_type = detect_food_category_fast(hsv, s_mean, v_mean)
-        
-        # Classification
-        if food_type == 'cooked_food':
-            if freshness_score >= 65:
-                label = "Fresh"
-                confidence = np.random.uniform(82, 92)
-            elif freshness_score >= 40:
-                label = "Okay"
-                confidence = np.random.uniform(72, 85)
-            else:
-                label = "Avoid"
-                confidence = np.random.uniform(82, 95)
-        else:
-            if freshness_score >= 60:
-                label = "Fresh"
-                confidence = np.random.uniform(85, 95)
-            elif freshness_score >= 35:
-                label = "Okay"
-                confidence = np.random.uniform(70, 85)
-            else:
-                label = "Avoid"
-                confidence = np.random.uniform(80, 95)
+        'gray': (s < 30) & (v > 40) & (v < 120),
+    }
+
+def color_ratios(hsv):
+    h, s, v = hsv[:, :, 0], hsv[:, :, 1], hsv[:, :, 2]
+    total_pixels = hsv.shape[0] * hsv.shape[1]
+    return (
+        np.count_nonzero((s < 40) & (v > 120)) / total_pixels,
+        np.count_nonzero((h > 40) & (h <= 85) & (s > 30)) / total_pixels,
+        np.count_nonzero((h > 10) & (h <= 40) & (s > 40)) / total_pixels,
+        np.count_nonzero((h > 5) & (h < 35) & (s < 100) & (v > 40)) / total_pixels,
+    )
+
+def compute_features(hsv, masks=None):
+    """Feature vector (FEATURE_NAMES order, float32) for an HSV image."""
+    with metrics.stage("simulate.features"):
+        masks = masks if masks is not None else spoilage_masks(hsv)
+        total_pixels = hsv.shape[0] * hsv.shape[1]
+        means = hsv.reshape(-1, 3).mean(axis=0)
+        return np.array([
+            means[0], means[1], means[2],
+            np.count_nonzero(masks['mold']) / total_pixels,
+            np.count_nonzero(masks['rotten']) / total_pixels,
+            np.count_nonzero(masks['gray']) / total_pixels,
+            *color_ratios(hsv),
+        ], dtype=np.float32)
+
+def load_analysis_image(image_path):
+    """BGR image decoded at (roughly) analysis size, or None if it cannot be read."""
+    with metrics.stage("simulate.decode"):
+        return decode_image(image_path, max_dimension=ANALYSIS_MAX_DIMENSION)
+
+def extract_features(image_path):
+    """Decode an image and return its feature vector, or None if it cannot be read."""
+    image = load_analysis_image(image_path)
+    if image is None:
+        return None
+    return compute_features(image_to_hsv(image))
+
+def pack_features(features):
+    return None if features is None else np.asarray(features, dtype=np.float32).tobytes()
+
+def unpack_features(blob):
+    return np.frombuffer(blob, dtype=np.float32)
+
+def _column(features, name):
+    return features[:, FEATURE_INDEX[name]]
+
+def freshness_scores(features):
+    """Vectorized freshness score (0-100) for an (N, len(FEATURE_NAMES)) matrix."""
+    features = np.atleast_2d(features)
+    v_mean, s_mean = _column(features, 'v_mean'), _column(features, 's_mean')
+    score = 70 - _column(features, 'mold_ratio') * 200 - _column(features, 'rotten_ratio') * 120
+    score = score - np.where(_column(features, 'gray_ratio') > 0.3, 50, 0)
+    score = score - np.where(v_mean < 35, 30, 0) + np.where(v_mean > 200, 5, 0)
+    score = score + np.where((s_mean > 100) & (v_mean > 100), 10, 0)
+    return np.clip(score, 0, 100)
+
+def food_categories(features, thresholds=None):
+    """Vectorized food category for an (N, len(FEATURE_NAMES)) matrix."""
+    c = (thresholds or THRESHOLDS)['categories']
+    features = np.atleast_2d(features)
+    white, green = _column(features, 'white_ratio'), _column(features, 'green_ratio')
+    orange, brown = _column(features, 'orange_ratio'), _column(features, 'brown_ratio')
+    s_mean, v_mean = _column(features, 's_mean'), _column(features, 'v_mean')
+    conditions = [
+        (white > c['cooked_white']) & ((orange > c['cooked_orange']) | (green > c['cooked_green'])),
+        white > c['dairy_white'],
+        (brown > c['bread_brown']) & (s_mean < c['bread_saturation']),
+        green > c['vegetable_green'],
+        (s_mean > c['fruit_saturation']) & (v_mean > c['fruit_value']),
+    ]
+    return np.select(conditions, ['cooked_food', 'dairy', 'bread', 'vegetable', 'fruit'], default='cooked_food')
+
+def freshness_labels(scores, categories, thresholds=None):
+    """Vectorized Fresh/Okay/Avoid labels from scores and per-category cutoffs."""
+    cutoffs = (thresholds or THRESHOLDS)['labels']
+    fresh_cut = np.full(len(scores), cutoffs['default']['fresh'], dtype=np.float64)
+    okay_cut = np.full(len(scores), cutoffs['default']['okay'], dtype=np.float64)
+    for category, cut in cutoffs.items():
+        if category != 'default':
+            selected = categories == category
+            fresh_cut[selected] = cut['fresh']
+            okay_cut[selected] = cut['okay']
+    return np.where(scores >= fresh_cut, 'Fresh', np.where(scores >= okay_cut, 'Okay', 'Avoid'))
+
+def confidence_range(food_type, label):
+    return CONFIDENCE_RANGES.get((food_type, label), CONFIDENCE_RANGES[('default', label)])
+
+def classify_features(features, thresholds=None):
+    """Label one feature vector: returns ``(label, confidence, food_type)``."""
+    scores = freshness_scores(features)
+    categories = food_categories(features, thresholds)
+    label = str(freshness_labels(scores, categories, thresholds)[0])
+    food_type = str(categories[0])
+    confidence = np.random.uniform(*confidence_range(food_type, label))
+    return label, round(confidence, 2), food_type
+
+def simulate_prediction(image_path, features=None):
+    try:
+        if features is None:
+            features = extract_features(image_path)
+        if features is None:
+            metrics.record_fallback("simulate_prediction.unreadable")
+            return "Error", 0.0, "unknown"
         
-        return label, round(confidence, 2), food_type
+        with metrics.stage("simulate.classify"):
+            return classify_features(features)
             
     except Exception as e:
         print(f"Simulation error: {str(e)}")
+        metrics.record_error("simulate_prediction")
+        metrics.record_fallback("simulate_prediction.default")
         return "Okay", 70.0, "fruit"
 
 def detect_food_category_fast(hsv, s_mean, v_mean):
     """Fast food category detection using pre-computed HSV"""
     try:
-        total_pixels = hsv.shape[0] * hsv.shape[1]
-        
-        # Quick color ratios
-        white_ratio = np.sum((hsv[:, :, 1] < 40) & (hsv[:, :, 2] > 120)) / total_pixels
-        green_ratio = np.sum((hsv[:, :, 0] > 40) & (hsv[:, :, 0] <= 85) & (hsv[:, :, 1] > 30)) / total_pixels
-        orange_ratio = np.sum((hsv[:, :, 0] > 10) & (hsv[:, :, 0] <= 40) & (hsv[:, :, 1] > 40)) / total_pixels
-        brown_ratio = np.sum((hsv[:, :, 0] > 5) & (hsv[:, :, 0] < 35) & (hsv[:, :, 1] < 100) & (hsv[:, :, 2] > 40)) / total_pixels
-        
-        # Quick classification
-        if white_ratio > 0.25 and (orange_ratio > 0.15 or green_ratio > 0.10):
-            return "cooked_food"
-        if white_ratio > 0.50:
-            return "dairy"
-        if brown_ratio > 0.30 and s_mean < 50:
-            return "bread"
-        if green_ratio > 0.25:
-            return "vegetable"
-        if s_mean > 60 and v_mean > 100:
-            return "fruit"
-        return "cooked_food"
+        row = np.zeros(len(FEATURE_NAMES), dtype=np.float32)
+        row[FEATURE_INDEX['s_mean']] = s_mean
+        row[FEATURE_INDEX['v_mean']] = v_mean
+        row[FEATURE_INDEX['white_ratio']:] = color_ratios(hsv)
+        return str(food_categories(row)[0])
     except:
+        metrics.record_error("detect_food_category_fast")
+        metrics.record_fallback("detect_food_category_fast.default")
         return "fruit"
 
 def detect_food_category(image_path):
     """Detailed food category detection (fallback)"""
     try:
-        image = cv2.imread(image_path)
+        with metrics.stage("food_type.decode"):
+            image = decode_image(image_path, max_dimension=ANALYSIS_MAX_DIMENSION)
         if image is None:
+            metrics.record_fallback("detect_food_category.unreadable")
             return "fruit"
         
-        # Resize for speed
-        height, width = image.shape[:2]
-        if width > 640 or height > 640:
-            scale = 640 / max(width, height)
-            image = cv2.resize(image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
-        
-        hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+        hsv = image_to_hsv(image)
         s_mean = np.mean(hsv[:, :, 1])
         v_mean = np.mean(hsv[:, :, 2])
         
@@ -218,6 +409,8 @@ def detect_food_category(image_path):
             
     except Exception as e:
         print(f"Food category detection error: {str(e)}")
+        metrics.record_error("detect_food_category")
+        metrics.record_fallback("detect_food_category.default")
         return "cooked_food"
 
 def get_storage_tips(food_type):
@@ -225,22 +418,28 @@ def get_storage_tips(food_type):
 
 def analyze_image_quality(image_path):
     try:
-        image = cv2.imread(image_path)
+        with metrics.stage("quality.decode"):
+            image = decode_image(image_path, max_dimension=ANALYSIS_MAX_DIMENSION)
         if image is None:
+            metrics.record_fallback("analyze_image_quality.unreadable")
             return {"quality": "Poor", "resolution": "Unknown", "blur_score": 0}
         
-        height, width = image.shape[:2]
-        gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+        # Resolution of the original file; blur and lighting are measured at analysis size
+        width, height = oriented_size(sniff_image(image_path))
+        image = fit_analysis_size(image)
         
         # Calculate blur score using Laplacian variance
-        blur_score = cv2.Laplacian(gray, cv2.CV_64F).var()
+        with metrics.stage("quality.blur"):
+            gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY)
+            blur_score = cv2.Laplacian(gray, cv2.CV_64F).var()
         
         # Analyze image for quality indicators (not freshness)
-        hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
-        
-        # Check lighting quality
-        brightness = np.mean(hsv[:, :, 2])
-        brightness_std = np.std(hsv[:, :, 2])
+        with metrics.stage("quality.lighting"):
+            hsv = cv2.cvtColor(image, cv2.COLOR_BGR2HSV)
+            
+            # Check lighting quality
+            brightness = np.mean(hsv[:, :, 2])
+            brightness_std = np.std(hsv[:, :, 2])
         
         # Check if image is too dark or overexposed
         too_dark = brightness < 50
@@ -273,4 +472,6 @@ def analyze_image_quality(image_path):
         }
     except Exception as e:
         print(f"Quality analysis error: {str(e)}")
+        metrics.record_error("analyze_image_quality")
+        metrics.record_fallback("analyze_image_quality.default")
         return {"quality": "Unknown", "resolution": "Unknown", "blur_score": 0}
@@ -0,0 +1,154 @@
+"""Opt-in per-request profiling with on-disk dumps.
+
+Profiling is off by default. It can be switched on for a random fraction of
+requests to the heavy endpoints (``PROFILE_REQUESTS=1`` plus
+``PROFILE_SAMPLE_RATE``), or for a single request by sending the
+``X-Profile`` header with the value of ``PROFILE_TOKEN``.
+
+Two profilers are available:
+
+* ``cprofile`` (default) - deterministic, writes ``.pstats`` files that load
+  with ``python -m pstats`` or snakeviz.
+* ``sample`` - a background thread samples the request thread's stack every
+  ``PROFILE_INTERVAL_MS`` and writes ``.collapsed`` stacks for flamegraph.pl
+  or speedscope.
+
+At most ``PROFILE_MAX_FILES`` dumps are kept; the oldest are pruned.
+"""
+import cProfile
+import os
+import random
+import sys
+import threading
+import time
+from collections import Counter
+
+from flask import g, request
+
+import metrics
+
+DEFAULT_ENDPOINTS = ('predict', 'analytics', 'download_pdf', 'email_report')
+
+
+def _env_flag(name, default='0'):
+    return os.environ.get(name, default).lower() in ('1', 'true', 'yes', 'on')
+
+
+class StackSampler:
+    """Collects collapsed stacks of one thread by polling ``sys._current_frames``."""
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name='profile-sampler', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            parts = []
+            while frame is not None:
+                code = frame.f_code
+                parts.append(f"{os.path.basename(code.co_filename)}:{code.co_name}:{frame.f_lineno}")
+                frame = frame.f_back
+            self.stacks[';'.join(reversed(parts))] += 1
+
+    def dump(self, path):
+        with open(path, 'w') as fh:
+            for stack, count in self.stacks.most_common():
+                fh.write(f"{stack} {count}\n")
+
+
+def init_profiling(app):
+    app.config.setdefault('PROFILE_REQUESTS', _env_flag('PROFILE_REQUESTS'))
+    app.config.setdefault('PROFILE_TOKEN', os.environ.get('PROFILE_TOKEN'))
+    app.config.setdefault('PROFILE_MODE', os.environ.get('PROFILE_MODE', 'cprofile'))
+    app.config.setdefault('PROFILE_SAMPLE_RATE', float(os.environ.get('PROFILE_SAMPLE_RATE', '0.01')))
+    app.config.setdefault('PROFILE_INTERVAL_MS', float(os.environ.get('PROFILE_INTERVAL_MS', '5')))
+    app.config.setdefault('PROFILE_DIR', os.environ.get('PROFILE_DIR', os.path.join(app.instance_path, 'profiles')))
+    app.config.setdefault('PROFILE_MAX_FILES', int(os.environ.get('PROFILE_MAX_FILES', '200')))
+    app.config.setdefault('PROFILE_ENDPOINTS', DEFAULT_ENDPOINTS)
+
+    @app.before_request
+    def start_profiler():
+        if not _should_profile(app.config):
+            return
+        if app.config['PROFILE_MODE'] == 'sample':
+            profiler = StackSampler(threading.get_ident(), app.config['PROFILE_INTERVAL_MS'] / 1000.0)
+            profiler.start()
+        else:
+            profiler = cProfile.Profile()
+            profiler.enable()
+        g.profiler = profiler
+        g.profile_started = time.perf_counter()
+
+    @app.after_request
+    def tag_profiled_response(response):
+        if 'profiler' in g:
+            g.profile_name = _profile_name(time.perf_counter() - g.profile_started)
+            response.headers['X-Profile-Id'] = g.profile_name
+        return response
+
+    @app.teardown_request
+    def stop_profiler(exc):
+        profiler = g.pop('profiler', None)
+        if profiler is None:
+            return
+        name = g.pop('profile_name', None) or _profile_name(time.perf_counter() - g.profile_started)
+        try:
+            if isinstance(profiler, StackSampler):
+                profiler.stop()
+                _write(app.config, profiler, name + '.collapsed')
+            else:
+                profiler.disable()
+                _write(app.config, profiler, name + '.pstats')
+        except Exception as e:
+            print(f"Profile dump error: {str(e)}")
+            metrics.record_error("profiling.dump")
+
+
+def _should_profile(config):
+    token = config['PROFILE_TOKEN']
+    if token and request.headers.get('X-Profile') == token:
+        return True
+    if not config['PROFILE_REQUESTS'] or request.endpoint not in config['PROFILE_ENDPOINTS']:
+        return False
+    return random.random() < config['PROFILE_SAMPLE_RATE']
+
+
+def _profile_name(elapsed):
+    stamp = time.strftime('%Y%m%d-%H%M%S')
+    return f"{stamp}_{request.endpoint or 'unmatched'}_{int(elapsed * 1000)}ms_{os.getpid()}_{threading.get_ident() % 10000}"
+
+
+def _write(config, profiler, filename):
+    directory = config['PROFILE_DIR']
+    os.makedirs(directory, exist_ok=True)
+    if isinstance(profiler, StackSampler):
+        profiler.dump(os.path.join(directory, filename))
+    else:
+        profiler.dump_stats(os.path.join(directory, filename))
+    metrics.inc("food_profiles_written_total", endpoint=request.endpoint or 'unmatched')
+    _prune(directory, config['PROFILE_MAX_FILES'])
+
+
+def _prune(directory, max_files):
+    entries = [e for e in os.scandir(directory) if e.is_file() and e.name.endswith(('.pstats', '.collapsed'))]
+    if len(entries) <= max_files:
+        return
+    entries.sort(key=lambda e: e.stat().st_mtime)
+    for entry in entries[:len(entries) - max_files]:
+        try:
+            os.remove(entry.path)
+        except OSError:
+            pass
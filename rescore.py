@@ -0,0 +1,157 @@
+"""Re-score stored analyses from their persisted feature vectors.
+
+Each Analysis keeps the float32 vector ``predict.extract_features`` produced
+for its image. Trying new cutoffs or a new scoring function only needs
+those vectors: they are read into one matrix, scored with the vectorized
+functions in ``predict``, and only rows whose label or food type changed
+are written back. No image is decoded.
+"""
+import importlib
+import time
+
+import numpy as np
+from sqlalchemy import bindparam, func, select, update
+
+import fragments
+import metrics
+import storage
+from archive import COLD, rebuild_counts, select_analyses, tables as archive_tables
+from auth import db
+from predict import (FEATURE_NAMES, confidence_range, extract_features, food_categories,
+                     freshness_labels, freshness_scores, pack_features)
+
+
+def default_scorer(features, thresholds):
+    """The heuristic's own rules: returns ``(labels, food_types)`` arrays."""
+    categories = food_categories(features, thresholds)
+    return freshness_labels(freshness_scores(features), categories, thresholds), categories
+
+
+def load_scorer(spec):
+    """Import a ``module:function`` scorer with the same signature as ``default_scorer``."""
+    module_name, _, name = spec.partition(':')
+    return getattr(importlib.import_module(module_name), name or 'score')
+
+
+def load_feature_matrix(user_id=None, chunk_size=50000):
+    """Return ``(ids, labels, food_types, features)`` for every analysis with a stored vector, archived ones included."""
+    width = len(FEATURE_NAMES)
+
+    def build(table):
+        query = (select(table.c.id, table.c.label, table.c.food_type, table.c.features)
+                 .where(func.length(table.c.features) == width * 4))
+        if user_id is not None:
+            query = query.where(table.c.user_id == user_id)
+        return query
+
+    query = select_analyses(build)
+    query = query.order_by(query.selected_columns.id).execution_options(yield_per=chunk_size)
+
+    ids, labels, food_types, blobs = [], [], [], []
+    for row_id, label, food_type, blob in db.session.execute(query):
+        ids.append(row_id)
+        labels.append(label)
+        food_types.append(food_type or '')
+        blobs.append(blob)
+    features = np.frombuffer(b''.join(blobs), dtype=np.float32).reshape(-1, width)
+    return np.array(ids, dtype=np.int64), np.array(labels, dtype=str), np.array(food_types, dtype=str), features
+
+
+def rescore_analyses(thresholds=None, scorer=None, user_id=None, apply=False, chunk_size=50000):
+    """Re-label stored analyses; with ``apply`` write the changes back.
+
+    Changed rows get the midpoint of the new label's confidence range.
+    Returns a summary dict with row counts, ``old -> new`` label
+    transitions and the time spent loading, scoring and writing.
+    """
+    scorer = scorer or default_scorer
+    summary = {'rows': 0, 'changed': 0, 'transitions': {}, 'applied': apply}
+
+    started = time.perf_counter()
+    with metrics.stage("rescore.load"):
+        ids, old_labels, old_food_types, features = load_feature_matrix(user_id, chunk_size)
+    summary['rows'] = len(ids)
+    summary['load_seconds'] = time.perf_counter() - started
+
+    started = time.perf_counter()
+    with metrics.stage("rescore.score"):
+        new_labels, new_food_types = scorer(features, thresholds)
+        new_labels = np.asarray(new_labels, dtype=str)
+        new_food_types = np.asarray(new_food_types, dtype=str)
+        changed = np.flatnonzero((new_labels != old_labels) | (new_food_types != old_food_types))
+    summary['score_seconds'] = time.perf_counter() - started
+    summary['changed'] = len(changed)
+
+    if len(changed):
+        pairs, counts = np.unique(np.char.add(np.char.add(old_labels[changed], ' -> '), new_labels[changed]),
+                                  return_counts=True)
+        summary['transitions'] = {str(pair): int(count) for pair, count in zip(pairs, counts)}
+
+    started = time.perf_counter()
+    if apply and len(changed):
+        # Each id is in one of the two tables; the update is a no-op in the other
+        tables = archive_tables()
+        statements = [(update(table)
+                       .where(table.c.id == bindparam('row_id'))
+                       .values(label=bindparam('new_label'), food_type=bindparam('new_food_type'),
+                               confidence=bindparam('new_confidence')))
+                      for table in tables]
+        with metrics.stage("rescore.write"):
+            for start in range(0, len(changed), chunk_size):
+                rows = []
+                for i in changed[start:start + chunk_size]:
+                    low, high = confidence_range(new_food_types[i], new_labels[i])
+                    rows.append({'row_id': int(ids[i]), 'new_label': str(new_labels[i]),
+                                 'new_food_type': str(new_food_types[i]), 'new_confidence': (low + high) / 2})
+                for statement in statements:
+                    db.session.execute(statement, rows)
+            db.session.commit()
+        if COLD in tables:
+            # Archived labels changed, so their per-user totals are stale
+            rebuild_counts()
+        # Core updates skip the session hooks that bump versions; one global bump covers every user
+        fragments.bump_global()
+        metrics.inc("food_rescored_rows_total", len(changed))
+    summary['write_seconds'] = time.perf_counter() - started
+    return summary
+
+
+def backfill_features(batch_size=200):
+    """Compute and store feature vectors for analyses saved before they were persisted, archived ones included.
+
+    Returns ``(filled, missing)``; ``missing`` counts rows whose image is gone.
+    """
+    filled = missing = 0
+    for table in archive_tables():
+        table_filled, table_missing = _backfill_table(table, batch_size)
+        filled += table_filled
+        missing += table_missing
+    return filled, missing
+
+
+def _backfill_table(table, batch_size):
+    statement = update(table).where(table.c.id == bindparam('row_id')).values(features=bindparam('new_features'))
+    filled = missing = 0
+    last_id = 0
+    while True:
+        rows = db.session.execute(
+            select(table.c.id, table.c.image_filename)
+            .where(table.c.features.is_(None), table.c.id > last_id)
+            .order_by(table.c.id).limit(batch_size)
+        ).all()
+        if not rows:
+            break
+        params = []
+        for row_id, image_filename in rows:
+            # Sharded names resolve under their shard directories
+            features = extract_features(storage.upload_path(image_filename))
+            if features is None:
+                missing += 1
+                continue
+            params.append({'row_id': row_id, 'new_features': pack_features(features)})
+        if params:
+            db.session.execute(statement, params)
+        db.session.commit()
+        filled += len(params)
+        last_id = rows[-1][0]
+    return filled, missing
@@ -0,0 +1,321 @@
+"""Retention for uploaded images, spoilage heatmaps and PDF reports.
+
+Each artifact type has its own age limit (0 keeps it forever):
+
+``originals``
+    Uploaded images of analyses older than ``RETENTION_ORIGINALS_DAYS``.
+    The file and its heatmap are deleted. The ``Analysis`` row, with its
+    features and embedding, is kept and marked ``image_purged_at``.
+``renditions``
+    Heatmap overlays of analyses older than ``RETENTION_RENDITIONS_DAYS``.
+    ``heatmap_filename`` is cleared.
+``reports``
+    PDF reports, which are regenerated on every download, once their file
+    is older than ``RETENTION_REPORTS_DAYS``.
+``orphans``
+    Files under the upload root that no ``Analysis`` row references, such
+    as images left behind by a request that failed before its commit.
+    Only files older than ``RETENTION_ORPHAN_GRACE_HOURS`` are removed, so
+    uploads still being analyzed are safe.
+``batches``
+    Stored results of multi-image uploads (``AnalysisBatch``) older than
+    ``RETENTION_BATCHES_DAYS``. Not files either; the analyses they list
+    are kept.
+``archive``
+    Not a file type: analyses older than ``ARCHIVE_AFTER_DAYS`` move to the
+    archive table (see archive.py). Archived rows still count as
+    references for ``orphans`` and still expire under the two row-based
+    policies.
+
+Rows are handled in id order, ``RETENTION_BATCH_SIZE`` per query and per
+commit. Orphans are checked against the database one batch of file names
+at a time. A sweep runs from ``flask sweep`` (cron) or, with
+``RETENTION_SWEEP_INTERVAL`` set, from a background thread in every
+worker. A file lock lets only one process sweep at a time, and a sweep is
+skipped if another process finished one within the interval.
+"""
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from sqlalchemy import bindparam, delete, select, update
+
+import archive
+import fragments
+import metrics
+import storage
+from archive import ARCHIVE_AFTER_DAYS
+from auth import db, AnalysisBatch
+
+try:
+    import fcntl
+except ImportError:
+    # Windows: no cross-process lock; run a single sweeper there
+    fcntl = None
+
+RETENTION_ORIGINALS_DAYS = float(os.environ.get('RETENTION_ORIGINALS_DAYS', 0))
+RETENTION_RENDITIONS_DAYS = float(os.environ.get('RETENTION_RENDITIONS_DAYS', 0))
+RETENTION_REPORTS_DAYS = float(os.environ.get('RETENTION_REPORTS_DAYS', 7))
+RETENTION_ORPHAN_GRACE_HOURS = float(os.environ.get('RETENTION_ORPHAN_GRACE_HOURS', 24))
+RETENTION_BATCHES_DAYS = float(os.environ.get('RETENTION_BATCHES_DAYS', 30))
+RETENTION_BATCH_SIZE = int(os.environ.get('RETENTION_BATCH_SIZE', 500))
+# Seconds between in-process sweeps; 0 leaves sweeping to `flask sweep`
+RETENTION_SWEEP_INTERVAL = float(os.environ.get('RETENTION_SWEEP_INTERVAL', 0))
+SWEEP_LOCK_PATH = os.environ.get('RETENTION_LOCK_PATH', os.path.join('instance', 'retention.lock'))
+
+ARTIFACTS = ('originals', 'renditions', 'reports', 'orphans', 'batches', 'archive')
+
+
+def _remove(path, dry_run):
+    """``(files, bytes)`` removed for ``path``; a file that is already gone counts as nothing."""
+    try:
+        size = os.path.getsize(path)
+        if not dry_run:
+            os.remove(path)
+    except FileNotFoundError:
+        return 0, 0
+    return 1, size
+
+
+def _expire_rows(cutoff, purge_images, now, batch_size, dry_run):
+    files = reclaimed = 0
+    for table in (archive.HOT, archive.COLD):
+        table_files, table_bytes = _expire_table(table, cutoff, purge_images, now, batch_size, dry_run)
+        files += table_files
+        reclaimed += table_bytes
+    return files, reclaimed
+
+
+def _expire_table(table, cutoff, purge_images, now, batch_size, dry_run):
+    conditions = [table.c.timestamp < cutoff]
+    if purge_images:
+        conditions.append(table.c.image_purged_at.is_(None))
+        statement = (update(table).where(table.c.id == bindparam('row_id'))
+                     .values(heatmap_filename=None, image_purged_at=now))
+    else:
+        conditions.append(table.c.heatmap_filename.isnot(None))
+        statement = update(table).where(table.c.id == bindparam('row_id')).values(heatmap_filename=None)
+
+    files = reclaimed = 0
+    last_id = 0
+    while True:
+        rows = db.session.execute(
+            select(table.c.id, table.c.image_filename, table.c.heatmap_filename, table.c.user_id)
+            .where(table.c.id > last_id, *conditions)
+            .order_by(table.c.id).limit(batch_size)
+        ).all()
+        if not rows:
+            break
+        for _, image, heat, _ in rows:
+            names = [heat] if heat else []
+            if purge_images:
+                names.append(image)
+            for name in names:
+                removed, size = _remove(storage.upload_path(name), dry_run)
+                files += removed
+                reclaimed += size
+        if not dry_run:
+            db.session.connection().execute(statement, [{'row_id': row[0]} for row in rows])
+            # Core updates skip the session hooks that bump the cached pages' versions
+            fragments.bump_users({row.user_id for row in rows})
+            db.session.commit()
+        last_id = rows[-1][0]
+    return files, reclaimed
+
+
+def _walk_files(root):
+    """``(relname, path, stat)`` for every file below ``root``, without building the full list."""
+    pending = [(root, '')]
+    while pending:
+        directory, prefix = pending.pop()
+        try:
+            entries = list(os.scandir(directory))
+        except FileNotFoundError:
+            continue
+        for entry in entries:
+            if entry.name.startswith('.'):
+                continue
+            if entry.is_dir(follow_symlinks=False):
+                pending.append((entry.path, prefix + entry.name + '/'))
+            elif entry.is_file(follow_symlinks=False):
+                yield prefix + entry.name, entry.path, entry.stat()
+
+
+def expire_reports(cutoff, dry_run=False):
+    cutoff_ts = cutoff.timestamp()
+    files = reclaimed = 0
+    for _, path, stat in _walk_files(storage.REPORT_ROOT):
+        if stat.st_mtime < cutoff_ts:
+            removed, size = _remove(path, dry_run)
+            files += removed
+            reclaimed += size
+    return files, reclaimed
+
+
+def expire_batches(cutoff, batch_size=RETENTION_BATCH_SIZE, dry_run=False):
+    """Delete stored batch results created before ``cutoff``; returns the row count."""
+    table = AnalysisBatch.__table__
+    query = select(table.c.id).where(table.c.created_at < cutoff).order_by(table.c.id)
+    if dry_run:
+        return len(db.session.execute(query).all())
+    rows = 0
+    while True:
+        ids = db.session.execute(query.limit(batch_size)).scalars().all()
+        if not ids:
+            return rows
+        db.session.execute(delete(table).where(table.c.id.in_(ids)))
+        db.session.commit()
+        rows += len(ids)
+
+
+def _referenced(names):
+    found = set()
+    for table in (archive.HOT, archive.COLD):
+        found.update(db.session.execute(
+            select(table.c.image_filename).where(table.c.image_filename.in_(names))).scalars())
+        found.update(db.session.execute(
+            select(table.c.heatmap_filename).where(table.c.heatmap_filename.in_(names))).scalars())
+    return found
+
+
+def sweep_orphans(cutoff, batch_size=RETENTION_BATCH_SIZE, dry_run=False):
+    """Delete upload files older than ``cutoff`` that no analysis references."""
+    cutoff_ts = cutoff.timestamp()
+    files = reclaimed = 0
+
+    def flush(batch):
+        nonlocal files, reclaimed
+        referenced = _referenced([relname for relname, _ in batch])
+        for relname, path in batch:
+            if relname not in referenced:
+                removed, size = _remove(path, dry_run)
+                files += removed
+                reclaimed += size
+
+    batch = []
+    for relname, path, stat in _walk_files(storage.UPLOAD_ROOT):
+        if stat.st_mtime < cutoff_ts:
+            batch.append((relname, path))
+            if len(batch) >= batch_size:
+                flush(batch)
+                batch = []
+    if batch:
+        flush(batch)
+    db.session.rollback()
+    return files, reclaimed
+
+
+@contextmanager
+def sweep_lock(path=SWEEP_LOCK_PATH):
+    """Yields the open lock file if this process holds the sweep lock, else None."""
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    handle = open(path, 'a+')
+    try:
+        if fcntl is not None:
+            try:
+                fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                yield None
+                return
+        yield handle
+    finally:
+        handle.close()
+
+
+def _last_sweep(handle):
+    handle.seek(0)
+    try:
+        return float(handle.read().strip() or 0)
+    except ValueError:
+        return 0.0
+
+
+def run_sweep(artifacts=ARTIFACTS, dry_run=False, now=None, min_interval=0, batch_size=RETENTION_BATCH_SIZE):
+    """Apply the retention policy once.
+
+    Returns ``{artifact: {'files': n, 'bytes': n}, 'seconds': s}`` (plus ``'rows'``
+    for ``batches`` and ``archive``), or None when
+    another process holds the lock or finished a sweep less than ``min_interval``
+    seconds ago.
+    """
+    now = now or datetime.utcnow()
+    with sweep_lock() as handle:
+        if handle is None or (min_interval and time.time() - _last_sweep(handle) < min_interval):
+            return None
+        started = time.perf_counter()
+        summary = {}
+        for artifact in artifacts:
+            files = reclaimed = rows = 0
+            with metrics.stage(f"retention.{artifact}"):
+                if artifact == 'originals' and RETENTION_ORIGINALS_DAYS > 0:
+                    files, reclaimed = _expire_rows(now - timedelta(days=RETENTION_ORIGINALS_DAYS), True, now,
+                                                    batch_size, dry_run)
+                elif artifact == 'renditions' and RETENTION_RENDITIONS_DAYS > 0:
+                    files, reclaimed = _expire_rows(now - timedelta(days=RETENTION_RENDITIONS_DAYS), False, now,
+                                                    batch_size, dry_run)
+                elif artifact == 'reports' and RETENTION_REPORTS_DAYS > 0:
+                    files, reclaimed = expire_reports(now - timedelta(days=RETENTION_REPORTS_DAYS), dry_run)
+                elif artifact == 'orphans' and RETENTION_ORPHAN_GRACE_HOURS > 0:
+                    files, reclaimed = sweep_orphans(now - timedelta(hours=RETENTION_ORPHAN_GRACE_HOURS),
+                                                     batch_size, dry_run)
+                elif artifact == 'batches' and RETENTION_BATCHES_DAYS > 0:
+                    rows = expire_batches(now - timedelta(days=RETENTION_BATCHES_DAYS), batch_size, dry_run)
+                elif artifact == 'archive' and ARCHIVE_AFTER_DAYS > 0:
+                    rows = archive.archive_rows(now - timedelta(days=ARCHIVE_AFTER_DAYS), dry_run=dry_run)
+            summary[artifact] = {'files': files, 'bytes': reclaimed}
+            if artifact in ('batches', 'archive'):
+                summary[artifact]['rows'] = rows
+            if not dry_run:
+                metrics.inc("food_retention_deleted_files_total", files, artifact=artifact)
+                metrics.inc("food_retention_reclaimed_bytes_total", reclaimed, artifact=artifact)
+        summary['seconds'] = time.perf_counter() - started
+        if not dry_run:
+            handle.seek(0)
+            handle.truncate()
+            handle.write(str(time.time()))
+            handle.flush()
+            metrics.set_gauge("food_retention_last_sweep_timestamp", time.time())
+        return summary
+
+
+class Sweeper:
+    """Runs ``run_sweep`` every ``interval`` seconds in a daemon thread of each worker."""
+
+    def __init__(self, app, interval):
+        self.app = app
+        self.interval = interval
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def ensure_running(self):
+        # Threads do not survive fork (gunicorn --preload), so start one per process
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            threading.Thread(target=self._run, name='retention-sweeper', daemon=True).start()
+            self._pid = os.getpid()
+
+    def _run(self):
+        while True:
+            # Jitter so workers started together do not all contend for the lock at once
+            time.sleep(self.interval * random.uniform(0.5, 1.5))
+            try:
+                with self.app.app_context():
+                    run_sweep(min_interval=self.interval * 0.9)
+            except Exception as e:
+                print(f"Retention sweep error: {str(e)}")
+                metrics.record_error("retention.sweep")
+
+
+def init_retention(app):
+    """Start the in-process sweeper with each worker's first request when ``RETENTION_SWEEP_INTERVAL`` is set."""
+    if RETENTION_SWEEP_INTERVAL <= 0:
+        return None
+    sweeper = Sweeper(app, RETENTION_SWEEP_INTERVAL)
+    app.before_request(sweeper.ensure_running)
+    return sweeper
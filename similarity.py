@@ -0,0 +1,340 @@
+"""Per-user nearest-neighbour search over colour/spoilage embeddings.
+
+Each analysis stores an embedding: HSV hue/saturation/value histograms
+plus the spoilage and colour ratios from ``predict.compute_features``,
+L2-normalised so a dot product is cosine similarity.
+
+A user's vectors are searched by brute force while they have fewer than
+``SIMILAR_IVF_MIN`` of them. Past that, an inverted-file (IVF) index is
+trained: k-means centroids split the vectors into lists, and a query
+only scans the ``SIMILAR_NPROBE`` lists whose centroids are nearest.
+New analyses go into a small tail that is scanned directly and merged
+into the lists in bulk. Indexes are loaded from ``Analysis.embedding`` on
+first use and kept for the ``SIMILAR_MAX_USERS`` most recent users.
+
+As in phash.py, a new analysis is added to its user's index when its
+session commits (``add_on_commit``), and each search first reads the
+user's rows above the highest id loaded. Removed rows (archived or
+deleted, or found missing by a search, which then runs again to fill
+``k``) become tombstones that searches skip.
+
+Requests only ever do that incremental catch-up. Training the IVF lists,
+dropping tombstones and the periodic reload (every
+``SIMILAR_RELOAD_SECONDS``) happen by building a fresh index on the
+background thread (``offload.run_background``), which then replaces the
+old one; until it does, searches use the old index, by brute force if it
+is not trained yet.
+"""
+import os
+import threading
+import time
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+from flask import current_app
+from sqlalchemy import event, select
+from sqlalchemy.orm import Session
+
+import metrics
+import offload
+from auth import db, Analysis
+from predict import FEATURE_INDEX
+
+SIMILAR_IVF_MIN = int(os.environ.get('SIMILAR_IVF_MIN', 20000))
+SIMILAR_NPROBE = int(os.environ.get('SIMILAR_NPROBE', 8))
+SIMILAR_MAX_USERS = int(os.environ.get('SIMILAR_MAX_USERS', 256))
+# Seconds after which a user's index is loaded again; 0 never reloads
+SIMILAR_RELOAD_SECONDS = float(os.environ.get('SIMILAR_RELOAD_SECONDS', 300))
+
+HUE_BINS, SAT_BINS, VAL_BINS = 18, 8, 8
+RATIO_NAMES = ('mold_ratio', 'rotten_ratio', 'gray_ratio', 'white_ratio', 'green_ratio', 'orange_ratio', 'brown_ratio')
+# Spoilage ratios are small fractions; weight them up against the histograms
+RATIO_WEIGHT = 2.0
+EMBEDDING_DIM = HUE_BINS + SAT_BINS + VAL_BINS + len(RATIO_NAMES)
+# Tail size at which new vectors are merged into the IVF lists
+MERGE_THRESHOLD = 4096
+# Share of tombstoned vectors at which the index is rebuilt without them
+MAX_DEAD_FRACTION = 0.25
+
+
+def embed(hsv, features):
+    """Unit-length float32 embedding of an HSV image and its feature vector."""
+    parts = []
+    for channel, bins, upper in ((0, HUE_BINS, 180), (1, SAT_BINS, 256), (2, VAL_BINS, 256)):
+        hist = cv2.calcHist([hsv], [channel], None, [bins], [0, upper]).ravel()
+        parts.append(hist / max(hist.sum(), 1))
+    parts.append(RATIO_WEIGHT * np.array([features[FEATURE_INDEX[name]] for name in RATIO_NAMES]))
+    vector = np.concatenate(parts).astype(np.float32)
+    return vector / max(np.linalg.norm(vector), 1e-6)
+
+
+def pack_embedding(vector):
+    return None if vector is None else np.asarray(vector, dtype=np.float32).tobytes()
+
+
+def kmeans(vectors, k, iterations=10, sample=65536, seed=0):
+    """Spherical k-means centroids trained on a sample of ``vectors``."""
+    rng = np.random.default_rng(seed)
+    if len(vectors) > sample:
+        vectors = vectors[rng.choice(len(vectors), sample, replace=False)]
+    centroids = vectors[rng.choice(len(vectors), k, replace=False)].copy()
+    for _ in range(iterations):
+        assign = np.argmax(vectors @ centroids.T, axis=1)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, vectors)
+        norms = np.linalg.norm(sums, axis=1, keepdims=True)
+        empty = norms[:, 0] == 0
+        centroids = np.where(empty[:, None], centroids, sums / np.maximum(norms, 1e-6))
+    return centroids
+
+
+def _top_k(ids, scores, k):
+    if len(scores) > k:
+        best = np.argpartition(-scores, k)[:k]
+        ids, scores = ids[best], scores[best]
+    order = np.argsort(-scores)
+    return list(zip(ids[order].tolist(), scores[order].tolist()))
+
+
+class VectorIndex:
+    def __init__(self, dim=EMBEDDING_DIM):
+        self.vectors = np.empty((1024, dim), dtype=np.float32)
+        self.ids = np.empty(1024, dtype=np.int64)
+        self.count = 0
+        # Highest id loaded from the database, and ids added above it since
+        self.max_id = 0
+        self._added = set()
+        self.loaded_at = time.monotonic()
+        # Sorted ids of removed rows, skipped by searches until the next rebuild
+        self._dead = np.empty(0, dtype=np.int64)
+        # IVF state; the first ``indexed`` rows are in the lists, the rest are the tail
+        self.centroids = None
+        self.trained_on = 0
+        self.indexed = 0
+        self._assignments = None
+        self._order = None
+        self._offsets = None
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return self.count - len(self._dead)
+
+    def _reserve(self, extra):
+        needed = self.count + extra
+        if needed > len(self.ids):
+            capacity = max(needed, 2 * len(self.ids))
+            vectors = np.empty((capacity, self.vectors.shape[1]), dtype=np.float32)
+            vectors[:self.count] = self.vectors[:self.count]
+            ids = np.empty(capacity, dtype=np.int64)
+            ids[:self.count] = self.ids[:self.count]
+            self.vectors, self.ids = vectors, ids
+
+    def add_many(self, ids, vectors):
+        """Bulk insert of loaded rows, skipping ids already inserted with ``add``."""
+        with self._lock:
+            if not len(ids):
+                return
+            self.max_id = max(self.max_id, int(np.max(ids)))
+            if self._added:
+                new = ~np.isin(ids, list(self._added))
+                ids, vectors = ids[new], vectors[new]
+                self._added = {added for added in self._added if added > self.max_id}
+            self._append(ids, vectors)
+
+    def add(self, analysis_id, vector):
+        with self._lock:
+            if analysis_id > self.max_id:
+                self._added.add(analysis_id)
+            elif (self.ids[:self.count] == analysis_id).any():
+                # Already loaded by a reload that ran while it committed
+                return
+            self._append(np.array([analysis_id], dtype=np.int64), np.asarray(vector, dtype=np.float32)[None, :])
+
+    def _append(self, ids, vectors):
+        if not len(ids):
+            return
+        self._reserve(len(ids))
+        self.vectors[self.count:self.count + len(ids)] = vectors
+        self.ids[self.count:self.count + len(ids)] = ids
+        self.count += len(ids)
+        self._maintain()
+
+    def remove(self, ids):
+        """Tombstone ``ids`` (archived or deleted analyses); searches skip them."""
+        ids = np.asarray(ids, dtype=np.int64)
+        with self._lock:
+            ids = ids[np.isin(ids, self.ids[:self.count])]
+            if len(ids):
+                self._dead = np.union1d(self._dead, ids)
+
+    def needs_rebuild(self):
+        """Whether a fresh index is due: reload age, untrained or outgrown lists, or too many tombstones."""
+        if SIMILAR_RELOAD_SECONDS > 0 and time.monotonic() - self.loaded_at > SIMILAR_RELOAD_SECONDS:
+            return True
+        if self.count >= SIMILAR_IVF_MIN and (self.centroids is None or self.count >= 2 * self.trained_on):
+            return True
+        return len(self._dead) > MAX_DEAD_FRACTION * self.count
+
+    def train(self):
+        """Train the IVF lists if the index is big enough; for indexes not yet in use."""
+        with self._lock:
+            if self.count < SIMILAR_IVF_MIN:
+                return
+            with metrics.stage("similar.train"):
+                self.centroids = kmeans(self.vectors[:self.count], int(np.sqrt(self.count)))
+            self.trained_on = self.count
+            self._assign(0)
+
+    def _maintain(self):
+        # Only the cheap tail merge runs inline; training is left to rebuilds
+        if self.centroids is not None and self.count - self.indexed >= MERGE_THRESHOLD:
+            self._assign(self.indexed)
+
+    def _assign(self, start):
+        with metrics.stage("similar.assign"):
+            assign = np.empty(self.count, dtype=np.int64)
+            if start:
+                assign[:start] = self._assignments[:start]
+            for chunk in range(start, self.count, 65536):
+                block = self.vectors[chunk:min(chunk + 65536, self.count)]
+                assign[chunk:chunk + len(block)] = np.argmax(block @ self.centroids.T, axis=1)
+            self._assignments = assign
+            self._order = np.argsort(assign, kind='stable')
+            self._offsets = np.concatenate([[0], np.cumsum(np.bincount(assign, minlength=len(self.centroids)))])
+            self.indexed = self.count
+
+    def search(self, vector, k=5, exclude_id=None):
+        """``[(analysis_id, similarity), ...]`` for the ``k`` most similar vectors."""
+        with self._lock:
+            vector = np.asarray(vector, dtype=np.float32)
+            if self.centroids is None:
+                rows = np.arange(self.count)
+            else:
+                lists = np.argpartition(-(self.centroids @ vector), min(SIMILAR_NPROBE, len(self.centroids) - 1))
+                lists = lists[:SIMILAR_NPROBE]
+                starts, lengths = self._offsets[lists], self._offsets[lists + 1] - self._offsets[lists]
+                total = int(lengths.sum())
+                positions = np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(total)
+                rows = np.concatenate([self._order[positions], np.arange(self.indexed, self.count)])
+            ids = self.ids[rows]
+            scores = self.vectors[rows] @ vector
+            keep = ~np.isin(ids, self._dead) if len(self._dead) else np.ones(len(ids), dtype=bool)
+            if exclude_id is not None:
+                keep &= ids != exclude_id
+            return _top_k(ids[keep], scores[keep], k)
+
+
+_indexes = OrderedDict()
+_indexes_lock = threading.Lock()
+# Users whose index is being rebuilt on the background thread
+_rebuilding = set()
+
+
+def _load_rows(user_id, after_id, chunk_size=50000):
+    table = Analysis.__table__
+    query = (select(table.c.id, table.c.embedding)
+             .where(table.c.user_id == user_id, table.c.id > after_id, table.c.embedding.isnot(None))
+             .order_by(table.c.id)
+             .execution_options(yield_per=chunk_size))
+    # The session sees its own flushed rows; those are added when it commits
+    uncommitted = {analysis_id for _, analysis_id, _ in db.session.info.get('similar_pending', ())}
+    ids, blobs = [], []
+    for row_id, blob in db.session.execute(query):
+        if len(blob) == EMBEDDING_DIM * 4 and row_id not in uncommitted:
+            ids.append(row_id)
+            blobs.append(blob)
+    vectors = np.frombuffer(b''.join(blobs), dtype=np.float32).reshape(-1, EMBEDDING_DIM)
+    return np.array(ids, dtype=np.int64), vectors
+
+
+def user_index(user_id):
+    """The user's index, loaded on first use and caught up with rows added since.
+
+    Schedules a background rebuild when one is due.
+    """
+    with _indexes_lock:
+        index = _indexes.get(user_id)
+        if index is None:
+            index = _indexes[user_id] = VectorIndex()
+            while len(_indexes) > SIMILAR_MAX_USERS:
+                _indexes.popitem(last=False)
+        _indexes.move_to_end(user_id)
+    with index._lock:
+        with metrics.stage("similar.load"):
+            index.add_many(*_load_rows(user_id, index.max_id))
+        rebuild = index.needs_rebuild()
+    if rebuild:
+        with _indexes_lock:
+            rebuild = user_id not in _rebuilding
+            _rebuilding.add(user_id)
+        if rebuild:
+            offload.run_background(_rebuild, current_app._get_current_object(), user_id)
+    return index
+
+
+def _rebuild(app, user_id):
+    """Load, train and swap in a fresh index for ``user_id``; runs on the background thread."""
+    try:
+        with app.app_context():
+            index = VectorIndex()
+            with metrics.stage("similar.rebuild"):
+                index.add_many(*_load_rows(user_id, 0))
+                index.train()
+        with _indexes_lock:
+            old = _indexes.get(user_id)
+            # Not swapped in if the user was evicted meanwhile
+            if old is not None:
+                # Removals seen while the new index was loading
+                index.remove(old._dead)
+                _indexes[user_id] = index
+    except Exception as e:
+        print(f"Similarity index rebuild error: {str(e)}")
+        metrics.record_error("similarity.rebuild")
+    finally:
+        with _indexes_lock:
+            _rebuilding.discard(user_id)
+
+
+def add_on_commit(user_id, analysis_id, vector):
+    """Add a flushed analysis to the user's index (if loaded) once the current session commits."""
+    if vector is not None:
+        db.session.info.setdefault('similar_pending', []).append((user_id, analysis_id, vector))
+
+
+def remove(ids):
+    """Drop ``ids`` from every user index loaded in this process."""
+    with _indexes_lock:
+        indexes = list(_indexes.values())
+    for index in indexes:
+        index.remove(ids)
+
+
+@event.listens_for(Session, 'after_commit')
+def _add_committed(session):
+    for user_id, analysis_id, vector in session.info.pop('similar_pending', ()):
+        index = _indexes.get(user_id)
+        if index is not None:
+            index.add(analysis_id, vector)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_pending(session):
+    session.info.pop('similar_pending', None)
+
+
+def similar_analyses(analysis, k=5):
+    """``[(Analysis, similarity), ...]`` most like ``analysis`` among the same user's."""
+    if analysis.embedding is None:
+        return []
+    with metrics.stage("similar.search"):
+        vector = np.frombuffer(analysis.embedding, dtype=np.float32)
+        index = user_index(analysis.user_id)
+        while True:
+            matches = index.search(vector, k, exclude_id=analysis.id)
+            ids = [i for i, _ in matches]
+            rows = {a.id: a for a in Analysis.query.filter(Analysis.id.in_(ids)).all()} if ids else {}
+            missing = [i for i in ids if i not in rows]
+            if not missing:
+                return [(rows[i], score) for i, score in matches]
+            index.remove(missing)
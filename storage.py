@@ -0,0 +1,107 @@
+"""Layout of uploaded images and generated reports on disk.
+
+New files are fanned out by a hash of their name into
+``<root>/ab/cd/<name>`` (``STORAGE_SHARD_DEPTH`` levels of 256
+directories), so no directory holds more than a few files per thousand
+stored. The path relative to the root, with ``/`` separators, is what
+``Analysis.image_filename`` stores. That keeps ``url_for('static',
+filename='uploads/' + image_filename)`` working for both sharded names and
+the flat names saved before sharding. ``shard_existing_uploads`` moves
+those older files into the sharded layout.
+"""
+import hashlib
+import os
+
+from sqlalchemy import bindparam, select, update
+
+import fragments
+from auth import db, Analysis, AnalysisArchive
+
+UPLOAD_ROOT = os.path.join("static", "uploads")
+REPORT_ROOT = os.path.join("static", "reports")
+STORAGE_SHARD_DEPTH = int(os.environ.get('STORAGE_SHARD_DEPTH', 2))
+
+
+def sharded_name(name, depth=None):
+    """``name`` prefixed with its shard directories, e.g. ``3f/a9/apple_1c2d3e4f.jpg``."""
+    depth = STORAGE_SHARD_DEPTH if depth is None else depth
+    if depth <= 0:
+        return name
+    digest = hashlib.md5(name.encode('utf-8')).hexdigest()
+    return '/'.join([digest[2 * level:2 * level + 2] for level in range(depth)] + [name])
+
+
+def upload_path(relname):
+    return os.path.join(UPLOAD_ROOT, *relname.split('/'))
+
+
+def new_upload(filename):
+    """``(filepath, relname)`` for a new upload called ``filename``; the shard directory is created."""
+    relname = sharded_name(filename)
+    filepath = upload_path(relname)
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    return filepath, relname
+
+
+def report_path(analysis_id):
+    """Where the PDF report for ``analysis_id`` is written; the directory is created."""
+    filepath = os.path.join(REPORT_ROOT, *sharded_name(f"report_{analysis_id}.pdf").split('/'))
+    os.makedirs(os.path.dirname(filepath), exist_ok=True)
+    return filepath
+
+
+def _move(old_relname, new_relname):
+    source = upload_path(old_relname)
+    if not os.path.exists(source):
+        return False
+    target = upload_path(new_relname)
+    os.makedirs(os.path.dirname(target), exist_ok=True)
+    os.replace(source, target)
+    return True
+
+
+def shard_existing_uploads(batch_size=500):
+    """Move flat-layout uploads (and their heatmaps) into shard directories.
+
+    Rows are handled in id order, ``batch_size`` per commit, so the command
+    can be stopped and rerun. Archived analyses are moved too. Returns
+    ``(rows_updated, files_moved)``.
+    """
+    updated = moved = 0
+    for table in (Analysis.__table__, AnalysisArchive.__table__):
+        table_updated, table_moved = _shard_table(table, batch_size)
+        updated += table_updated
+        moved += table_moved
+    if updated:
+        # Cached pages link the old image paths
+        fragments.bump_global()
+    return updated, moved
+
+
+def _shard_table(table, batch_size):
+    statement = (update(table).where(table.c.id == bindparam('row_id'))
+                 .values(image_filename=bindparam('image'), heatmap_filename=bindparam('heatmap')))
+    updated = moved = 0
+    last_id = 0
+    while True:
+        rows = db.session.execute(
+            select(table.c.id, table.c.image_filename, table.c.heatmap_filename)
+            .where(table.c.id > last_id, ~table.c.image_filename.contains('/'))
+            .order_by(table.c.id).limit(batch_size)
+        ).all()
+        if not rows:
+            break
+        params = []
+        for row_id, image, heat in rows:
+            new_image = sharded_name(image)
+            # The heatmap moves into the same shard as its image
+            new_heat = None if heat is None else new_image[:-len(image)] + heat
+            moved += _move(image, new_image)
+            if heat is not None:
+                moved += _move(heat, new_heat)
+            params.append({'row_id': row_id, 'image': new_image, 'heatmap': new_heat})
+        db.session.connection().execute(statement, params)
+        db.session.commit()
+        updated += len(params)
+        last_id = rows[-1][0]
+    return updated, moved
@@ -0,0 +1,79 @@
+"""Identity cache for the Flask-Login user loader.
+
+Every authenticated request used to load its ``User`` row before doing
+any work. Instead, the loader returns a ``UserSnapshot`` of the few
+fields routes and templates read, cached for ``USER_CACHE_TTL`` seconds.
+Code that changes a user loads the real row, commits, and calls
+``invalidate``. With ``CACHE_URL`` pointing at Redis, the snapshots and
+invalidations are shared by all workers. Otherwise a change made in one
+worker shows up in the others after at most one TTL.
+"""
+import os
+
+import metrics
+from auth import db, User
+from cache_backends import make_cache
+
+USER_CACHE_TTL = float(os.environ.get('USER_CACHE_TTL', 300))
+USER_CACHE_MAX_ENTRIES = int(os.environ.get('USER_CACHE_MAX_ENTRIES', 10000))
+
+_cache = make_cache('user', max_entries=USER_CACHE_MAX_ENTRIES)
+
+
+class UserSnapshot:
+    """Read-only stand-in for ``User`` that satisfies Flask-Login's user interface."""
+    __slots__ = ('id', 'username', 'email', 'profile_picture')
+    is_authenticated = True
+    is_active = True
+    is_anonymous = False
+
+    def __init__(self, id, username, email, profile_picture):
+        self.id = id
+        self.username = username
+        self.email = email
+        self.profile_picture = profile_picture
+
+    @classmethod
+    def from_user(cls, user):
+        return cls(user.id, user.username, user.email, user.profile_picture)
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def get_id(self):
+        return str(self.id)
+
+    def __eq__(self, other):
+        return getattr(other, 'id', None) == self.id and hasattr(other, 'get_id')
+
+    def __hash__(self):
+        return hash(self.id)
+
+    def __repr__(self):
+        return f'<UserSnapshot {self.username}>'
+
+
+def _key(user_id):
+    return str(user_id)
+
+
+def load(user_id):
+    """Snapshot of user ``user_id``, or None if there is no such user. Misses query the database."""
+    user_id = int(user_id)
+    if USER_CACHE_TTL > 0:
+        cached = _cache.get(_key(user_id))
+        if cached is not None:
+            metrics.inc("food_user_cache_total", result="hit")
+            return UserSnapshot(**cached)
+    metrics.inc("food_user_cache_total", result="miss")
+    user = db.session.get(User, user_id)
+    if user is None:
+        return None
+    snapshot = UserSnapshot.from_user(user)
+    if USER_CACHE_TTL > 0:
+        _cache.set(_key(user_id), snapshot.to_dict(), ttl=USER_CACHE_TTL)
+    return snapshot
+
+
+def invalidate(user_id):
+    _cache.delete(_key(user_id))